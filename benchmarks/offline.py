@@ -0,0 +1,92 @@
+"""
+Deterministic, offline stand-ins for the models of the day pipelines.
+
+`HashEmbedding` embeds texts as hashed bags of words, so that texts sharing
+terms are similar, and `MockLLM` answers with a fixed number of tokens. Text
+is split on whitespace and sentence punctuation, so no tokenizer or NLTK data
+has to be downloaded.
+"""
+
+import hashlib
+import re
+from typing import List
+
+import numpy as np
+from llama_index.core import Settings
+from llama_index.core.base.embeddings.base import BaseEmbedding, Embedding
+from llama_index.core.llms import MockLLM
+from llama_index.core.node_parser import SentenceSplitter
+
+from utils.bm25 import tokenize
+
+SENTENCE_END = re.compile(r"(?<=[.!?])\s+")
+
+
+def split_words(text: str) -> List[str]:
+    """Splits a text on whitespace."""
+    return text.split()
+
+
+def split_sentences(text: str) -> List[str]:
+    """Splits a text after sentence punctuation."""
+    return SENTENCE_END.split(text)
+
+
+class HashEmbedding(BaseEmbedding):
+    """Embedding of a text as the unit-norm, signed feature hash of its terms."""
+
+    embed_dim: int = 256
+
+    def __init__(self, embed_dim: int = 256, **kwargs) -> None:
+        super().__init__(embed_dim=embed_dim, model_name=f"hash-{embed_dim}", **kwargs)
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "HashEmbedding"
+
+    def _embed(self, text: str) -> Embedding:
+        vector = np.zeros(self.embed_dim, dtype=np.float32)
+        for term in tokenize(text):
+            digest = hashlib.blake2b(term.encode("utf-8"), digest_size=8).digest()
+            value = int.from_bytes(digest, "little")
+            vector[value % self.embed_dim] += 1.0 if value >> 63 else -1.0
+        norm = np.linalg.norm(vector)
+        return (vector / norm if norm else vector).tolist()
+
+    def _get_query_embedding(self, query: str) -> Embedding:
+        return self._embed(query)
+
+    async def _aget_query_embedding(self, query: str) -> Embedding:
+        return self._embed(query)
+
+    def _get_text_embedding(self, text: str) -> Embedding:
+        return self._embed(text)
+
+    async def _aget_text_embedding(self, text: str) -> Embedding:
+        return self._embed(text)
+
+
+def use_offline_models(
+    chunk_size: int = 1000, chunk_overlap: int = 200, answer_tokens: int = 64
+) -> None:
+    """
+    Installs the offline stand-ins in `Settings`.
+
+    Must be called after importing a day module, as the day modules set the
+    chunk size of `Settings` on import.
+
+    Args:
+        chunk_size (int, optional): The chunk size, in words. Defaults to 1000.
+        chunk_overlap (int, optional): The chunk overlap, in words. Defaults to 200.
+        answer_tokens (int, optional): The number of tokens of every LLM answer. Defaults to 64.
+    """
+    Settings.embed_model = HashEmbedding()
+    Settings.llm = MockLLM(max_tokens=answer_tokens)
+    Settings.tokenizer = split_words
+    Settings.node_parser = SentenceSplitter(
+        chunk_size=chunk_size,
+        chunk_overlap=chunk_overlap,
+        tokenizer=split_words,
+        chunking_tokenizer_fn=split_sentences,
+    )
+    Settings.transformations = [Settings.node_parser]
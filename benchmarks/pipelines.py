@@ -0,0 +1,448 @@
+"""
+End-to-end benchmark of the day pipelines.
+
+Builds the `RAG` of days 0-1 and the `Chatbot` indices of days 2-4 over a
+synthetic corpus, with the offline stand-ins of `benchmarks.offline`, and
+reports for every configuration (day, backend, chunk size, top k):
+
+- the ingestion time and throughput of a cold build, and its peak RSS,
+- the time to load the persisted indices in a fresh interpreter,
+- the retrieval and end-to-end query latency percentiles, and their peak RSS.
+
+Both phases run in fresh interpreters, so that a phase's load time and peak
+RSS are its own. Day 0 persists in the "mmap" or "json" format, days 1-4 use
+the "chroma" or "numpy" backend; each day runs the backends it supports. The
+end-to-end queries of days 2-4 go through a year's query engine, the agent
+itself is not benchmarked as it needs a function-calling LLM.
+
+Usage:
+    python -m benchmarks.pipelines --days 0,1,2 --chunk-sizes 512,1000 --output pipelines.json
+    python -m benchmarks.pipelines --baseline pipelines.json --tolerance 0.2
+    python main.py -d 2 --benchmark
+"""
+
+import argparse
+import importlib
+import itertools
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List, Optional
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DAY_BACKENDS = {
+    0: ["mmap", "json"],
+    1: ["chroma", "numpy"],
+    2: ["chroma", "numpy"],
+    3: ["chroma", "numpy"],
+    4: ["chroma", "numpy"],
+}
+# measures where lower is better, compared against the baseline
+TRACKED = [
+    "ingest_time",
+    "ingest_peak_rss_mb",
+    "load_time",
+    "retrieve_p50_ms",
+    "retrieve_p95_ms",
+    "retrieve_p99_ms",
+    "query_p50_ms",
+    "query_p95_ms",
+    "query_p99_ms",
+    "query_peak_rss_mb",
+]
+
+SEGMENTS = ["Mobility", "Delivery", "Freight"]
+ITEMS = ["revenue", "adjusted EBITDA", "gross bookings", "operating loss", "net income"]
+YEARS = ["2022", "2021", "2020", "2019"]
+
+
+def peak_rss_mb() -> float:
+    """Returns the peak resident memory of the process, in MiB."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes elsewhere
+    return peak / 2**20 if sys.platform == "darwin" else peak / 2**10
+
+
+def percentile(samples: List[float], q: float) -> float:
+    """Returns the q-th percentile of samples."""
+    import numpy as np
+
+    return float(np.percentile(samples, q))
+
+
+def make_sentence(rng: random.Random, year: str) -> str:
+    """Generates a sentence of a synthetic filing."""
+    return (
+        f"In {year} the {rng.choice(SEGMENTS)} segment reported {rng.choice(ITEMS)}"
+        f" of {rng.randrange(1, 20_000):,} million dollars,"
+        f" {rng.choice(['up', 'down'])} {rng.randrange(1, 60)} percent from the prior year."
+    )
+
+
+def make_corpus(
+    data_dir: str, day: int, documents: int, paragraphs: int, seed: int = 0
+) -> None:
+    """
+    Generates the synthetic corpus of a day.
+
+    Days 0-1 get `documents` text files, days 2-4 one HTML filing per year.
+
+    Args:
+        data_dir (str): The folder to write the corpus to.
+        day (int): The day number.
+        documents (int): The number of text files of days 0-1.
+        paragraphs (int): The number of paragraphs of every file.
+        seed (int, optional): The random seed. Defaults to 0.
+    """
+    rng = random.Random(seed)
+    if day < 2:
+        os.makedirs(data_dir, exist_ok=True)
+        for i in range(documents):
+            with open(os.path.join(data_dir, f"doc_{i:03d}.txt"), "w") as f:
+                for _ in range(paragraphs):
+                    year = rng.choice(YEARS)
+                    sentences = [make_sentence(rng, year) for _ in range(4)]
+                    f.write(" ".join(sentences) + "\n\n")
+        return
+
+    os.makedirs(os.path.join(data_dir, "UBER"), exist_ok=True)
+    for year in YEARS:
+        with open(os.path.join(data_dir, "UBER", f"UBER_{year}.html"), "w") as f:
+            f.write("<html><body>\n")
+            for _ in range(paragraphs):
+                sentences = [make_sentence(rng, year) for _ in range(4)]
+                f.write(f"<p>{' '.join(sentences)}</p>\n")
+            f.write("</body></html>\n")
+
+
+def make_queries(count: int, seed: int = 1) -> List[Dict[str, str]]:
+    """
+    Generates distinct queries, each about a year.
+
+    Every query mentions a distinct figure, so that the query caches never
+    serve one query with the result of another.
+
+    Args:
+        count (int): The number of queries.
+        seed (int, optional): The random seed. Defaults to 1.
+
+    Returns:
+        List[Dict[str, str]]: The queries, as {"year", "query"} dicts.
+    """
+    rng = random.Random(seed)
+    queries = []
+    for i in range(count):
+        year = rng.choice(YEARS)
+        queries.append(
+            {
+                "year": year,
+                "query": f"Was the {rng.choice(ITEMS)} of the {rng.choice(SEGMENTS)}"
+                f" segment in {year} above {1_000 + i} million dollars?",
+            }
+        )
+    return queries
+
+
+def open_pipeline(config: Dict, data_dir: str, persist_dir: str):
+    """
+    Builds or loads the pipeline of a configuration, with all its indices loaded.
+
+    Args:
+        config (Dict): The configuration.
+        data_dir (str): The folder of the corpus.
+        persist_dir (str): The folder of the persisted indices.
+
+    Returns:
+        Union[RAG, Chatbot]: The pipeline.
+    """
+    day = config["day"]
+    module = importlib.import_module(f"day{day}.main")
+    if day == 0:
+        return module.RAG(data_dir, persist_dir, storage_format=config["backend"])
+    if day == 1:
+        return module.RAG(
+            data_dir,
+            persist_dir,
+            similarity_top_k=config["top_k"],
+            streaming=False,
+            vector_backend=config["backend"],
+        )
+
+    chatbot = module.Chatbot(
+        data_dir,
+        persist_dir,
+        similarity_top_k=config["top_k"],
+        streaming=False,
+        vector_backend=config["backend"],
+        partitioned=config["partitioned"],
+    )
+    registry = chatbot.init_indices()
+    keys = [chatbot.CHROMA_COLLECTION_NAME] if chatbot.partitioned else chatbot.years
+    for key in keys:
+        registry.get(key)
+    return chatbot
+
+
+def count_chunks(pipeline) -> int:
+    """Returns the number of chunks indexed by a pipeline."""
+    manifests = getattr(pipeline, "manifests", None)
+    manifests = manifests.values() if manifests else [pipeline.manifest]
+    return sum(
+        len(entry["chunks"])
+        for manifest in manifests
+        for entry in manifest.files.values()
+    )
+
+
+def run_phase(config: Dict, workdir: str, phase: str) -> Dict:
+    """
+    Runs a phase of a configuration in the current process.
+
+    Args:
+        config (Dict): The configuration.
+        workdir (str): The folder holding the corpus, the indices and the embedding cache.
+        phase (str): "ingest" to build the indices, "serve" to load and query them.
+
+    Returns:
+        Dict: The measures of the phase.
+    """
+    from llama_index.core.schema import QueryBundle
+
+    from benchmarks.offline import use_offline_models
+    from utils.embeddings import use_embedding_cache
+
+    # the day module sets the chunk size on import
+    importlib.import_module(f"day{config['day']}.main")
+    use_offline_models(config["chunk_size"], config["chunk_overlap"])
+    use_embedding_cache(cache_dir=os.path.join(workdir, "embeddings"))
+    data_dir = config.get("data_dir") or os.path.join(workdir, "data")
+    persist_dir = os.path.join(workdir, "storage")
+
+    start = time.perf_counter()
+    pipeline = open_pipeline(config, data_dir, persist_dir)
+    elapsed = time.perf_counter() - start
+    if phase == "ingest":
+        chunks = count_chunks(pipeline)
+        return {
+            "chunks": chunks,
+            "ingest_time": elapsed,
+            "chunks_per_sec": chunks / elapsed if elapsed else 0.0,
+            "ingest_peak_rss_mb": peak_rss_mb(),
+        }
+
+    retrieve_ms, query_ms = [], []
+    for query in make_queries(config["queries"]):
+        if config["day"] < 2:
+            engine = pipeline.query_engine.inner
+            start = time.perf_counter()
+            engine.retrieve(QueryBundle(query["query"]))
+            retrieve_ms.append((time.perf_counter() - start) * 1000)
+            start = time.perf_counter()
+            str(pipeline.run(query["query"]))
+            query_ms.append((time.perf_counter() - start) * 1000)
+        else:
+            engine = pipeline.year_query_engine(query["year"])
+            start = time.perf_counter()
+            engine.retrieve(QueryBundle(query["query"]))
+            retrieve_ms.append((time.perf_counter() - start) * 1000)
+            start = time.perf_counter()
+            str(pipeline.year_query_engine(query["year"]).query(query["query"]))
+            query_ms.append((time.perf_counter() - start) * 1000)
+
+    measures = {"load_time": elapsed}
+    for name, samples in (("retrieve", retrieve_ms), ("query", query_ms)):
+        for q in (50, 95, 99):
+            measures[f"{name}_p{q}_ms"] = percentile(samples, q)
+    measures["query_peak_rss_mb"] = peak_rss_mb()
+    return measures
+
+
+def run_in_subprocess(config: Dict, workdir: str, phase: str) -> Dict:
+    """
+    Runs a phase of a configuration in a fresh interpreter.
+
+    Args:
+        config (Dict): The configuration.
+        workdir (str): The folder holding the corpus, the indices and the embedding cache.
+        phase (str): "ingest" or "serve".
+
+    Returns:
+        Dict: The measures of the phase, or {"error": ...} if it failed.
+    """
+    result = subprocess.run(
+        [
+            sys.executable,
+            "-W",
+            "ignore",
+            "-m",
+            "benchmarks.pipelines",
+            "--phase",
+            phase,
+            "--config",
+            json.dumps(config),
+            "--workdir",
+            workdir,
+        ],
+        cwd=ROOT,
+        capture_output=True,
+        text=True,
+    )
+    if result.returncode != 0:
+        return {"error": result.stderr.strip().splitlines()[-1:]}
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def run(
+    days: List[int],
+    chunk_sizes: List[int] = [1000],
+    top_ks: List[int] = [3],
+    backends: List[str] = ["chroma", "numpy", "mmap"],
+    queries: int = 50,
+    documents: int = 20,
+    paragraphs: int = 200,
+    partitioned: bool = False,
+    data_dir: Optional[str] = None,
+) -> List[Dict]:
+    """
+    Runs the benchmark.
+
+    Args:
+        days (List[int]): The days to benchmark.
+        chunk_sizes (List[int], optional): The chunk sizes, in words. Defaults to [1000].
+        top_ks (List[int], optional): The numbers of retrieved chunks, for days 1-4. Defaults to [3].
+        backends (List[str], optional): Among "chroma" and "numpy" for days 1-4, "mmap" and "json" for day 0.
+            Defaults to ["chroma", "numpy", "mmap"].
+        queries (int, optional): The number of queries per configuration. Defaults to 50.
+        documents (int, optional): The number of text files of days 0-1. Defaults to 20.
+        paragraphs (int, optional): The number of paragraphs of every file. Defaults to 200.
+        partitioned (bool, optional): Whether days 2-4 index all the years in a single collection. Defaults to False.
+        data_dir (str, optional): A corpus to use instead of the synthetic one. Defaults to None.
+
+    Returns:
+        List[Dict]: The configuration and measures of every run.
+    """
+    results = []
+    for day in days:
+        day_backends = [b for b in backends if b in DAY_BACKENDS[day]]
+        # day 0 retrieves a fixed number of chunks
+        day_top_ks = [None] if day == 0 else top_ks
+        for backend, chunk_size, top_k in itertools.product(
+            day_backends, chunk_sizes, day_top_ks
+        ):
+            config = {
+                "day": day,
+                "backend": backend,
+                "chunk_size": chunk_size,
+                "chunk_overlap": chunk_size // 5,
+                "top_k": top_k,
+                "partitioned": partitioned,
+                "queries": queries,
+                "data_dir": data_dir,
+            }
+            with tempfile.TemporaryDirectory() as workdir:
+                if data_dir is None:
+                    make_corpus(
+                        os.path.join(workdir, "data"), day, documents, paragraphs
+                    )
+                measures = run_in_subprocess(config, workdir, "ingest")
+                if "error" not in measures:
+                    measures.update(run_in_subprocess(config, workdir, "serve"))
+            results.append({**config, **measures})
+            print(json.dumps(results[-1]), file=sys.stderr)
+    return results
+
+
+def config_key(result: Dict) -> str:
+    """Returns the name of the configuration of a result."""
+    key = f"day{result['day']}/{result['backend']}/chunk{result['chunk_size']}"
+    if result["top_k"] is not None:
+        key += f"/top{result['top_k']}"
+    return key + ("/partitioned" if result.get("partitioned") else "")
+
+
+def find_regressions(
+    results: List[Dict], baseline: List[Dict], tolerance: float
+) -> List[str]:
+    """
+    Compares results against a baseline, configuration by configuration.
+
+    Args:
+        results (List[Dict]): The current results.
+        baseline (List[Dict]): The baseline results.
+        tolerance (float): The allowed relative increase of a measure.
+
+    Returns:
+        List[str]: A description of every measure worse than the baseline beyond the tolerance.
+    """
+    previous = {config_key(result): result for result in baseline}
+    regressions = []
+    for result in results:
+        reference = previous.get(config_key(result), {})
+        for name in TRACKED:
+            if name in result and name in reference:
+                if result[name] > reference[name] * (1 + tolerance):
+                    regressions.append(
+                        f"{config_key(result)} {name}: {result[name]:.3f} vs {reference[name]:.3f}"
+                    )
+    return regressions
+
+
+def parse_list(value: str, cast=str) -> List:
+    return [cast(item) for item in value.split(",") if item]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--days", default="0,1,2,3,4")
+    parser.add_argument("--chunk-sizes", default="1000", help="Chunk sizes, in words")
+    parser.add_argument("--top-k", default="3", help="Numbers of retrieved chunks")
+    parser.add_argument("--backends", default="chroma,numpy,mmap")
+    parser.add_argument("--queries", type=int, default=50)
+    parser.add_argument("--documents", type=int, default=20)
+    parser.add_argument("--paragraphs", type=int, default=200)
+    parser.add_argument("--partitioned", action="store_true")
+    parser.add_argument("--data-dir", help="Corpus to use instead of the synthetic one")
+    parser.add_argument("--output", help="Path to write the JSON results to")
+    parser.add_argument(
+        "--baseline", help="Path of previous JSON results to compare to"
+    )
+    parser.add_argument(
+        "--tolerance", type=float, default=0.2, help="Allowed relative increase"
+    )
+    # internal: runs a single phase in this interpreter
+    parser.add_argument("--phase", choices=["ingest", "serve"], help=argparse.SUPPRESS)
+    parser.add_argument("--config", help=argparse.SUPPRESS)
+    parser.add_argument("--workdir", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.phase:
+        print(json.dumps(run_phase(json.loads(args.config), args.workdir, args.phase)))
+        sys.exit(0)
+
+    results = run(
+        parse_list(args.days, int),
+        chunk_sizes=parse_list(args.chunk_sizes, int),
+        top_ks=parse_list(args.top_k, int),
+        backends=parse_list(args.backends),
+        queries=args.queries,
+        documents=args.documents,
+        paragraphs=args.paragraphs,
+        partitioned=args.partitioned,
+        data_dir=args.data_dir,
+    )
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = find_regressions(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print("Regression:", regression)
+        sys.exit(1 if regressions else 0)
@@ -0,0 +1,153 @@
+"""
+Startup benchmark of the day pipelines.
+
+Measures, in fresh interpreters, the import time of every day module and the
+time-to-first-prompt of the day 2-4 chatbots (`python main.py -d <day>`), and
+optionally compares them against a previous run to catch regressions.
+
+Usage:
+    python -m benchmarks.startup --output startup.json
+    python -m benchmarks.startup --baseline startup.json --tolerance 0.2
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+from typing import Dict, List
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DAYS = [0, 1, 2, 3, 4]
+CHATBOT_DAYS = [2, 3, 4]
+PROMPT = b"User: "
+
+
+def measure_import(day: int) -> float:
+    """
+    Measures the import time of a day module in a fresh interpreter.
+
+    Args:
+        day (int): The day number.
+
+    Returns:
+        float: The import time, in seconds.
+    """
+    code = (
+        "import time; start = time.perf_counter();"
+        f" import day{day}.main;"
+        " print(time.perf_counter() - start)"
+    )
+    output = subprocess.run(
+        [sys.executable, "-W", "ignore", "-c", code],
+        cwd=ROOT,
+        capture_output=True,
+        check=True,
+        text=True,
+    ).stdout
+    return float(output.strip().splitlines()[-1])
+
+
+def measure_first_prompt(day: int, timeout: float = 120) -> float:
+    """
+    Measures the time from launching a chatbot to its first prompt.
+
+    Args:
+        day (int): The day number.
+        timeout (float, optional): The time to wait for the prompt, in seconds. Defaults to 120.
+
+    Returns:
+        float: The time-to-first-prompt, in seconds.
+    """
+    start = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, "-W", "ignore", "main.py", "-d", str(day)],
+        cwd=ROOT,
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+        bufsize=0,
+    )
+    output = b""
+    try:
+        while not output.endswith(PROMPT):
+            chunk = process.stdout.read(1)  # type: ignore
+            if not chunk:
+                raise RuntimeError(f"day {day} exited before prompting")
+            output += chunk
+            if time.perf_counter() - start > timeout:
+                raise TimeoutError(f"day {day} did not prompt within {timeout}s")
+        elapsed = time.perf_counter() - start
+        process.communicate(b"q\n", timeout=timeout)
+    finally:
+        process.kill()
+    return elapsed
+
+
+def run(runs: int) -> Dict[str, float]:
+    """
+    Runs the benchmark.
+
+    Args:
+        runs (int): The number of runs of every measure. The median is reported.
+
+    Returns:
+        Dict[str, float]: The median of every measure, in seconds.
+    """
+    results = {}
+    for day in DAYS:
+        samples = [measure_import(day) for _ in range(runs)]
+        results[f"import_day{day}"] = statistics.median(samples)
+    for day in CHATBOT_DAYS:
+        samples = [measure_first_prompt(day) for _ in range(runs)]
+        results[f"first_prompt_day{day}"] = statistics.median(samples)
+    return results
+
+
+def find_regressions(
+    results: Dict[str, float], baseline: Dict[str, float], tolerance: float
+) -> List[str]:
+    """
+    Compares results against a baseline.
+
+    Args:
+        results (Dict[str, float]): The current results.
+        baseline (Dict[str, float]): The baseline results.
+        tolerance (float): The allowed relative slowdown.
+
+    Returns:
+        List[str]: A description of every measure slower than the baseline beyond the tolerance.
+    """
+    return [
+        f"{name}: {value:.3f}s vs {baseline[name]:.3f}s"
+        for name, value in results.items()
+        if name in baseline and value > baseline[name] * (1 + tolerance)
+    ]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=3, help="Runs per measure")
+    parser.add_argument("--output", help="Path to write the JSON results to")
+    parser.add_argument(
+        "--baseline", help="Path of previous JSON results to compare to"
+    )
+    parser.add_argument(
+        "--tolerance", type=float, default=0.2, help="Allowed relative slowdown"
+    )
+    args = parser.parse_args()
+
+    results = run(args.runs)
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = find_regressions(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print("Regression:", regression)
+        sys.exit(1 if regressions else 0)
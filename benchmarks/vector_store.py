@@ -0,0 +1,184 @@
+"""
+Retrieval benchmark of the vector store backends.
+
+Indexes random embeddings in `NumpyVectorStore`, in each of its quantization
+modes, and in `ChromaVectorStore`, then reports for each corpus size the build
+time, the single-query latency percentiles, the batched throughput and the
+recall against an exact float32 search.
+
+Usage:
+    python -m benchmarks.vector_store --sizes 10000,100000,1000000 --output vector_store.json
+"""
+
+import argparse
+import json
+import statistics
+import tempfile
+import time
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+from llama_index.core.schema import TextNode
+from llama_index.core.vector_stores.types import (
+    BasePydanticVectorStore,
+    VectorStoreQuery,
+)
+
+from utils.numpy_store import NumpyVectorStore, normalize
+
+
+def make_corpus(size: int, dim: int, queries: int, seed: int = 0):
+    """
+    Generates random embeddings, and queries close to some of them.
+
+    Args:
+        size (int): The number of embeddings.
+        dim (int): The dimension of the embeddings.
+        queries (int): The number of queries.
+        seed (int, optional): The random seed. Defaults to 0.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: The embeddings and the queries, unit-norm.
+    """
+    rng = np.random.default_rng(seed)
+    embeddings = normalize(rng.standard_normal((size, dim), dtype=np.float32))
+    targets = embeddings[rng.choice(size, queries, replace=False)]
+    noise = rng.standard_normal((queries, dim), dtype=np.float32) * 0.05
+    return embeddings, normalize(targets + noise)
+
+
+def exact_top_k(embeddings: np.ndarray, queries: np.ndarray, k: int) -> List[set]:
+    """Returns the rows of the k most similar embeddings of every query."""
+    truth = []
+    for query in queries:
+        scores = embeddings @ query
+        truth.append(set(np.argpartition(-scores, k - 1)[:k].tolist()))
+    return truth
+
+
+def percentile(samples: List[float], q: float) -> float:
+    """Returns the q-th percentile of samples."""
+    return float(np.percentile(samples, q))
+
+
+def bench_store(
+    store: BasePydanticVectorStore,
+    embeddings: np.ndarray,
+    queries: np.ndarray,
+    truth: List[set],
+    k: int,
+    batch_query: Optional[Callable] = None,
+) -> Dict[str, float]:
+    """
+    Benchmarks a vector store.
+
+    Args:
+        store (BasePydanticVectorStore): The empty store.
+        embeddings (np.ndarray): The embeddings to index.
+        queries (np.ndarray): The queries.
+        truth (List[set]): The exact top k rows of every query.
+        k (int): The number of nodes to retrieve.
+        batch_query (Callable, optional): Retrieves all the queries at once, if supported.
+
+    Returns:
+        Dict[str, float]: The build time, latencies, throughput and recall.
+    """
+    start = time.perf_counter()
+    # below chroma's maximum batch size
+    for chunk in range(0, len(embeddings), 5_000):
+        store.add(
+            [
+                TextNode(id_=str(row), text="", embedding=embedding.tolist())
+                for row, embedding in enumerate(
+                    embeddings[chunk : chunk + 5_000], start=chunk
+                )
+            ]
+        )
+    build_time = time.perf_counter() - start
+
+    latencies, hits = [], 0
+    for query, expected in zip(queries, truth):
+        start = time.perf_counter()
+        result = store.query(
+            VectorStoreQuery(query_embedding=query.tolist(), similarity_top_k=k)
+        )
+        latencies.append((time.perf_counter() - start) * 1000)
+        hits += len(expected.intersection(int(node_id) for node_id in result.ids))
+
+    metrics = {
+        "build_time": build_time,
+        "p50_ms": percentile(latencies, 50),
+        "p95_ms": percentile(latencies, 95),
+        "mean_ms": statistics.mean(latencies),
+        "recall": hits / (k * len(queries)),
+    }
+    if batch_query is not None:
+        start = time.perf_counter()
+        batch_query(queries.tolist(), k)
+        metrics["batch_qps"] = len(queries) / (time.perf_counter() - start)
+    return metrics
+
+
+def run(
+    sizes: List[int], dim: int, queries: int, k: int, backends: List[str]
+) -> List[Dict]:
+    """
+    Runs the benchmark.
+
+    Args:
+        sizes (List[int]): The corpus sizes.
+        dim (int): The dimension of the embeddings.
+        queries (int): The number of queries per corpus.
+        k (int): The number of nodes to retrieve.
+        backends (List[str]): Among "numpy", "numpy-float16", "numpy-int8" and "chroma".
+
+    Returns:
+        List[Dict]: The metrics of every backend and size.
+    """
+    results = []
+    for size in sizes:
+        embeddings, query_embeddings = make_corpus(size, dim, queries)
+        truth = exact_top_k(embeddings, query_embeddings, k)
+        for backend in backends:
+            if backend.startswith("numpy"):
+                quantization = backend.partition("-")[2] or None
+                store = NumpyVectorStore(quantization=quantization)
+                metrics = bench_store(
+                    store, embeddings, query_embeddings, truth, k, store.batch_query
+                )
+            else:
+                import chromadb
+                from llama_index.vector_stores.chroma import ChromaVectorStore
+
+                with tempfile.TemporaryDirectory() as persist_dir:
+                    client = chromadb.PersistentClient(persist_dir)
+                    collection = client.create_collection(
+                        "benchmark", metadata={"hnsw:space": "cosine"}
+                    )
+                    store = ChromaVectorStore(chroma_collection=collection)
+                    metrics = bench_store(store, embeddings, query_embeddings, truth, k)
+            results.append({"backend": backend, "size": size, **metrics})
+            print(json.dumps(results[-1]))
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", default="10000,100000,1000000")
+    parser.add_argument("--dim", type=int, default=384)
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument("--top-k", type=int, default=3)
+    parser.add_argument("--backends", default="numpy,numpy-float16,numpy-int8,chroma")
+    parser.add_argument("--output", help="Path to write the JSON results to")
+    args = parser.parse_args()
+
+    results = run(
+        [int(size) for size in args.sizes.split(",")],
+        args.dim,
+        args.queries,
+        args.top_k,
+        args.backends.split(","),
+    )
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
@@ -1,13 +1,26 @@
 import os
+from typing import Optional
 
 from llama_index.core import (
-    SimpleDirectoryReader,
     StorageContext,
     VectorStoreIndex,
     load_index_from_storage,
 )
 from llama_index.core.query_engine import BaseQueryEngine
 
+from utils.embeddings import EmbeddingCache, use_embedding_cache
+from utils.ingestion import get_parse_pool
+from utils.manifest import (
+    IndexManifest,
+    ManifestDiff,
+    list_data_files,
+    load_data_file,
+    sync_index,
+)
+from utils.mmap_store import MmapVectorStore
+from utils.query_cache import CachedQueryEngine, QueryCache
+from utils.tracing import Tracer, enable_tracing, trace_span
+
 
 class RAG:
     """
@@ -16,17 +29,35 @@ class RAG:
     Attributes:
         DATA_FOLDER_PATH (str): The path to the data folder
         PERSIST_DIR (str): The directory for persisting indexes.
+        storage_format (str): "mmap" to persist embeddings and nodes in memory-mapped binary files, "json" for the default JSON files.
+        vector_dtype (str): The dtype of the embeddings persisted in the "mmap" format, "float32" or "float16".
+        parse_workers (int): The number of processes parsing files, 0 to parse them in-process.
+        manifest (IndexManifest): The content hashes of the indexed files.
+        embedding_cache (EmbeddingCache): The persistent embedding cache shared by all days.
+        query_cache (QueryCache): The cache of query results, invalidated when the index changes.
+        tracer (Optional[Tracer]): The tracer recording the stages of every query, None when tracing is disabled.
         query_engine (BaseQueryEngine): The query engine for performing searches.
     """
 
     DATA_FOLDER_PATH: str
     PERSIST_DIR: str
+    storage_format: str
+    vector_dtype: str
+    parse_workers: int
+    manifest: IndexManifest
+    embedding_cache: EmbeddingCache
+    query_cache: QueryCache
+    tracer: Optional[Tracer]
     query_engine: BaseQueryEngine
 
     def __init__(
         self,
         data_folder_path: str = os.path.join(".", "day0", "data"),
         persist_dir: str = os.path.join(".", "day0", "storage"),
+        storage_format: str = "mmap",
+        vector_dtype: str = "float32",
+        parse_workers: int = 0,
+        trace_path: Optional[str] = None,
     ) -> None:
         """
         Initializes the RAG with specified parameters.
@@ -34,13 +65,28 @@ class RAG:
         Args:
             data_folder_path (str, optional): The path to the data folder. Defaults to "./day0/data".
             persist_dir (str, optional): The directory for persisting indexes. Defaults to "./day0/storage".
+            storage_format (str, optional): "mmap" or "json". Defaults to "mmap".
+            vector_dtype (str, optional): "float32" or "float16", for the "mmap" format. Defaults to "float32".
+            parse_workers (int, optional): The number of processes parsing files, 0 to parse them in-process. Defaults to 0.
+            trace_path (str, optional): The Chrome trace file recording the stages of every query. Defaults to None, no tracing.
         """
         # set base paths
         self.DATA_FOLDER_PATH = data_folder_path
         self.PERSIST_DIR = persist_dir
+        self.storage_format = storage_format
+        self.vector_dtype = vector_dtype
+        self.parse_workers = parse_workers
+        # Registered before the index is built, so that ingestion is traced too
+        self.tracer = enable_tracing(trace_path) if trace_path else None
+
+        self.manifest = IndexManifest(os.path.join(self.PERSIST_DIR, "manifest.json"))
+
+        # Embed through the shared, persistent embedding cache
+        self.embedding_cache = use_embedding_cache()
+        self.query_cache = QueryCache()
 
-        # Create/load indexes
-        if not os.path.exists(self.PERSIST_DIR):
+        # Create/load indexes, rebuilding those persisted without a manifest or in another format
+        if not self.manifest.exists or self.persisted_format() != self.storage_format:
             self.create_index()
         else:
             self.load_existing_index()
@@ -49,23 +95,82 @@ class RAG:
         """
         Creates a new index from the data and stores it.
         """
-        # Loading data
-        documents = SimpleDirectoryReader(self.DATA_FOLDER_PATH).load_data()
-
-        # creating index
-        index = VectorStoreIndex.from_documents(documents)
+        # creating index, from scratch
+        self.manifest.files = {}
+        index = VectorStoreIndex([], storage_context=self.create_storage_context())
+        self.refresh_index(index)
 
         # Storing index
         index.storage_context.persist(persist_dir=self.PERSIST_DIR)
-        self.query_engine = index.as_query_engine()
+        self.query_engine = CachedQueryEngine(index.as_query_engine(), self.query_cache)
 
     def load_existing_index(self):
         """
         Loads an existing index from storage.
         """
-        storage_context = StorageContext.from_defaults(persist_dir=self.PERSIST_DIR)
+        storage_context = self.create_storage_context(self.PERSIST_DIR)
         index = load_index_from_storage(storage_context)
-        self.query_engine = index.as_query_engine()
+        if self.refresh_index(index):
+            index.storage_context.persist(persist_dir=self.PERSIST_DIR)
+        self.query_engine = CachedQueryEngine(index.as_query_engine(), self.query_cache)
+
+    def create_storage_context(
+        self, persist_dir: Optional[str] = None
+    ) -> StorageContext:
+        """
+        Creates an empty storage context, or loads a persisted one, in the configured format.
+
+        Args:
+            persist_dir (str, optional): The directory to load the storage context from. Defaults to an empty one.
+
+        Returns:
+            StorageContext: The storage context.
+        """
+        if self.storage_format != "mmap":
+            return StorageContext.from_defaults(persist_dir=persist_dir)
+        if persist_dir is None:
+            vector_store = MmapVectorStore(dtype=self.vector_dtype)
+        else:
+            vector_store = MmapVectorStore.from_persist_dir(persist_dir)
+        return StorageContext.from_defaults(
+            persist_dir=persist_dir, vector_store=vector_store
+        )
+
+    def persisted_format(self) -> Optional[str]:
+        """
+        Tells the format of the persisted index.
+
+        Returns:
+            Optional[str]: "mmap", "json", or None if there is no persisted index.
+        """
+        path = os.path.join(self.PERSIST_DIR, "default__vector_store.json")
+        if not os.path.exists(path):
+            return None
+        return "mmap" if MmapVectorStore.is_persisted(path) else "json"
+
+    def refresh_index(self, index: VectorStoreIndex) -> ManifestDiff:
+        """
+        Re-indexes the files of the data folder added, changed or deleted since the last sync.
+
+        Args:
+            index (VectorStoreIndex): The index to refresh.
+
+        Returns:
+            ManifestDiff: The files that were re-indexed.
+        """
+        diff = sync_index(
+            index,
+            self.manifest,
+            list_data_files(self.DATA_FOLDER_PATH),
+            load_data_file,
+            executor=get_parse_pool(self.parse_workers) if self.parse_workers else None,
+        )
+        if diff:
+            print("Re-indexed", diff)
+            for report in diff.reports:
+                print(report)
+            self.query_cache.invalidate()
+        return diff
 
     def run(self, query):
         """
@@ -77,7 +182,8 @@ class RAG:
         Returns:
             QueryResult: The LLM response.
         """
-        return self.query_engine.query(query)
+        with trace_span("rag.run", query=query):
+            return self.query_engine.query(query)
 
 
 if __name__ == "__main__":
@@ -1,15 +1,24 @@
 import os
+from typing import Optional
 
-import chromadb
-from llama_index.core import (
-    Settings,
-    SimpleDirectoryReader,
-    StorageContext,
-    VectorStoreIndex,
-)
+from llama_index.core import Settings, VectorStoreIndex
 from llama_index.core.query_engine import BaseQueryEngine
 from llama_index.core.vector_stores.types import VectorStore
-from llama_index.vector_stores.chroma import ChromaVectorStore
+
+from utils.bm25 import BM25Index, as_hybrid_query_engine, open_bm25_index
+from utils.chroma_pool import get_chroma_collection, iter_collection_chunks
+from utils.embeddings import EmbeddingCache, use_embedding_cache
+from utils.ingestion import get_parse_pool
+from utils.manifest import (
+    IndexManifest,
+    ManifestDiff,
+    list_data_files,
+    load_data_file,
+    sync_index,
+)
+from utils.numpy_store import NumpyVectorStore, open_numpy_store
+from utils.query_cache import CachedQueryEngine, QueryCache
+from utils.tracing import Tracer, enable_tracing, trace_span
 
 # Global settings
 Settings.chunk_size = 1000
@@ -24,12 +33,30 @@ class RAG:
         DATA_FOLDER_PATH (str): The path to the data folder.
         PERSIST_DIR (str): The folder for persisting Chroma db.
         CHROMA_COLLECTION_NAME (str): The name of the Chroma collection.
+        vector_backend (str): "chroma", or "numpy" for an in-process `NumpyVectorStore`.
+        quantization (Optional[str]): The quantization of a new "numpy" store, None, "float16" or "int8".
+        manifest (IndexManifest): The content hashes of the indexed files.
+        hybrid_search (bool): Whether to fuse BM25 and vector retrieval.
+        bm25_index (Optional[BM25Index]): The BM25 index of the chunks, when `hybrid_search`.
+        parse_workers (int): The number of processes parsing files, 0 to parse them in-process.
+        embedding_cache (EmbeddingCache): The persistent embedding cache shared by all days.
+        query_cache (QueryCache): The cache of query results, invalidated when the index changes.
+        tracer (Optional[Tracer]): The tracer recording the stages of every query, None when tracing is disabled.
         query_engine (BaseQueryEngine): The query engine for performing searches.
     """
 
     DATA_FOLDER_PATH: str
     PERSIST_DIR: str
     CHROMA_COLLECTION_NAME: str
+    vector_backend: str
+    quantization: Optional[str]
+    manifest: IndexManifest
+    hybrid_search: bool
+    bm25_index: Optional[BM25Index]
+    parse_workers: int
+    embedding_cache: EmbeddingCache
+    query_cache: QueryCache
+    tracer: Optional[Tracer]
     query_engine: BaseQueryEngine
 
     def __init__(
@@ -39,6 +66,11 @@ class RAG:
         chroma_collection_name: str = "collection",
         similarity_top_k: int = 3,
         streaming: bool = True,
+        vector_backend: str = "chroma",
+        quantization: Optional[str] = None,
+        hybrid_search: bool = True,
+        parse_workers: int = 0,
+        trace_path: Optional[str] = None,
     ) -> None:
         """
         Initializes the RAG with specified parameters.
@@ -49,22 +81,63 @@ class RAG:
             chroma_collection_name (str, optional): The name of the Chroma collection. Defaults to "collection".
             similarity_top_k (int, optional): The number of top similar nodes to retrieve. Defaults to 3.
             streaming (bool, optional): Whether to stream the LLM response or not. Defaults to True.
+            vector_backend (str, optional): "chroma" or "numpy". Defaults to "chroma".
+            quantization (str, optional): The quantization of a new "numpy" store, "float16" or "int8". Defaults to None.
+            hybrid_search (bool, optional): Whether to fuse BM25 and vector retrieval. Defaults to True.
+            parse_workers (int, optional): The number of processes parsing files, 0 to parse them in-process. Defaults to 0.
+            trace_path (str, optional): The Chrome trace file recording the stages of every query. Defaults to None, no tracing.
         """
         # set base paths
         self.DATA_FOLDER_PATH = data_folder_path
         self.PERSIST_DIR = persist_dir
         # Set Chroma collection name
         self.CHROMA_COLLECTION_NAME = chroma_collection_name
+        self.vector_backend = vector_backend
+        self.quantization = quantization
+        self.hybrid_search = hybrid_search
+        self.bm25_index = None
+        self.parse_workers = parse_workers
+        # Registered before the index is built, so that ingestion is traced too
+        self.tracer = enable_tracing(trace_path) if trace_path else None
 
-        # Create/load indices
-        vector_store = self.init_chroma()
-        if not os.path.exists(self.PERSIST_DIR):
+        # each backend keeps its own manifest
+        suffix = ".numpy" if self.vector_backend == "numpy" else ""
+        self.manifest = IndexManifest(
+            os.path.join(
+                self.PERSIST_DIR,
+                f"{self.CHROMA_COLLECTION_NAME}{suffix}.manifest.json",
+            )
+        )
+
+        # Embed through the shared, persistent embedding cache
+        self.embedding_cache = use_embedding_cache()
+        self.query_cache = QueryCache()
+
+        # Create/load indices, rebuilding those persisted without a manifest
+        if self.vector_backend == "numpy":
+            vector_store = self.init_numpy_store()
+        else:
+            vector_store = self.init_chroma()
+        if not self.manifest.exists:
             index = self.create_index(vector_store)
         else:
             index = self.load_existing_index(vector_store)
 
-        self.query_engine = index.as_query_engine(
-            similarity_top_k=similarity_top_k,
+        if self.hybrid_search:
+            query_engine = as_hybrid_query_engine(
+                index,
+                self.bm25_index,
+                similarity_top_k=similarity_top_k,
+                streaming=streaming,
+            )
+        else:
+            query_engine = index.as_query_engine(
+                similarity_top_k=similarity_top_k,
+                streaming=streaming,
+            )
+        self.query_engine = CachedQueryEngine(
+            query_engine,
+            self.query_cache,
             streaming=streaming,
         )
 
@@ -75,13 +148,35 @@ class RAG:
         Returns:
             ChromaVectorStore: The initialized Chroma Vector Store.
         """
-        chroma_client = chromadb.PersistentClient(self.PERSIST_DIR)
-        chroma_collection = chroma_client.get_or_create_collection(
-            self.CHROMA_COLLECTION_NAME
+        from llama_index.vector_stores.chroma import ChromaVectorStore
+
+        chroma_collection = get_chroma_collection(
+            self.PERSIST_DIR, self.CHROMA_COLLECTION_NAME
         )
         vector_store = ChromaVectorStore(chroma_collection=chroma_collection)
         return vector_store
 
+    @property
+    def numpy_store_path(self) -> str:
+        """The path of the "numpy" store's JSON file."""
+        return os.path.join(
+            self.PERSIST_DIR, f"{self.CHROMA_COLLECTION_NAME}.numpy.json"
+        )
+
+    @property
+    def bm25_path(self) -> str:
+        """The path of the BM25 index's JSON file, next to the manifest."""
+        return self.manifest.path.replace(".manifest.json", ".bm25.json")
+
+    def init_numpy_store(self):
+        """
+        Loads the persisted NumPy Vector Store, or creates an empty one, and returns it.
+
+        Returns:
+            NumpyVectorStore: The NumPy Vector Store.
+        """
+        return open_numpy_store(self.numpy_store_path, self.manifest, self.quantization)
+
     def create_index(self, vector_store: VectorStore):
         """
         Creates a new index using the provided vector store and returns it.
@@ -92,14 +187,15 @@ class RAG:
         Returns:
             VectorStoreIndex: The created index.
         """
-        storage_context = StorageContext.from_defaults(vector_store=vector_store)
-        # Loading data
-        documents = SimpleDirectoryReader(self.DATA_FOLDER_PATH).load_data()
+        # Rebuilding a missing manifest from the collection, so that its embeddings are reused
+        if isinstance(vector_store, NumpyVectorStore):
+            vector_store.clear()
+        elif vector_store.client.count():
+            self.manifest.restore(iter_collection_chunks(vector_store.client))
 
         # Creating index
-        index = VectorStoreIndex.from_documents(
-            documents, storage_context=storage_context
-        )
+        index = VectorStoreIndex.from_vector_store(vector_store=vector_store)
+        self.refresh_index(index)
         return index
 
     def load_existing_index(self, vector_store: VectorStore):
@@ -113,8 +209,39 @@ class RAG:
             VectorStoreIndex: The loaded index.
         """
         index = VectorStoreIndex.from_vector_store(vector_store=vector_store)
+        self.refresh_index(index)
         return index
 
+    def refresh_index(self, index: VectorStoreIndex) -> ManifestDiff:
+        """
+        Re-indexes the files of the data folder added, changed or deleted since the last sync.
+
+        Args:
+            index (VectorStoreIndex): The index to refresh.
+
+        Returns:
+            ManifestDiff: The files that were re-indexed.
+        """
+        diff = sync_index(
+            index,
+            self.manifest,
+            list_data_files(self.DATA_FOLDER_PATH),
+            load_data_file,
+            executor=get_parse_pool(self.parse_workers) if self.parse_workers else None,
+        )
+        if diff:
+            print("Re-indexed", diff)
+            for report in diff.reports:
+                print(report)
+            self.query_cache.invalidate()
+        if isinstance(index.vector_store, NumpyVectorStore) and (
+            diff or not NumpyVectorStore.is_persisted(self.numpy_store_path)
+        ):
+            index.vector_store.persist(self.numpy_store_path)
+        if self.hybrid_search:
+            self.bm25_index = open_bm25_index(self.bm25_path, index, self.manifest)
+        return diff
+
     def run(self, query):
         """
         Executes a query using the query engine and returns the results.
@@ -125,5 +252,5 @@ class RAG:
         Returns:
             QueryResult: The response from the LLM
         """
-        return self.query_engine.query(query)
-
+        with trace_span("rag.run", query=query):
+            return self.query_engine.query(query)
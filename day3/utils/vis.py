@@ -1,6 +1,10 @@
+import os
 from typing import List
 
-import matplotlib.pyplot as plt
+from utils.rendering import get_renderer
+
+# rendered in the background, the tools return the path of the file at once
+PLOTS_DIR = os.path.join(".", "day3", "plots")
 
 
 def plot_progress_over_years(countries: List[str], areas: List[float]):
@@ -11,17 +15,10 @@ def plot_progress_over_years(countries: List[str], areas: List[float]):
         years (List[str]): List of years.
         progress (List[float]): List of progress values corresponding to each year.
     """
-    plt.figure(figsize=(8, 6))
-    plt.plot(countries, areas, marker="o", color="b", linestyle="-")
-    plt.title("Progress Over Years")
-    plt.xlabel("Year")
-    plt.ylabel("Progress")
-    plt.grid(True)
-    plt.xticks(rotation=45)
-    plt.tight_layout()
-    plt.show()
-
-    return "Plotting..."
+    plot = get_renderer(PLOTS_DIR).plot(
+        countries, areas, title="Progress Over Years", xlabel="Year", ylabel="Progress"
+    )
+    return f"Plotting to {plot.path}"
 
 
 def plot_progress_over_years_for_one_countrie(years: List[str], areas: List[float]):
@@ -32,17 +29,10 @@ def plot_progress_over_years_for_one_countrie(years: List[str], areas: List[floa
         years (List[str]): List of years.
         progress (List[float]): List of progress values corresponding to each year.
     """
-    plt.figure(figsize=(8, 6))
-    plt.plot(years, areas, marker="o", color="b", linestyle="-")
-    plt.title("Progress Over Years")
-    plt.xlabel("Year")
-    plt.ylabel("Progress")
-    plt.grid(True)
-    plt.xticks(rotation=45)
-    plt.tight_layout()
-    plt.show()
-
-    return "Plotting..."
+    plot = get_renderer(PLOTS_DIR).plot(
+        years, areas, title="Progress Over Years", xlabel="Year", ylabel="Progress"
+    )
+    return f"Plotting to {plot.path}"
 
 
 def plot_house_pricing_data(prices: List[float], areas: List[str]):
@@ -53,21 +43,14 @@ def plot_house_pricing_data(prices: List[float], areas: List[str]):
         areas (List[str]): List of areas.
         prices (List[float]): List of prices values corresponding to each area.
     """
-    plt.figure(figsize=(8, 6))
-    plt.plot(areas, prices, marker="o", color="b", linestyle="-")
-    plt.title("Progress Over Prices")
-    plt.xlabel("Area")
-    plt.ylabel("Price")
-    plt.grid(True)
-    plt.xticks(rotation=45)
-    plt.tight_layout()
-    plt.show()
-
-    return "Plotting..."
+    plot = get_renderer(PLOTS_DIR).plot(
+        areas, prices, title="Progress Over Prices", xlabel="Area", ylabel="Price"
+    )
+    return f"Plotting to {plot.path}"
 
 
 if __name__ == "__main__":
     years = ["2019", "2020", "2021", "2022"]
     progress = [0.2, 0.4, 0.6, 0.8]
 
-    plot_progress_over_years(years, progress)
+    print(plot_progress_over_years(years, progress))
@@ -1,31 +1,49 @@
 import os
-from pathlib import Path
-from typing import Dict, List
+from typing import Dict, Iterable, List, Optional, Tuple
 
-import chromadb
 import nest_asyncio
-import pandas
-from llama_index.agent.openai import OpenAIAgent
 from llama_index.core import (
+    Document,
     Settings,
-    SimpleDirectoryReader,
-    StorageContext,
     VectorStoreIndex,
 )
+from llama_index.core.base.embeddings.base import BaseEmbedding
 from llama_index.core.query_engine import (
     BaseQueryEngine,
-    SubQuestionQueryEngine,
 )
-from llama_index.core.tools import FunctionTool, QueryEngineTool, ToolMetadata
-from llama_index.core.vector_stores.types import VectorStore
-from llama_index.readers.file import UnstructuredReader
-from llama_index.vector_stores.chroma import ChromaVectorStore
-
-from day3.utils.stdout import save_note
-from day4.utils.vis import (
-    apply_python_script_on_df,
+from llama_index.core.tools import BaseTool, FunctionTool, QueryEngineTool, ToolMetadata
+from llama_index.core.vector_stores.types import (
+    FilterOperator,
+    MetadataFilter,
+    MetadataFilters,
+    VectorStore,
 )
 
+from day3.utils.stdout import save_note, search_notes
+from utils.bm25 import BM25Index, as_hybrid_query_engine, open_bm25_index
+from utils.chroma_pool import (
+    get_chroma_client,
+    get_chroma_collection,
+    iter_collection_chunks,
+)
+from utils.embeddings import EmbeddingCache, use_embedding_cache
+from utils.executor import ScriptExecutor
+from utils.index_registry import IndexRegistry, LazyQueryEngine
+from utils.ingestion import (
+    FilingLoader,
+    build_year_indices,
+    get_parse_pool,
+    load_filing,
+)
+from utils.manifest import IndexManifest, sync_index
+from utils.memory import SummaryMemory
+from utils.numpy_store import NumpyVectorStore, open_numpy_store
+from utils.query_cache import CachedQueryEngine, QueryCache
+from utils.server import serve_sessions
+from utils.streaming import TurnMetrics, TurnStream
+from utils.sub_question import ParallelSubQuestionQueryEngine
+from utils.tracing import Tracer, enable_tracing, trace_span
+
 nest_asyncio.apply()
 
 # Global settings
@@ -40,6 +58,13 @@ class Chatbot:
     PERSIST_DIR: str
     CHROMA_COLLECTION_NAME: str
     query_engine: BaseQueryEngine
+    embedding_cache: EmbeddingCache
+    query_caches: Dict[str, QueryCache]
+    index_registry: IndexRegistry
+    bm25_indices: Dict[str, BM25Index]
+    manifests: Dict[str, IndexManifest]
+    tracer: Optional[Tracer]
+    turn_metrics: List[TurnMetrics]
     years: List[str] = ["2022", "2021", "2020", "2019"]
     doc_set: Dict = {}
 
@@ -50,6 +75,23 @@ class Chatbot:
         chroma_collection_name: str = "collection",
         similarity_top_k: int = 3,
         streaming: bool = True,
+        max_concurrency: int = 4,
+        sub_question_timeout: Optional[float] = 60.0,
+        index_memory_budget: Optional[int] = None,
+        index_idle_ttl: Optional[float] = None,
+        vector_backend: str = "chroma",
+        quantization: Optional[str] = None,
+        hybrid_search: bool = True,
+        partitioned: bool = False,
+        streaming_ingestion: bool = True,
+        parse_workers: int = 0,
+        trace_path: Optional[str] = None,
+        memory_token_limit: Optional[int] = 3000,
+        memory_retrieve_top_k: int = 2,
+        script_workers: int = 2,
+        script_timeout: Optional[float] = 30.0,
+        script_memory_limit: Optional[int] = 1 << 30,
+        script_cache_bytes: int = 64 << 20,
     ) -> None:
         """
         Initialize the chatbot.
@@ -60,6 +102,25 @@ class Chatbot:
             chroma_collection_name (str): Name of the Chroma collection.
             similarity_top_k (int): Number of top similar documents to retrieve.
             streaming (bool): Whether to enable streaming mode for document retrieval.
+            max_concurrency (int): Maximum number of sub-questions answered concurrently.
+            sub_question_timeout (Optional[float]): Timeout of a sub-question in seconds, None to disable it.
+            index_memory_budget (Optional[int]): Memory the loaded year indices may hold in bytes, None for no limit.
+            index_idle_ttl (Optional[float]): Idle time after which a year index is unloaded in seconds, None to keep it.
+            vector_backend (str): "chroma", or "numpy" for in-process `NumpyVectorStore`s.
+            quantization (Optional[str]): The quantization of new "numpy" stores, None, "float16" or "int8".
+            hybrid_search (bool): Whether to fuse BM25 and vector retrieval in the year tools.
+            partitioned (bool): Whether to index all the years in a single collection, partitioned by year metadata.
+            streaming_ingestion (bool): Whether to parse filings incrementally in bounded sections,
+                rather than as a single document with `UnstructuredReader`.
+            parse_workers (int): Number of processes parsing filings across years, 0 to parse them in-process.
+            trace_path (Optional[str]): Chrome trace file recording the stages of every turn, None to disable tracing.
+            memory_token_limit (Optional[int]): Token budget of the chat history sent with every turn,
+                older turns being summarized, None to send the whole history.
+            memory_retrieve_top_k (int): Number of summarized turns recalled verbatim when similar to the user message.
+            script_workers (int): Number of worker processes running the agent's scripts on the housing data.
+            script_timeout (Optional[float]): Wall time a script may run in seconds, None for no limit.
+            script_memory_limit (Optional[int]): Memory a script may allocate in bytes, None for no limit.
+            script_cache_bytes (int): Memory the cached script results may hold in bytes.
         """
         # set base paths
         self.DATA_FOLDER_PATH = data_folder_path
@@ -67,18 +128,77 @@ class Chatbot:
         # Set Chroma collection name
         self.CHROMA_COLLECTION_NAME = chroma_collection_name
 
-        # Create/load indices
-        index_set = {}
-        if not os.path.exists(self.PERSIST_DIR):
-            index_set = self.init_chroma()
-        else:
-            index_set = self.load_existing_index()
+        self.similarity_top_k = similarity_top_k
+        self.streaming = streaming
+        self.max_concurrency = max_concurrency
+        self.sub_question_timeout = sub_question_timeout
+        self.index_memory_budget = index_memory_budget
+        self.index_idle_ttl = index_idle_ttl
+        self.vector_backend = vector_backend
+        self.quantization = quantization
+        self.hybrid_search = hybrid_search
+        self.partitioned = partitioned
+        self.streaming_ingestion = streaming_ingestion
+        self.parse_workers = parse_workers
+        self.memory_token_limit = memory_token_limit
+        self.memory_retrieve_top_k = memory_retrieve_top_k
+        self.script_workers = script_workers
+        self.script_timeout = script_timeout
+        self.script_memory_limit = script_memory_limit
+        self.script_executor: Optional[ScriptExecutor] = None
+        self.script_cache_bytes = script_cache_bytes
+        self.bm25_indices = {}
+        self.manifests = {}
+        # Registered before any index is built, so that ingestion is traced too
+        self.tracer = enable_tracing(trace_path) if trace_path else None
+        self.turn_metrics = []
+
+        # One result cache per year tool, invalidated when the year is re-indexed
+        self.query_caches = {year: QueryCache() for year in self.years}
+
+        # Indices, tools and agent are built on first use
+        self._tools: Optional[List[BaseTool]] = None
+        self._agent = None
+
+    @property
+    def tools(self) -> List[BaseTool]:
+        """The agent tools, built on first use."""
+        if self._tools is None:
+            self._tools = self.build_tools()
+        return self._tools
+
+    @property
+    def agent(self):
+        """The agent of the terminal loop, built on first use."""
+        if self._agent is None:
+            self._agent = self.create_agent()
+        return self._agent
+
+    def build_tools(self) -> List[BaseTool]:
+        """
+        Load the indices and build the agent tools.
+
+        Returns:
+            List[BaseTool]: The agent tools.
+        """
+        from utils.dataframe import FrameSource
+        from utils.frame_cache import ResultCache
+        from utils.frame_index import FrameIndex, query_frame_index
+
+        from day4.utils.vis import apply_python_script_on_df
+
+        self.init_indices()
 
         individual_query_ingine_tools = [
             QueryEngineTool(
-                query_engine=index_set[year].as_query_engine(
-                    similarity_top_k=similarity_top_k,
-                    streaming=streaming,
+                query_engine=CachedQueryEngine(
+                    LazyQueryEngine(
+                        lambda year=year: self.year_query_engine(year),
+                        self.index_registry,
+                        self.CHROMA_COLLECTION_NAME if self.partitioned else year,
+                    ),
+                    self.query_caches[year],
+                    streaming=self.streaming,
                 ),
                 metadata=ToolMetadata(
                     name=f"vector_index_{year}",
@@ -88,8 +208,10 @@ class Chatbot:
             for year in self.years
         ]
 
-        query_engine = SubQuestionQueryEngine.from_defaults(
-            query_engine_tools=individual_query_ingine_tools
+        query_engine = ParallelSubQuestionQueryEngine.from_defaults(
+            query_engine_tools=individual_query_ingine_tools,
+            max_concurrency=self.max_concurrency,
+            sub_question_timeout=self.sub_question_timeout,
         )
 
         query_engine_tool = QueryEngineTool(
@@ -101,102 +223,505 @@ class Chatbot:
         )
 
         # Data source: https://www.kaggle.com/datasets/saurabhbadole/housing-price-data
-        df = pandas.read_csv("./day3/data/Housing_Price_Data.csv")
+        self.housing = FrameSource("./day3/data/Housing_Price_Data.csv")
+        print(self.housing.report)
+        df = self.housing.df
+        # Results of the scripts, keyed by the version of the housing data
+        self.script_cache = ResultCache(
+            max_bytes=self.script_cache_bytes, source=self.housing
+        )
+
+        # Aggregates and indexes of the housing data, materialized once
+        housing_index = FrameIndex(df, self.housing.fingerprint)
+        print(f"Housing data indexed in {housing_index.build_time:.2f}s")
+        housing_summary_tool = FunctionTool.from_defaults(
+            fn=query_frame_index(self.housing, housing_index),
+            name="housing_summary",
+            description=(
+                "useful for when you want counts, sums, means, minimums or maximums of the housing price data,"
+                " optionally grouped by up to two of the columns"
+                f" {', '.join(housing_index.group_columns)}"
+                " and over the rows matching conditions such as 'furnishingstatus=furnished, bedrooms>=3'."
+                " It answers from precomputed aggregates in microseconds, prefer it to running code for such questions."
+                f" The numeric columns are {', '.join(housing_index.measures)}."
+            ),
+        )
+        # Scripts run in pre-warmed worker processes, which map the cache built above
+        self.script_executor = ScriptExecutor(
+            self.housing.csv_path,
+            workers=self.script_workers,
+            timeout=self.script_timeout,
+            memory_limit=self.script_memory_limit,
+            figure_dir=os.path.join(".", "day4", "figures"),
+        )
 
         tacking_note_tool = FunctionTool.from_defaults(
             fn=save_note,
             description=("Useful for when you want to save notes in the disk"),
         )
 
+        searching_notes_tool = FunctionTool.from_defaults(
+            fn=search_notes,
+            description=(
+                "Useful for when you want to find the notes saved earlier about a topic"
+            ),
+        )
+
         apply_python_script_on_df_tool = FunctionTool.from_defaults(
-            fn=apply_python_script_on_df(df),
+            fn=apply_python_script_on_df(
+                self.script_executor, self.housing, self.script_cache
+            ),
             description=(
                 "useful for when you wnat to answer queries that require analyzing, and visualizing housing price data."
                 " For the visualization use mathplotlib library."
                 " You should provide the python script you want to execute on df to respond to the question."
                 " df is provided just apply the script on it."
+                " Print what you need, or end the script with an expression to get its value;"
+                " figures are saved as PNG files."
                 " This is the db columns:"
                 f"{df.columns}"
             ),
         )
 
-        tools = individual_query_ingine_tools + [
-            query_engine_tool,
-            tacking_note_tool,
-            apply_python_script_on_df_tool,
-        ]
+        return (
+            individual_query_ingine_tools
+            + self.multi_year_tools()
+            + [
+                query_engine_tool,
+                tacking_note_tool,
+                searching_notes_tool,
+                apply_python_script_on_df_tool,
+                housing_summary_tool,
+            ]
+        )
+
+    def init_indices(self) -> IndexRegistry:
+        """
+        Create the registry of the indices, building them if nothing is persisted yet.
 
-        self.agent = OpenAIAgent.from_tools(tools, verbose=True)  # type: ignore
+        Persisted indices are loaded on the first query about them.
+
+        Returns:
+            IndexRegistry: The registry, keyed by year, or by collection name in partitioned mode.
+        """
+        # Embed through the shared, persistent embedding cache
+        self.embedding_cache = use_embedding_cache()
+
+        # Create/load indices, each year is loaded on the first query about it
+        self.index_registry = IndexRegistry(
+            self.build_partitioned_index if self.partitioned else self.build_year_index,
+            memory_budget=self.index_memory_budget,
+            idle_ttl=self.index_idle_ttl,
+        )
+        if not os.path.exists(self.PERSIST_DIR):
+            for year, index in self.init_chroma().items():
+                self.index_registry.put(year, index)
+        else:
+            self.load_existing_index()
+        return self.index_registry
 
     def init_chroma(self):
         """
         Initialize Chroma indices for each year.
 
+        In partitioned mode, the single collection of all the years is initialized instead.
+
         Returns:
-            Dict[str, VectorStoreIndex]: A dictionary mapping years to their respective VectorStoreIndex objects.
+            Dict[str, VectorStoreIndex]: A dictionary mapping years, or the collection name in partitioned mode,
+                to their respective VectorStoreIndex objects.
         """
-        loader = UnstructuredReader()
-        all_docs = []
-        index_set = {}
-        for year in self.years:
-            year_docs = loader.load_data(
-                file=Path(f"./day2/data/UBER/UBER_{year}.html"), split_documents=False
+        if self.vector_backend == "chroma":
+            self.chroma_client = get_chroma_client(self.PERSIST_DIR)
+        if self.partitioned:
+            index_set, reports = build_year_indices(
+                [self.CHROMA_COLLECTION_NAME], self.build_partitioned_index
             )
-            # insert year metadata into each year
-            for doc in year_docs:
-                doc.metadata = {"year": year}
-            self.doc_set[year] = year_docs
+        else:
+            index_set, reports = build_year_indices(self.years, self.build_year_index)
+        for report in reports:
+            print(report)
+
+        return index_set
 
-            chroma_client = chromadb.PersistentClient(f"{self.PERSIST_DIR}")
-            chroma_collection = chroma_client.get_or_create_collection(
-                f"{self.CHROMA_COLLECTION_NAME}-{year}"
+    def build_year_index(self, year: str, embed_model: Optional[BaseEmbedding] = None):
+        """
+        Index the filing of a year into the year's own collection.
+
+        Only the chunks of the filing that changed since the last sync are re-embedded.
+
+        Args:
+            year (str): The year of the filing.
+            embed_model (BaseEmbedding, optional): The embedding model to use. Defaults to `Settings.embed_model`.
+
+        Returns:
+            VectorStoreIndex: The year's VectorStoreIndex object.
+        """
+        return self.sync_collection(
+            f"{self.CHROMA_COLLECTION_NAME}-{year}", [year], embed_model=embed_model
+        )
+
+    def build_partitioned_index(
+        self, collection_name: str, embed_model: Optional[BaseEmbedding] = None
+    ):
+        """
+        Index the filings of all the years into a single collection, tagged with their year.
+
+        A year added to `years` is appended to the collection, and only its chunks are embedded.
+
+        Args:
+            collection_name (str): The name of the collection.
+            embed_model (BaseEmbedding, optional): The embedding model to use. Defaults to `Settings.embed_model`.
+
+        Returns:
+            VectorStoreIndex: The VectorStoreIndex object of all the years.
+        """
+        return self.sync_collection(
+            collection_name, self.years, embed_model=embed_model
+        )
+
+    def filing_path(self, year: str) -> str:
+        """
+        Get the path of the filing of a year.
+
+        Args:
+            year (str): The year of the filing.
+
+        Returns:
+            str: The path of the filing.
+        """
+        return os.path.join(self.DATA_FOLDER_PATH, "UBER", f"UBER_{year}.html")
+
+    def sync_collection(
+        self,
+        collection_name: str,
+        years: List[str],
+        embed_model: Optional[BaseEmbedding] = None,
+    ):
+        """
+        Bring a collection in line with the filings of the given years.
+
+        Only the chunks of the filings that changed since the last sync are re-embedded.
+
+        Args:
+            collection_name (str): The name of the collection.
+            years (List[str]): The years of the filings.
+            embed_model (BaseEmbedding, optional): The embedding model to use. Defaults to `Settings.embed_model`.
+
+        Returns:
+            VectorStoreIndex: The collection's VectorStoreIndex object.
+        """
+        vector_store, manifest = self.open_vector_store(collection_name)
+        filings = {self.filing_path(year): year for year in years}
+
+        if self.parse_workers:
+            # workers parse with `load_filing`, as the chatbot cannot be sent to them
+            load = FilingLoader(filings, streaming=self.streaming_ingestion)
+            executor = get_parse_pool(self.parse_workers)
+        else:
+            load = lambda path: self.load_year_documents(filings[path], path)
+            executor = None
+
+        index = self.create_index(vector_store, embed_model=embed_model)
+        diff = sync_index(index, manifest, list(filings), load, executor=executor)
+        if diff:
+            print(f"[{', '.join(years)}] Re-indexed", diff)
+            for report in diff.reports:
+                print(report)
+            # the caches of removed years too, should they be queried again
+            stale = diff.added + diff.changed + diff.deleted
+            for year, cache in self.query_caches.items():
+                if self.filing_path(year) in stale:
+                    cache.invalidate()
+        if isinstance(vector_store, NumpyVectorStore):
+            store_path = self.numpy_store_path(collection_name)
+            if diff or not NumpyVectorStore.is_persisted(store_path):
+                vector_store.persist(store_path)
+        self.manifests[collection_name] = manifest
+        if self.hybrid_search:
+            self.bm25_indices[collection_name] = open_bm25_index(
+                manifest.path.replace(".manifest.json", ".bm25.json"), index, manifest
             )
-            vector_store = ChromaVectorStore(chroma_collection=chroma_collection)
-            index = self.create_index(vector_store)
-            index_set[year] = index
+        return index
+
+    def numpy_store_path(self, collection_name: str) -> str:
+        """
+        Get the path of the JSON file of a "numpy" collection.
 
-        all_docs.extend(year_docs)
+        Args:
+            collection_name (str): The name of the collection.
 
-        return index_set
+        Returns:
+            str: The path of the file.
+        """
+        return os.path.join(self.PERSIST_DIR, f"{collection_name}.numpy.json")
 
-    def create_index(self, vector_store: VectorStore):
+    def open_vector_store(
+        self, collection_name: str
+    ) -> Tuple[VectorStore, IndexManifest]:
+        """
+        Open a collection of the configured vector backend, along with its manifest.
+
+        Args:
+            collection_name (str): The name of the collection.
+
+        Returns:
+            Tuple[VectorStore, IndexManifest]: The vector store and its manifest.
+        """
+        if self.vector_backend == "numpy":
+            manifest = IndexManifest(
+                os.path.join(self.PERSIST_DIR, f"{collection_name}.numpy.manifest.json")
+            )
+            vector_store = open_numpy_store(
+                self.numpy_store_path(collection_name), manifest, self.quantization
+            )
+            return vector_store, manifest
+
+        from llama_index.vector_stores.chroma import ChromaVectorStore
+
+        chroma_collection = get_chroma_collection(self.PERSIST_DIR, collection_name)
+        vector_store = ChromaVectorStore(chroma_collection=chroma_collection)
+        manifest = IndexManifest(
+            os.path.join(self.PERSIST_DIR, f"{collection_name}.manifest.json")
+        )
+        # Rebuilding a missing manifest from the collection, so that its embeddings are reused
+        if not manifest.exists and chroma_collection.count():
+            manifest.restore(iter_collection_chunks(chroma_collection))
+        return vector_store, manifest
+
+    def load_year_documents(self, year: str, path: str) -> Iterable[Document]:
+        """
+        Parse the filing of a year.
+
+        With streaming ingestion, the filing is parsed lazily into sections of bounded size,
+        which are not kept in `doc_set`.
+
+        Args:
+            year (str): The year of the filing.
+            path (str): The path of the filing.
+
+        Returns:
+            Iterable[Document]: The documents of the filing, tagged with their year.
+        """
+        year_docs = load_filing(
+            path, {"year": year}, streaming=self.streaming_ingestion
+        )
+        if not self.streaming_ingestion:
+            self.doc_set[year] = year_docs
+        return year_docs
+
+    def create_index(
+        self, vector_store: VectorStore, embed_model: Optional[BaseEmbedding] = None
+    ):
         """
         Create a VectorStoreIndex.
 
         Args:
             vector_store (VectorStore): The VectorStore object to create the index from.
+            embed_model (BaseEmbedding, optional): The embedding model to use. Defaults to `Settings.embed_model`.
 
         Returns:
             VectorStoreIndex: The created VectorStoreIndex object.
         """
-        storage_context = StorageContext.from_defaults(vector_store=vector_store)
-        # Loading data
-        documents = SimpleDirectoryReader(self.DATA_FOLDER_PATH).load_data()
-
-        # Creating index
-        index = VectorStoreIndex.from_documents(
-            documents, storage_context=storage_context
+        index = VectorStoreIndex.from_vector_store(
+            vector_store=vector_store, embed_model=embed_model
         )
         return index
 
     def load_existing_index(self):
         """
-        Load existing Chroma indices.
+        Open the existing Chroma indices.
+
+        The index of a year is loaded, and re-indexed if its filing changed since it was built,
+        on the first query about the year.
+        """
+        if self.vector_backend == "chroma":
+            self.chroma_client = get_chroma_client(self.PERSIST_DIR)
+
+    def year_query_engine(self, year: str) -> BaseQueryEngine:
+        """
+        Create a query engine over the index of a year, loading the index if needed.
+
+        In partitioned mode, the engine is a view of the single collection filtered on the year.
+
+        Args:
+            year (str): The year of the filing.
 
         Returns:
-            Dict[str, VectorStoreIndex]: A dictionary mapping years to their respective VectorStoreIndex objects.
+            BaseQueryEngine: The query engine.
         """
-        index_set = {}
-        for year in self.years:
-            chroma_client = chromadb.PersistentClient(f"{self.PERSIST_DIR}")
-            chroma_collection = chroma_client.get_or_create_collection(
-                f"{self.CHROMA_COLLECTION_NAME}-{year}"
+        if self.partitioned:
+            return self.partition_query_engine([year])
+        index = self.index_registry.get(year)
+        if self.hybrid_search:
+            return as_hybrid_query_engine(
+                index,
+                self.bm25_indices[f"{self.CHROMA_COLLECTION_NAME}-{year}"],
+                similarity_top_k=self.similarity_top_k,
+                streaming=self.streaming,
             )
-            vector_store = ChromaVectorStore(chroma_collection=chroma_collection)
-            index = VectorStoreIndex.from_vector_store(vector_store=vector_store)
-            index_set[year] = index
+        return index.as_query_engine(
+            similarity_top_k=self.similarity_top_k,
+            streaming=self.streaming,
+        )
 
-        return index_set
+    def partition_query_engine(
+        self, years: List[str], streaming: Optional[bool] = None
+    ) -> BaseQueryEngine:
+        """
+        Create a query engine over the partitions of some years in the single collection.
+
+        The year filter is pushed down to the vector store, so that the years are searched at once.
+
+        Args:
+            years (List[str]): The years to search.
+            streaming (Optional[bool]): Whether to stream the response. Defaults to `self.streaming`.
+
+        Returns:
+            BaseQueryEngine: The query engine.
+        """
+        collection_name = self.CHROMA_COLLECTION_NAME
+        index = self.index_registry.get(collection_name)
+        filters = MetadataFilters(
+            filters=[
+                MetadataFilter(key="year", value=years, operator=FilterOperator.IN)
+            ]
+        )
+        # more chunks for more years, as they compete for the top k
+        similarity_top_k = self.similarity_top_k * len(years)
+        streaming = self.streaming if streaming is None else streaming
+        if self.hybrid_search:
+            manifest = self.manifests[collection_name]
+            node_ids = {
+                node_id
+                for year in years
+                for node_id in manifest.files.get(self.filing_path(year), {}).get(
+                    "chunks", []
+                )
+            }
+            return as_hybrid_query_engine(
+                index,
+                self.bm25_indices[collection_name],
+                similarity_top_k=similarity_top_k,
+                filters=filters,
+                node_ids=node_ids,
+                streaming=streaming,
+            )
+        return index.as_query_engine(
+            similarity_top_k=similarity_top_k,
+            filters=filters,
+            streaming=streaming,
+        )
+
+    def search_filings(self, query: str, years: List[str]) -> str:
+        """
+        Answer a query from the SEC 10-K filings of Uber of several years, searched at once.
+
+        Args:
+            query (str): The query.
+            years (List[str]): The years of the filings to search, e.g. ["2021", "2022"].
+
+        Returns:
+            str: The answer.
+        """
+        unknown = sorted(set(years).difference(self.years))
+        if unknown:
+            return f"No filing for {', '.join(unknown)}, the available years are {', '.join(self.years)}"
+        return str(self.partition_query_engine(years, streaming=False).query(query))
+
+    def multi_year_tools(self) -> List[BaseTool]:
+        """
+        Build the tools searching several years at once, available in partitioned mode.
+
+        Returns:
+            List[BaseTool]: The tools, empty if the years have their own collections.
+        """
+        if not self.partitioned:
+            return []
+        return [
+            FunctionTool.from_defaults(
+                fn=self.search_filings,
+                name="multi_year_vector_index",
+                description=(
+                    "useful for when you want to answer queries about several years of the SEC 10-K for Uber"
+                    " with a single search. Provide the query and the years to search."
+                ),
+            )
+        ]
+
+    def create_memory(self) -> Optional[SummaryMemory]:
+        """
+        Create the chat memory of an agent, bounded by `memory_token_limit`.
+
+        Returns:
+            Optional[SummaryMemory]: The memory, None for the agent's default, unbounded memory.
+        """
+        if self.memory_token_limit is None:
+            return None
+        return SummaryMemory.from_defaults(
+            token_limit=self.memory_token_limit,
+            summary_token_limit=self.memory_token_limit // 6,
+            retrieve_top_k=self.memory_retrieve_top_k,
+            retrieved_token_limit=self.memory_token_limit // 6,
+        )
+
+    def create_agent(self, verbose: bool = True):
+        """
+        Create an agent with its own chat memory, sharing the chatbot's tools and indices.
+
+        Args:
+            verbose (bool): Whether the agent logs its tool calls.
+
+        Returns:
+            OpenAIAgent: The created agent.
+        """
+        from llama_index.agent.openai import OpenAIAgent
+
+        # agents report their function calls to the shared handlers, e.g. the tracer
+        return OpenAIAgent.from_tools(
+            self.tools,
+            memory=self.create_memory(),
+            verbose=verbose,
+            callback_manager=Settings.callback_manager,
+        )  # type: ignore
+
+    def serve(self, host: str = "127.0.0.1", port: int = 8000):
+        """
+        Serve concurrent chat sessions over HTTP, one agent per session.
+
+        Args:
+            host (str): The interface to listen on.
+            port (int): The port to listen on.
+        """
+        # Load the shared indices before accepting sessions, rather than on the event loop
+        self.tools
+        for key in [self.CHROMA_COLLECTION_NAME] if self.partitioned else self.years:
+            self.index_registry.get(key)
+        serve_sessions(lambda: self.create_agent(verbose=False), host, port)
+
+    def chat(self, query: str) -> TurnMetrics:
+        """
+        Run an agent turn, printing the answer token by token as it is streamed when `streaming`.
+
+        Args:
+            query (str): The user message.
+
+        Returns:
+            TurnMetrics: The latency of the turn, also appended to `turn_metrics`.
+        """
+        turn = TurnStream()
+        if self.streaming:
+            # the tools are called before the answer starts streaming
+            response = self.agent.stream_chat(query)
+            print("Agent: ", end="", flush=True)
+            for delta in turn.track(response.response_gen):
+                print(delta, end="", flush=True)
+            print()
+        else:
+            response = self.agent.chat(query)
+            print("Agent:", "".join(turn.track([str(response)])))
+        metrics = turn.metrics(tool_calls=len(response.sources))
+        self.turn_metrics.append(metrics)
+        return metrics
 
     def run(self):
         """Run the chatbot."""
@@ -204,5 +729,11 @@ class Chatbot:
             query = input("User: ")
             if query == "q":
                 break
-            response = self.agent.chat(query)
-            print("Agent:", response)
+            with trace_span("chatbot.turn", query=query) as span:
+                metrics = self.chat(query)
+                if span is not None:
+                    span.attributes.update(metrics.to_dict())
+            print(f"({metrics})")
+            if span is not None:
+                print("Trace:", self.tracer.summary(span.span_id))
+                self.tracer.flush()
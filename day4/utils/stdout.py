@@ -1,9 +1,32 @@
+from utils.notes import get_notes_store
+
+
 def save_note(note: str):
     try:
         print("Saving notes")
-        with open("./notes.txt", "w") as f:
-            f.write(note)
+        # appended to ./notes.jsonl in the background, batched with the next notes
+        get_notes_store().add(note)
         return "Note saved"
     except Exception as e:
         print(e)
         return "Note not saved"
+
+
+def search_notes(query: str) -> str:
+    """
+    Searches the saved notes, by keyword and by meaning.
+
+    Args:
+        query (str): What the notes should be about.
+
+    Returns:
+        str: The most relevant notes, one per line, with the time they were saved.
+    """
+    try:
+        results = get_notes_store().search(query)
+    except Exception as e:
+        print(e)
+        return "Notes not searched"
+    if not results:
+        return "No note found"
+    return "\n".join(str(note) for note, _ in results)
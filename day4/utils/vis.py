@@ -1,8 +1,14 @@
-from typing import List
+import os
+from typing import List, Optional
 
-import matplotlib.pyplot as plt
-import seaborn as sns
-from pandas import DataFrame
+from utils.dataframe import FrameSource
+from utils.executor import ScriptExecutor
+from utils.frame_cache import ResultCache
+from utils.rendering import get_renderer
+from utils.tracing import trace_span
+
+# rendered in the background, the tools return the path of the file at once
+PLOTS_DIR = os.path.join(".", "day4", "plots")
 
 
 def plot_progress_over_years(countries: List[str], areas: List[float]):
@@ -13,17 +19,10 @@ def plot_progress_over_years(countries: List[str], areas: List[float]):
         years (List[str]): List of years.
         progress (List[float]): List of progress values corresponding to each year.
     """
-    plt.figure(figsize=(8, 6))
-    plt.plot(countries, areas, marker="o", color="b", linestyle="-")
-    plt.title("Progress Over Years")
-    plt.xlabel("Year")
-    plt.ylabel("Progress")
-    plt.grid(True)
-    plt.xticks(rotation=45)
-    plt.tight_layout()
-    plt.show()
-
-    return "Plotting..."
+    plot = get_renderer(PLOTS_DIR).plot(
+        countries, areas, title="Progress Over Years", xlabel="Year", ylabel="Progress"
+    )
+    return f"Plotting to {plot.path}"
 
 
 def plot_progress_over_years_for_one_countrie(years: List[str], areas: List[float]):
@@ -34,17 +33,10 @@ def plot_progress_over_years_for_one_countrie(years: List[str], areas: List[floa
         years (List[str]): List of years.
         progress (List[float]): List of progress values corresponding to each year.
     """
-    plt.figure(figsize=(8, 6))
-    plt.plot(years, areas, marker="o", color="b", linestyle="-")
-    plt.title("Progress Over Years")
-    plt.xlabel("Year")
-    plt.ylabel("Progress")
-    plt.grid(True)
-    plt.xticks(rotation=45)
-    plt.tight_layout()
-    plt.show()
-
-    return "Plotting..."
+    plot = get_renderer(PLOTS_DIR).plot(
+        years, areas, title="Progress Over Years", xlabel="Year", ylabel="Progress"
+    )
+    return f"Plotting to {plot.path}"
 
 
 def plot_house_pricing_data(prices: List[float], areas: List[str]):
@@ -55,24 +47,46 @@ def plot_house_pricing_data(prices: List[float], areas: List[str]):
         areas (List[str]): List of areas.
         prices (List[float]): List of prices values corresponding to each area.
     """
-    plt.figure(figsize=(8, 6))
-    plt.plot(areas, prices, marker="o", color="b", linestyle="-")
-    plt.title("Progress Over Prices")
-    plt.xlabel("Area")
-    plt.ylabel("Price")
-    plt.grid(True)
-    plt.xticks(rotation=45)
-    plt.tight_layout()
-    plt.show()
+    plot = get_renderer(PLOTS_DIR).plot(
+        areas, prices, title="Progress Over Prices", xlabel="Area", ylabel="Price"
+    )
+    return f"Plotting to {plot.path}"
 
-    return "Plotting..."
 
+def apply_python_script_on_df(
+    executor: ScriptExecutor,
+    source: Optional[FrameSource] = None,
+    cache: Optional[ResultCache] = None,
+):
+    """
+    Create the tool function running scripts on the housing data.
+
+    Args:
+        executor (ScriptExecutor): The pool of worker processes holding the data as `df`.
+        source (Optional[FrameSource]): The housing data, whose changes are passed on to the workers.
+        cache (Optional[ResultCache]): The cache of the script results, keyed by the version of the data.
+    """
 
-def apply_python_script_on_df(df_: DataFrame):
     def fn(script: str):
-        df = df_
-        exec(script)
-        return "Script applied"
+        fingerprint = None
+        if source is not None:
+            source.refresh()
+            fingerprint = source.fingerprint
+        if cache is not None and fingerprint is not None:
+            cached = cache.lookup(fingerprint, script)
+            # unless its figures were deleted since
+            if cached is not None and all(map(os.path.exists, cached.figures)):
+                return str(cached)
+
+        with trace_span("pandas.exec", script=script) as span:
+            result = executor.run(script, fingerprint)
+            if span is not None:
+                span.attributes.update(
+                    ok=result.ok, figures=len(result.figures), run_time=result.duration
+                )
+        if result.ok and cache is not None and fingerprint is not None:
+            cache.store(fingerprint, script, result, len(str(result).encode()))
+        return str(result)
 
     return fn
 
@@ -81,4 +95,4 @@ if __name__ == "__main__":
     years = ["2019", "2020", "2021", "2022"]
     progress = [0.2, 0.4, 0.6, 0.8]
 
-    plot_progress_over_years(years, progress)
+    print(plot_progress_over_years(years, progress))
@@ -11,12 +11,47 @@ OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("-d", type=int, required=True, help="Day number")
+    parser.add_argument(
+        "--serve",
+        action="store_true",
+        help="Serve concurrent chat sessions over HTTP instead of the terminal loop (days 2-4)",
+    )
+    parser.add_argument(
+        "--partitioned",
+        action="store_true",
+        help="Index all the years in a single collection, filtered by year (days 2-4)",
+    )
+    parser.add_argument(
+        "--parse-workers",
+        type=int,
+        default=0,
+        help="Number of processes parsing documents, 0 to parse them in-process",
+    )
+    parser.add_argument(
+        "--trace",
+        metavar="PATH",
+        help="Record the stages of every query and turn to a Chrome trace file",
+    )
+    parser.add_argument(
+        "--benchmark",
+        action="store_true",
+        help="Benchmark the day's pipeline offline, printing JSON results, instead of running it",
+    )
+    parser.add_argument("--host", default="127.0.0.1", help="Host to serve on")
+    parser.add_argument("--port", type=int, default=8000, help="Port to serve on")
     args = parser.parse_args()
 
-    if args.d == 0:
+    if args.benchmark:
+        import json
+
+        from benchmarks.pipelines import run
+
+        print(json.dumps(run([args.d], partitioned=args.partitioned), indent=2))
+
+    elif args.d == 0:
         from day0.main import RAG
 
-        rag = RAG()
+        rag = RAG(parse_workers=args.parse_workers, trace_path=args.trace)
         response = rag.run("What did the author do growing up?")
         print(response)
 
@@ -24,7 +59,12 @@ if __name__ == "__main__":
         from day1.main import RAG
 
         streaming = True
-        rag = RAG(similarity_top_k=1, streaming=streaming)
+        rag = RAG(
+            similarity_top_k=1,
+            streaming=streaming,
+            parse_workers=args.parse_workers,
+            trace_path=args.trace,
+        )
         response = rag.run("What did the author do growing up?")
         if streaming:
             response.print_response_stream()  # type: ignore
@@ -34,17 +74,41 @@ if __name__ == "__main__":
     elif args.d == 2:
         from day2.main import Chatbot
 
-        chatbot = Chatbot(similarity_top_k=3)
-        chatbot.run()
+        chatbot = Chatbot(
+            similarity_top_k=3,
+            partitioned=args.partitioned,
+            parse_workers=args.parse_workers,
+            trace_path=args.trace,
+        )
+        if args.serve:
+            chatbot.serve(args.host, args.port)
+        else:
+            chatbot.run()
 
     elif args.d == 3:
         from day3.main import Chatbot
 
-        chatbot = Chatbot(similarity_top_k=3)
-        chatbot.run()
+        chatbot = Chatbot(
+            similarity_top_k=3,
+            partitioned=args.partitioned,
+            parse_workers=args.parse_workers,
+            trace_path=args.trace,
+        )
+        if args.serve:
+            chatbot.serve(args.host, args.port)
+        else:
+            chatbot.run()
 
     elif args.d == 4:
         from day4.main import Chatbot
 
-        chatbot = Chatbot(similarity_top_k=3)
-        chatbot.run()
+        chatbot = Chatbot(
+            similarity_top_k=3,
+            partitioned=args.partitioned,
+            parse_workers=args.parse_workers,
+            trace_path=args.trace,
+        )
+        if args.serve:
+            chatbot.serve(args.host, args.port)
+        else:
+            chatbot.run()
@@ -0,0 +1,64 @@
+import pandas
+import pytest
+
+from utils.dataframe import load_dataframe
+from utils.executor import ScriptExecutor
+
+
+@pytest.fixture(scope="module")
+def executor(tmp_path_factory):
+    folder = tmp_path_factory.mktemp("housing")
+    csv_path = str(folder / "housing.csv")
+    pandas.DataFrame(
+        {
+            "price": [13300000, 12250000, 9870000],
+            "area": [7420, 8960, 16200],
+            "mainroad": ["yes", "yes", "no"],
+        }
+    ).to_csv(csv_path, index=False)
+    # builds the memory-mapped cache the workers load
+    load_dataframe(csv_path)
+    executor = ScriptExecutor(
+        csv_path,
+        workers=1,
+        timeout=5.0,
+        memory_limit=256 << 20,
+        figure_dir=str(folder / "figures"),
+    )
+    yield executor
+    executor.close()
+
+
+def test_in_place_assignment(executor):
+    result = executor.run(
+        "df['area'] += 1\n"
+        "df.loc[0, 'area'] = 999\n"
+        "df.loc[0, 'price'] = 5\n"
+        "df.sort_values('area', inplace=True)\n"
+        "int(df['area'].sum()), int(df['price'].min())"
+    )
+    assert result.ok, result.error
+    assert result.value == "(26161, 5)"
+
+
+def test_changes_do_not_leak(executor):
+    executor.run("df.loc[0, 'area'] = 1\ndf['extra'] = 1")
+    result = executor.run("int(df.loc[0, 'area']), 'extra' in df")
+    assert result.value == "(7420, False)"
+
+
+def test_integers_do_not_overflow(executor):
+    result = executor.run("int((df['area'] ** 3).max())")
+    assert result.value == str(16200**3)
+
+
+def test_timeout_replaces_worker(executor):
+    result = executor.run("import time\ntime.sleep(60)")
+    assert result.error.startswith("TimeoutError")
+    assert executor.run("len(df)").value == "3"
+
+
+def test_memory_error(executor):
+    result = executor.run("data = bytearray(1 << 30)")
+    assert result.error.startswith("MemoryError")
+    assert executor.run("len(df)").value == "3"
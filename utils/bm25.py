@@ -0,0 +1,374 @@
+import json
+import math
+import os
+import re
+import threading
+from collections import Counter
+from typing import Dict, Iterable, List, Optional, Sequence, Set, Tuple
+
+from llama_index.core import VectorStoreIndex
+from llama_index.core.base.base_query_engine import BaseQueryEngine
+from llama_index.core.base.base_retriever import BaseRetriever
+from llama_index.core.schema import BaseNode, MetadataMode, NodeWithScore, QueryBundle
+from llama_index.core.vector_stores.types import MetadataFilters
+
+from utils.manifest import IndexManifest
+from utils.tracing import trace_span
+
+# words, and numbers with their thousands separators and decimals, e.g. "1,234.5"
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+(?:[.,][0-9]+)*")
+STOPWORDS = frozenset(
+    "a an and are as at be by for from has in is it its of on or that the this to"
+    " was were what which who will with".split()
+)
+
+
+def tokenize(text: str) -> List[str]:
+    """
+    Splits a text into lowercase terms, keeping figures such as "1,234.5" whole.
+
+    Args:
+        text (str): The text.
+
+    Returns:
+        List[str]: The terms, stopwords excluded.
+    """
+    return [
+        token for token in TOKEN_PATTERN.findall(text.lower()) if token not in STOPWORDS
+    ]
+
+
+class BM25Index:
+    """
+    Inverted index of chunks, scored with Okapi BM25.
+
+    The index mirrors the chunks of a vector index, see `open_bm25_index`, and
+    is persisted as a JSON file next to the vector store.
+
+    Attributes:
+        k1 (float): The term frequency saturation.
+        b (float): The document length normalization.
+    """
+
+    k1: float
+    b: float
+
+    def __init__(self, k1: float = 1.5, b: float = 0.75) -> None:
+        """
+        Creates an empty index.
+
+        Args:
+            k1 (float, optional): The term frequency saturation. Defaults to 1.5.
+            b (float, optional): The document length normalization. Defaults to 0.75.
+        """
+        self.k1 = k1
+        self.b = b
+        self._lock = threading.Lock()
+        # term -> node id -> term frequency
+        self._postings: Dict[str, Dict[str, int]] = {}
+        self._lengths: Dict[str, int] = {}
+        self._total_length = 0
+
+    @property
+    def node_ids(self) -> Set[str]:
+        """The ids of the indexed chunks."""
+        return set(self._lengths)
+
+    def add(self, nodes: Iterable[BaseNode]) -> None:
+        """
+        Indexes chunks, replacing those with the same id.
+
+        Args:
+            nodes (Iterable[BaseNode]): The chunks.
+        """
+        nodes = list(nodes)
+        self.delete([node.node_id for node in nodes])
+        with self._lock:
+            for node in nodes:
+                terms = tokenize(node.get_content(metadata_mode=MetadataMode.NONE))
+                for term, frequency in Counter(terms).items():
+                    self._postings.setdefault(term, {})[node.node_id] = frequency
+                self._lengths[node.node_id] = len(terms)
+                self._total_length += len(terms)
+
+    def delete(self, node_ids: Iterable[str]) -> None:
+        """
+        Removes chunks from the index.
+
+        Args:
+            node_ids (Iterable[str]): The ids of the chunks.
+        """
+        removed = set(node_ids).intersection(self._lengths)
+        if not removed:
+            return
+        with self._lock:
+            for node_id in removed:
+                self._total_length -= self._lengths.pop(node_id)
+            for term in list(self._postings):
+                postings = self._postings[term]
+                for node_id in removed.intersection(postings):
+                    del postings[node_id]
+                if not postings:
+                    del self._postings[term]
+
+    def search(
+        self, query: str, top_k: int, node_ids: Optional[Set[str]] = None
+    ) -> List[Tuple[str, float]]:
+        """
+        Ranks the chunks by BM25 score against a query.
+
+        Args:
+            query (str): The query.
+            top_k (int): The number of chunks to return.
+            node_ids (Set[str], optional): The chunks to rank. Defaults to all.
+
+        Returns:
+            List[Tuple[str, float]]: The ids and scores of the best chunks, by decreasing score.
+        """
+        with self._lock:
+            count = len(self._lengths)
+            if not count:
+                return []
+            average_length = self._total_length / count
+            scores: Dict[str, float] = {}
+            for term in set(tokenize(query)):
+                postings = self._postings.get(term)
+                if not postings:
+                    continue
+                idf = math.log(
+                    1 + (count - len(postings) + 0.5) / (len(postings) + 0.5)
+                )
+                for node_id, frequency in postings.items():
+                    if node_ids is not None and node_id not in node_ids:
+                        continue
+                    norm = self.k1 * (
+                        1 - self.b + self.b * self._lengths[node_id] / average_length
+                    )
+                    scores[node_id] = scores.get(node_id, 0.0) + idf * (
+                        frequency * (self.k1 + 1) / (frequency + norm)
+                    )
+        return sorted(scores.items(), key=lambda item: item[1], reverse=True)[:top_k]
+
+    def persist(self, path: str) -> None:
+        """
+        Writes the index to a JSON file.
+
+        Args:
+            path (str): The path of the file.
+        """
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with self._lock:
+            data = {
+                "k1": self.k1,
+                "b": self.b,
+                "lengths": self._lengths,
+                "postings": self._postings,
+            }
+            with open(f"{path}.tmp", "w") as f:
+                json.dump(data, f)
+        os.replace(f"{path}.tmp", path)
+
+    @classmethod
+    def from_persist_path(cls, path: str) -> "BM25Index":
+        """
+        Loads an index written by `persist`.
+
+        Args:
+            path (str): The path of the file.
+
+        Returns:
+            BM25Index: The loaded index.
+        """
+        with open(path) as f:
+            data = json.load(f)
+        index = cls(k1=data["k1"], b=data["b"])
+        index._lengths = data["lengths"]
+        index._postings = data["postings"]
+        index._total_length = sum(index._lengths.values())
+        return index
+
+
+def get_index_nodes(
+    index: VectorStoreIndex, node_ids: Optional[List[str]] = None
+) -> List[BaseNode]:
+    """
+    Fetches chunks of an index, from its vector store if it stores text, else from its docstore.
+
+    Args:
+        index (VectorStoreIndex): The index.
+        node_ids (List[str], optional): The ids of the chunks. Defaults to all.
+
+    Returns:
+        List[BaseNode]: The chunks found.
+    """
+    if index.vector_store.stores_text:
+        if node_ids is not None and not node_ids:
+            return []
+        return index.vector_store.get_nodes(node_ids=node_ids)
+    if node_ids is None:
+        return list(index.docstore.docs.values())
+    return index.docstore.get_nodes(node_ids, raise_error=False)  # type: ignore
+
+
+def open_bm25_index(
+    path: str, index: VectorStoreIndex, manifest: IndexManifest
+) -> BM25Index:
+    """
+    Loads the BM25 index of a vector index, bringing it in line with the manifest.
+
+    Chunks that left the vector index are removed, and chunks missing from the
+    BM25 index are read back from the vector index, without re-embedding them.
+
+    Args:
+        path (str): The path of the BM25 index file.
+        index (VectorStoreIndex): The vector index, synced with `manifest`.
+        manifest (IndexManifest): The manifest of the vector index.
+
+    Returns:
+        BM25Index: The BM25 index, holding the same chunks as the vector index.
+    """
+    expected = {
+        node_id for entry in manifest.files.values() for node_id in entry["chunks"]
+    }
+    exists = os.path.exists(path)
+    bm25_index = BM25Index.from_persist_path(path) if exists else BM25Index()
+    indexed = bm25_index.node_ids
+    if indexed != expected or not exists:
+        bm25_index.delete(indexed - expected)
+        bm25_index.add(get_index_nodes(index, sorted(expected - indexed)))
+        bm25_index.persist(path)
+    return bm25_index
+
+
+def reciprocal_rank_fusion(
+    rankings: Sequence[List[str]], k: int = 60
+) -> List[Tuple[str, float]]:
+    """
+    Fuses rankings by summing the reciprocal ranks of every item.
+
+    Args:
+        rankings (Sequence[List[str]]): The rankings, best first.
+        k (int, optional): The rank offset damping the top ranks. Defaults to 60.
+
+    Returns:
+        List[Tuple[str, float]]: The items and fused scores, by decreasing score.
+    """
+    scores: Dict[str, float] = {}
+    for ranking in rankings:
+        for rank, item in enumerate(ranking, start=1):
+            scores[item] = scores.get(item, 0.0) + 1 / (k + rank)
+    return sorted(scores.items(), key=lambda item: item[1], reverse=True)
+
+
+class HybridRetriever(BaseRetriever):
+    """
+    Retriever fusing vector and BM25 rankings with reciprocal rank fusion.
+
+    Each ranking retrieves `candidate_top_k` chunks, and the best
+    `similarity_top_k` of the fused ranking are returned, scored with their
+    fused score. Chunks only found by BM25 are fetched from the index. The
+    vector search is restricted by `filters`, and the BM25 search by
+    `node_ids`, which should select the same chunks.
+    """
+
+    def __init__(
+        self,
+        index: VectorStoreIndex,
+        bm25_index: BM25Index,
+        similarity_top_k: int = 3,
+        candidate_top_k: Optional[int] = None,
+        rrf_k: int = 60,
+        filters: Optional[MetadataFilters] = None,
+        node_ids: Optional[Set[str]] = None,
+    ) -> None:
+        """
+        Creates the retriever.
+
+        Args:
+            index (VectorStoreIndex): The vector index.
+            bm25_index (BM25Index): The BM25 index of the same chunks.
+            similarity_top_k (int, optional): The number of chunks to return. Defaults to 3.
+            candidate_top_k (int, optional): The number of chunks per ranking. Defaults to 4 * similarity_top_k.
+            rrf_k (int, optional): The rank offset of the fusion. Defaults to 60.
+            filters (MetadataFilters, optional): The metadata filters of the vector search. Defaults to None.
+            node_ids (Set[str], optional): The chunks the BM25 search may return. Defaults to all.
+        """
+        self._index = index
+        self._bm25_index = bm25_index
+        self._similarity_top_k = similarity_top_k
+        self._candidate_top_k = candidate_top_k or 4 * similarity_top_k
+        self._rrf_k = rrf_k
+        self._node_ids = node_ids
+        self._vector_retriever = index.as_retriever(
+            similarity_top_k=self._candidate_top_k, filters=filters
+        )
+        super().__init__(callback_manager=self._vector_retriever.callback_manager)
+
+    def _fuse(
+        self, query_bundle: QueryBundle, vector_nodes: List[NodeWithScore]
+    ) -> List[NodeWithScore]:
+        with trace_span("bm25.search") as span:
+            lexical = self._bm25_index.search(
+                query_bundle.query_str, self._candidate_top_k, node_ids=self._node_ids
+            )
+            if span is not None:
+                span.attributes["nodes"] = len(lexical)
+        fused = reciprocal_rank_fusion(
+            [
+                [node.node.node_id for node in vector_nodes],
+                [node_id for node_id, _ in lexical],
+            ],
+            k=self._rrf_k,
+        )[: self._similarity_top_k]
+
+        nodes = {node.node.node_id: node.node for node in vector_nodes}
+        missing = [node_id for node_id, _ in fused if node_id not in nodes]
+        nodes.update(
+            (node.node_id, node) for node in get_index_nodes(self._index, missing)
+        )
+        return [
+            NodeWithScore(node=nodes[node_id], score=score)
+            for node_id, score in fused
+            if node_id in nodes
+        ]
+
+    def _retrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        return self._fuse(query_bundle, self._vector_retriever.retrieve(query_bundle))
+
+    async def _aretrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        vector_nodes = await self._vector_retriever.aretrieve(query_bundle)
+        return self._fuse(query_bundle, vector_nodes)
+
+
+def as_hybrid_query_engine(
+    index: VectorStoreIndex,
+    bm25_index: BM25Index,
+    similarity_top_k: int = 3,
+    filters: Optional[MetadataFilters] = None,
+    node_ids: Optional[Set[str]] = None,
+    **kwargs,
+) -> BaseQueryEngine:
+    """
+    Creates a query engine retrieving with a `HybridRetriever`.
+
+    Args:
+        index (VectorStoreIndex): The vector index.
+        bm25_index (BM25Index): The BM25 index of the same chunks.
+        similarity_top_k (int, optional): The number of chunks to retrieve. Defaults to 3.
+        filters (MetadataFilters, optional): The metadata filters of the vector search. Defaults to None.
+        node_ids (Set[str], optional): The chunks the BM25 search may return. Defaults to all.
+        **kwargs: Passed to `RetrieverQueryEngine.from_args`, e.g. `streaming`.
+
+    Returns:
+        BaseQueryEngine: The query engine.
+    """
+    from llama_index.core.query_engine import RetrieverQueryEngine
+
+    retriever = HybridRetriever(
+        index,
+        bm25_index,
+        similarity_top_k=similarity_top_k,
+        filters=filters,
+        node_ids=node_ids,
+    )
+    return RetrieverQueryEngine.from_args(retriever, **kwargs)
@@ -0,0 +1,161 @@
+import os
+import threading
+import time
+from typing import Any, Dict, Iterator, Optional, Tuple
+
+
+class ChromaClientPool:
+    """
+    Process-wide pool of Chroma clients, one per persist directory.
+
+    Creating a `chromadb.PersistentClient` sets up its SQLite database and
+    segment caches, and creating several concurrently for the same directory
+    races. The pool creates a single client per directory, shared by every
+    year, tool, chatbot and session of the process, and caches the collections
+    opened through it.
+
+    Attributes:
+        collection_load_times (Dict[Tuple[str, str], float]): The time taken to open each collection, in seconds.
+    """
+
+    collection_load_times: Dict[Tuple[str, str], float]
+
+    def __init__(self) -> None:
+        """Creates an empty pool."""
+        self._lock = threading.Lock()
+        self._clients: Dict[str, Any] = {}
+        self._collections: Dict[Tuple[str, str], Any] = {}
+        self.collection_load_times = {}
+
+    @staticmethod
+    def _key(persist_dir: str) -> str:
+        return os.path.realpath(persist_dir)
+
+    def client(self, persist_dir: str):
+        """
+        Returns the client of a persist directory, creating it if needed.
+
+        Args:
+            persist_dir (str): The directory of the Chroma db.
+
+        Returns:
+            chromadb.ClientAPI: The shared client.
+        """
+        key = self._key(persist_dir)
+        with self._lock:
+            if key not in self._clients:
+                import chromadb
+
+                self._clients[key] = chromadb.PersistentClient(persist_dir)
+            return self._clients[key]
+
+    def collection(self, persist_dir: str, name: str):
+        """
+        Returns a collection of a persist directory, creating it if needed.
+
+        Args:
+            persist_dir (str): The directory of the Chroma db.
+            name (str): The name of the collection.
+
+        Returns:
+            chromadb.Collection: The collection.
+        """
+        key = (self._key(persist_dir), name)
+        client = self.client(persist_dir)
+        with self._lock:
+            if key not in self._collections:
+                start = time.perf_counter()
+                self._collections[key] = client.get_or_create_collection(name)
+                self.collection_load_times[key] = time.perf_counter() - start
+            return self._collections[key]
+
+    def open_file_handles(self) -> Optional[int]:
+        """
+        Counts the file descriptors of the process open on files of the pooled directories.
+
+        Returns:
+            Optional[int]: The number of handles, None where `/proc` is not available.
+        """
+        fd_dir = "/proc/self/fd"
+        if not os.path.isdir(fd_dir):
+            return None
+        with self._lock:
+            roots = [os.path.join(root, "") for root in self._clients]
+        handles = 0
+        for fd in os.listdir(fd_dir):
+            try:
+                target = os.readlink(os.path.join(fd_dir, fd))
+            except OSError:
+                continue
+            handles += any(target.startswith(root) for root in roots)
+        return handles
+
+    @property
+    def stats(self) -> Dict[str, Any]:
+        """Returns the open clients, collections and file handles, and the collection load times."""
+        with self._lock:
+            load_times = {
+                f"{os.path.basename(persist_dir)}/{name}": load_time
+                for (persist_dir, name), load_time in self.collection_load_times.items()
+            }
+            clients, collections = len(self._clients), len(self._collections)
+        return {
+            "clients": clients,
+            "collections": collections,
+            "file_handles": self.open_file_handles(),
+            "collection_load_times": load_times,
+        }
+
+
+# shared by the whole process
+chroma_pool = ChromaClientPool()
+
+
+def get_chroma_client(persist_dir: str):
+    """
+    Returns the pooled Chroma client of a persist directory.
+
+    Args:
+        persist_dir (str): The directory of the Chroma db.
+
+    Returns:
+        chromadb.ClientAPI: The shared client.
+    """
+    return chroma_pool.client(persist_dir)
+
+
+def get_chroma_collection(persist_dir: str, name: str):
+    """
+    Returns a collection of the pooled Chroma client of a persist directory.
+
+    Args:
+        persist_dir (str): The directory of the Chroma db.
+        name (str): The name of the collection.
+
+    Returns:
+        chromadb.Collection: The collection.
+    """
+    return chroma_pool.collection(persist_dir, name)
+
+
+def iter_collection_chunks(
+    collection, batch_size: int = 1000
+) -> Iterator[Tuple[str, Optional[str]]]:
+    """
+    Iterates over the chunks of a collection, a page at a time.
+
+    Args:
+        collection (chromadb.Collection): The collection.
+        batch_size (int, optional): The number of chunks read at a time. Defaults to 1000.
+
+    Returns:
+        Iterator[Tuple[str, Optional[str]]]: The id of every chunk and the id of its document.
+    """
+    offset = 0
+    while True:
+        page = collection.get(include=["metadatas"], limit=batch_size, offset=offset)
+        for chunk_id, metadata in zip(page["ids"], page["metadatas"]):
+            yield chunk_id, (metadata or {}).get("ref_doc_id")
+        if len(page["ids"]) < batch_size:
+            return
+        offset += batch_size
@@ -0,0 +1,286 @@
+import json
+import os
+import threading
+import time
+from dataclasses import dataclass
+from typing import Optional, Tuple
+
+import numpy as np
+import pandas
+
+# integers up to this bound are stored as int32, they are handed to agent code as int64 by `writable_frame`
+SAFE_INT32_MAX = 46340
+
+
+@dataclass
+class FrameLoadReport:
+    """
+    Statistics of a DataFrame load.
+
+    Attributes:
+        path (str): The path of the source CSV.
+        cached (bool): Whether the frame was memory-mapped from the columnar cache, rather than parsed from the CSV.
+        load_time (float): Wall time of the load, in seconds.
+        memory (int): The memory held by the frame, in bytes.
+        csv_load_time (float): Wall time of parsing the CSV with inferred dtypes, when the cache was built.
+        csv_memory (int): The memory held by the frame parsed with inferred dtypes, in bytes.
+        fingerprint (str): The SHA-256 of the CSV the frame was loaded from.
+    """
+
+    path: str
+    cached: bool
+    load_time: float
+    memory: int
+    csv_load_time: float
+    csv_memory: int
+    fingerprint: str = ""
+
+    def __str__(self) -> str:
+        source = "cache" if self.cached else "CSV"
+        return (
+            f"{os.path.basename(self.path)}: loaded from {source} in {self.load_time:.3f}s,"
+            f" {self.memory / 2**20:.2f} MiB"
+            f" (CSV: {self.csv_load_time:.3f}s, {self.csv_memory / 2**20:.2f} MiB)"
+        )
+
+
+def frame_memory(df: pandas.DataFrame) -> int:
+    """
+    Measures the memory held by a DataFrame, strings included.
+
+    Args:
+        df (pandas.DataFrame): The frame.
+
+    Returns:
+        int: The memory, in bytes.
+    """
+    return int(df.memory_usage(index=True, deep=True).sum())
+
+
+def downcast_frame(
+    df: pandas.DataFrame, max_category_ratio: float = 0.5
+) -> pandas.DataFrame:
+    """
+    Shrinks the dtypes of a DataFrame without changing its values.
+
+    Integers that fit in `SAFE_INT32_MAX` become int32, floats become float32
+    when no value changes, and strings with few distinct values become
+    categoricals. As products of int32 columns may overflow, the downcast
+    frame is meant to be stored and read, code computing on it should get a
+    `writable_frame` of it.
+
+    Args:
+        df (pandas.DataFrame): The frame, parsed with inferred dtypes.
+        max_category_ratio (float, optional): The maximum ratio of distinct values to rows of a categorical column.
+            Defaults to 0.5.
+
+    Returns:
+        pandas.DataFrame: The downcast frame.
+    """
+    columns = {}
+    for name, column in df.items():
+        if pandas.api.types.is_integer_dtype(column.dtype):
+            if len(column) and column.abs().max() <= SAFE_INT32_MAX:
+                column = column.astype(np.int32)
+        elif pandas.api.types.is_float_dtype(column.dtype):
+            narrow = column.astype(np.float32)
+            if np.array_equal(
+                narrow.to_numpy(np.float64), column.to_numpy(), equal_nan=True
+            ):
+                column = narrow
+        elif pandas.api.types.is_object_dtype(column.dtype):
+            if column.nunique(dropna=True) <= max_category_ratio * len(column):
+                column = column.astype("category")
+        columns[name] = column
+    return pandas.DataFrame(columns, index=df.index)
+
+
+def writable_frame(df: pandas.DataFrame) -> pandas.DataFrame:
+    """
+    Copies a frame loaded by `load_dataframe` for code that may modify it.
+
+    The copy owns writable columns, and its integers are int64 again, so that
+    products of several columns do not overflow.
+
+    Args:
+        df (pandas.DataFrame): The frame, possibly memory-mapped and downcast.
+
+    Returns:
+        pandas.DataFrame: The writable copy.
+    """
+    columns = {}
+    for name, column in df.items():
+        if (
+            pandas.api.types.is_signed_integer_dtype(column.dtype)
+            and column.dtype.itemsize < 8
+        ):
+            columns[name] = column.astype(np.int64)
+        else:
+            columns[name] = column.copy(deep=True)
+    return pandas.DataFrame(columns, index=df.index.copy())
+
+
+def load_dataframe(
+    csv_path: str, cache_dir: Optional[str] = None
+) -> Tuple[pandas.DataFrame, FrameLoadReport]:
+    """
+    Loads a CSV through a columnar cache.
+
+    The first load parses the CSV, downcasts its dtypes and writes it as an
+    uncompressed Feather file, which later loads memory-map. The cache is
+    rebuilt when the content of the CSV changes. Without pyarrow, the CSV is
+    parsed and downcast on every load.
+
+    The memory-mapped columns are read-only, and the integers may be int32:
+    code that may modify the frame or multiply its columns, such as the code
+    of the agent, should run on a `writable_frame` of it.
+
+    Args:
+        csv_path (str): The path of the CSV.
+        cache_dir (str, optional): The folder of the cache. Defaults to the folder of the CSV.
+
+    Returns:
+        Tuple[pandas.DataFrame, FrameLoadReport]: The frame and the statistics of its load.
+    """
+    start = time.perf_counter()
+    name = os.path.basename(csv_path)
+    cache_dir = cache_dir or os.path.dirname(csv_path) or "."
+    cache_path = os.path.join(cache_dir, f"{name}.feather")
+    meta_path = os.path.join(cache_dir, f"{name}.feather.json")
+
+    try:
+        from pyarrow import feather
+    except ImportError:
+        feather = None
+
+    stat = os.stat(csv_path)
+    meta = {}
+    if feather is not None and os.path.exists(meta_path):
+        with open(meta_path) as f:
+            meta = json.load(f)
+    if meta and os.path.exists(cache_path):
+        fresh = (meta["size"], meta["mtime_ns"]) == (stat.st_size, stat.st_mtime_ns)
+        if not fresh and meta["size"] == stat.st_size:
+            from utils.manifest import hash_file
+
+            # touched but maybe not changed
+            fresh = meta["sha256"] == hash_file(csv_path)
+            if fresh:
+                meta["mtime_ns"] = stat.st_mtime_ns
+                _write_meta(meta_path, meta)
+        if fresh:
+            table = feather.read_table(cache_path, memory_map=True)
+            df = table.to_pandas(split_blocks=True)
+            load_time = time.perf_counter() - start
+            return df, FrameLoadReport(
+                csv_path,
+                cached=True,
+                load_time=load_time,
+                memory=frame_memory(df),
+                csv_load_time=meta["csv_load_time"],
+                csv_memory=meta["csv_memory"],
+                fingerprint=meta["sha256"],
+            )
+
+    # imported here, so that loads from the cache do not import LlamaIndex
+    from utils.manifest import hash_file
+
+    df = pandas.read_csv(csv_path)
+    csv_load_time = time.perf_counter() - start
+    csv_memory = frame_memory(df)
+    df = downcast_frame(df)
+    report = FrameLoadReport(
+        csv_path,
+        cached=False,
+        load_time=time.perf_counter() - start,
+        memory=frame_memory(df),
+        csv_load_time=csv_load_time,
+        csv_memory=csv_memory,
+        fingerprint=hash_file(csv_path),
+    )
+    if feather is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        # uncompressed, so that it can be memory-mapped
+        feather.write_feather(
+            df.reset_index(drop=True), f"{cache_path}.tmp", compression="uncompressed"
+        )
+        os.replace(f"{cache_path}.tmp", cache_path)
+        _write_meta(
+            meta_path,
+            {
+                "size": stat.st_size,
+                "mtime_ns": stat.st_mtime_ns,
+                "sha256": report.fingerprint,
+                "csv_load_time": csv_load_time,
+                "csv_memory": csv_memory,
+            },
+        )
+    return df, report
+
+
+def _write_meta(path: str, meta: dict) -> None:
+    with open(f"{path}.tmp", "w") as f:
+        json.dump(meta, f)
+    os.replace(f"{path}.tmp", path)
+
+
+class FrameSource:
+    """
+    A CSV loaded through the columnar cache, reloaded once it changes.
+
+    Changes are detected lazily, by `refresh`, with a single `os.stat`. As only
+    the first caller of `refresh` sees a change, state derived from the frame
+    should be kept along with the `fingerprint` it was derived from.
+
+    Attributes:
+        csv_path (str): The path of the CSV.
+        cache_dir (Optional[str]): The folder of the cache, None for the folder of the CSV.
+        df (pandas.DataFrame): The current frame.
+        report (FrameLoadReport): The statistics of the load of the current frame.
+    """
+
+    csv_path: str
+    cache_dir: Optional[str]
+    df: pandas.DataFrame
+    report: FrameLoadReport
+
+    def __init__(self, csv_path: str, cache_dir: Optional[str] = None) -> None:
+        """
+        Loads the CSV.
+
+        Args:
+            csv_path (str): The path of the CSV.
+            cache_dir (str, optional): The folder of the cache. Defaults to the folder of the CSV.
+        """
+        self.csv_path = csv_path
+        self.cache_dir = cache_dir
+        self._lock = threading.Lock()
+        self._load()
+
+    def _load(self) -> None:
+        # taken before the load, so that a change during the load is seen by the next refresh
+        stat = os.stat(self.csv_path)
+        self.df, self.report = load_dataframe(self.csv_path, self.cache_dir)
+        self._stat = (stat.st_size, stat.st_mtime_ns)
+
+    @property
+    def fingerprint(self) -> str:
+        """The SHA-256 of the CSV the current frame was loaded from."""
+        return self.report.fingerprint
+
+    def refresh(self) -> bool:
+        """
+        Reloads the frame if its CSV was modified since it was loaded.
+
+        Returns:
+            bool: Whether the content of the frame changed.
+        """
+        stat = os.stat(self.csv_path)
+        if (stat.st_size, stat.st_mtime_ns) == self._stat:
+            return False
+        with self._lock:
+            fingerprint = self.fingerprint
+            stat = os.stat(self.csv_path)
+            if (stat.st_size, stat.st_mtime_ns) != self._stat:
+                self._load()
+            return self.fingerprint != fingerprint
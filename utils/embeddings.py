@@ -0,0 +1,520 @@
+import atexit
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from llama_index.core import Settings
+from llama_index.core.base.embeddings.base import BaseEmbedding, Embedding
+from llama_index.core.bridge.pydantic import PrivateAttr
+
+DEFAULT_CACHE_DIR = os.path.join(".", ".cache", "embeddings")
+
+
+class CountingEmbedding(BaseEmbedding):
+    """
+    Embedding model wrapper that counts the calls made to the wrapped model.
+
+    Attributes:
+        calls (int): The number of embedding requests (one per batch or query).
+        texts (int): The number of texts embedded.
+    """
+
+    _inner: BaseEmbedding = PrivateAttr()
+    _lock: threading.Lock = PrivateAttr()
+    _calls: int = PrivateAttr(default=0)
+    _texts: int = PrivateAttr(default=0)
+
+    def __init__(self, inner: BaseEmbedding) -> None:
+        """
+        Wraps an embedding model.
+
+        Args:
+            inner (BaseEmbedding): The embedding model doing the actual work.
+        """
+        super().__init__(
+            model_name=inner.model_name,
+            embed_batch_size=inner.embed_batch_size,
+            callback_manager=inner.callback_manager,
+        )
+        self._inner = inner
+        self._lock = threading.Lock()
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "CountingEmbedding"
+
+    @property
+    def calls(self) -> int:
+        return self._calls
+
+    @property
+    def texts(self) -> int:
+        return self._texts
+
+    def _count(self, num_texts: int) -> None:
+        with self._lock:
+            self._calls += 1
+            self._texts += num_texts
+
+    def _get_query_embedding(self, query: str) -> Embedding:
+        self._count(1)
+        return self._inner._get_query_embedding(query)
+
+    async def _aget_query_embedding(self, query: str) -> Embedding:
+        self._count(1)
+        return await self._inner._aget_query_embedding(query)
+
+    def _get_text_embedding(self, text: str) -> Embedding:
+        self._count(1)
+        return self._inner._get_text_embedding(text)
+
+    async def _aget_text_embedding(self, text: str) -> Embedding:
+        self._count(1)
+        return await self._inner._aget_text_embedding(text)
+
+    def _get_text_embeddings(self, texts: List[str]) -> List[Embedding]:
+        self._count(len(texts))
+        return self._inner._get_text_embeddings(texts)
+
+    async def _aget_text_embeddings(self, texts: List[str]) -> List[Embedding]:
+        self._count(len(texts))
+        return await self._inner._aget_text_embeddings(texts)
+
+
+class EmbeddingCache:
+    """
+    Persistent, size-bounded embedding cache keyed by (model, text hash).
+
+    The vectors of each dimension live in a memory-mapped float32 array, one
+    row per entry. An append-only log maps the keys to their rows: each flush
+    appends the entries evicted since the previous one, then those stored or
+    hit, from least to most recently used, so that replaying the log restores
+    the recency order. The log is compacted once it holds more than twice the
+    live entries, so that the offsets are written a bounded number of times
+    each. When the cache is full the least recently used entry is evicted,
+    and its row is reused once the eviction is logged.
+
+    The cache is thread-safe. A process holds the cache directory for as
+    long as the cache is open: a cache opened meanwhile by another process,
+    e.g. another day or a benchmark on the same directory, is kept in memory
+    only.
+
+    Attributes:
+        cache_dir (str): The directory holding the arrays and the offset log.
+        max_entries (int): The maximum number of cached embeddings.
+        persistent (bool): Whether the cache is written to `cache_dir`.
+        hits (int): The number of lookups served from the cache.
+        misses (int): The number of lookups that missed the cache.
+        evictions (int): The number of evicted entries.
+    """
+
+    LOG_FILENAME = "index.log"
+    LOCK_FILENAME = "lock"
+    # the offset index of previous versions, replaced by the log
+    INDEX_FILENAME = "index.json"
+    INITIAL_CAPACITY = 1024
+
+    cache_dir: str
+    max_entries: int
+    persistent: bool
+    hits: int
+    misses: int
+    evictions: int
+
+    def __init__(
+        self,
+        cache_dir: str = DEFAULT_CACHE_DIR,
+        max_entries: int = 200_000,
+        flush_every: int = 1024,
+    ) -> None:
+        """
+        Opens the cache, replaying its offset log if it exists.
+
+        Args:
+            cache_dir (str, optional): The cache directory. Defaults to "./.cache/embeddings".
+            max_entries (int, optional): The maximum number of cached embeddings. Defaults to 200000.
+            flush_every (int, optional): The number of insertions between two flushes of the log. Defaults to 1024.
+        """
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        self.flush_every = flush_every
+        self.hits = self.misses = self.evictions = 0
+
+        self._lock = threading.RLock()
+        # key -> (dim, row), from least to most recently used
+        self._entries: "OrderedDict[str, Tuple[int, int]]" = OrderedDict()
+        self._arrays: Dict[int, np.ndarray] = {}
+        self._next_row: Dict[int, int] = {}
+        self._free_rows: Dict[int, List[int]] = {}
+        # rows evicted since the last flush, reused once their eviction is logged
+        self._released: List[Tuple[int, int]] = []
+        # keys evicted, and keys stored or hit by recency, since the last flush
+        self._evicted_keys: List[str] = []
+        self._used_keys: "OrderedDict[str, None]" = OrderedDict()
+        self._log_records = 0
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.persistent = self._acquire()
+        if not self.persistent:
+            print(
+                f"The embedding cache {self.cache_dir} is used by another process,"
+                " caching embeddings in memory only"
+            )
+            return
+
+        log_path = os.path.join(self.cache_dir, self.LOG_FILENAME)
+        index_path = os.path.join(self.cache_dir, self.INDEX_FILENAME)
+        if os.path.exists(log_path):
+            self._replay(log_path)
+        elif os.path.exists(index_path):
+            with open(index_path) as f:
+                index = json.load(f)
+            for key, dim, row in index["entries"]:
+                self._entries[key] = (dim, row)
+            self._next_row = {int(dim): n for dim, n in index["next_row"].items()}
+            self._compact()
+            os.remove(index_path)
+        for dim, next_row in self._next_row.items():
+            used = {row for d, row in self._entries.values() if d == dim}
+            self._free_rows[dim] = [r for r in range(next_row) if r not in used]
+
+        atexit.register(self.flush)
+
+    def _acquire(self) -> bool:
+        """Locks the cache directory for the process, returning whether it was free."""
+        try:
+            import fcntl
+        except ImportError:
+            # not available on Windows
+            return True
+        self._lock_file = open(os.path.join(self.cache_dir, self.LOCK_FILENAME), "a")
+        try:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            self._lock_file.close()
+            return False
+        return True
+
+    def _replay(self, log_path: str) -> None:
+        torn = False
+        with open(log_path) as f:
+            for line in f:
+                torn = not line.endswith("\n")
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # a torn last line, from a crash during a flush
+                    continue
+                self._log_records += 1
+                if len(record) == 1:
+                    self._entries.pop(record[0], None)
+                    continue
+                key, dim, row = record
+                self._entries.pop(key, None)
+                self._entries[key] = (dim, row)
+                self._next_row[dim] = max(self._next_row.get(dim, 0), row + 1)
+        if torn:
+            # so that the next flush does not extend the torn line
+            self._compact()
+
+    def _compact(self) -> None:
+        """Rewrites the log with the live entries only."""
+        log_path = os.path.join(self.cache_dir, self.LOG_FILENAME)
+        with open(f"{log_path}.tmp", "w") as f:
+            for key, (dim, row) in self._entries.items():
+                f.write(json.dumps([key, dim, row]) + "\n")
+        os.replace(f"{log_path}.tmp", log_path)
+        self._log_records = len(self._entries)
+
+    @staticmethod
+    def make_key(model_name: str, text: str) -> str:
+        digest = hashlib.sha256(text.encode("utf-8", "surrogatepass")).hexdigest()
+        return f"{model_name}:{digest}"
+
+    def _array_path(self, dim: int) -> str:
+        return os.path.join(self.cache_dir, f"vectors-{dim}.f32")
+
+    def _array(self, dim: int, min_rows: int = 0) -> np.ndarray:
+        """Returns the array of a dimension, growing it to at least `min_rows` rows."""
+        array = self._arrays.get(dim)
+        path = self._array_path(dim)
+        if array is None and self.persistent and os.path.exists(path):
+            rows = os.path.getsize(path) // (4 * dim)
+            array = np.memmap(path, dtype=np.float32, mode="r+", shape=(rows, dim))
+        if array is None or array.shape[0] < min_rows:
+            rows = array.shape[0] if array is not None else 0
+            capacity = max(rows, self.INITIAL_CAPACITY)
+            while capacity < min_rows:
+                capacity *= 2
+            # the rows released since the last flush are not reused yet
+            capacity = max(min(capacity, self.max_entries + self.flush_every), min_rows)
+            if not self.persistent:
+                grown = np.zeros((capacity, dim), dtype=np.float32)
+                if array is not None:
+                    grown[:rows] = array
+                array = grown
+            else:
+                if array is not None:
+                    array.flush()
+                    del array
+                with open(path, "ab") as f:
+                    f.truncate(capacity * dim * 4)
+                array = np.memmap(
+                    path, dtype=np.float32, mode="r+", shape=(capacity, dim)
+                )
+        self._arrays[dim] = array
+        return array
+
+    def get(self, model_name: str, text: str) -> Optional[Embedding]:
+        """
+        Looks up the embedding of a text.
+
+        Args:
+            model_name (str): The name of the embedding model.
+            text (str): The embedded text.
+
+        Returns:
+            Optional[Embedding]: The cached embedding, or None on a miss.
+        """
+        key = self.make_key(model_name, text)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._use(key)
+            dim, row = entry
+            return self._array(dim)[row].tolist()
+
+    def _use(self, key: str) -> None:
+        """Marks an entry as the most recently used, to be logged on the next flush."""
+        self._entries.move_to_end(key)
+        self._used_keys[key] = None
+        self._used_keys.move_to_end(key)
+        if len(self._evicted_keys) + len(self._used_keys) >= self.flush_every:
+            self.flush()
+
+    def put(self, model_name: str, text: str, embedding: Embedding) -> None:
+        """
+        Stores the embedding of a text, evicting the least recently used entry if the cache is full.
+
+        Args:
+            model_name (str): The name of the embedding model.
+            text (str): The embedded text.
+            embedding (Embedding): The embedding of the text.
+        """
+        key = self.make_key(model_name, text)
+        dim = len(embedding)
+        with self._lock:
+            if key in self._entries:
+                self._use(key)
+                return
+            while len(self._entries) >= self.max_entries:
+                evicted_key, evicted = self._entries.popitem(last=False)
+                self._released.append(evicted)
+                self._used_keys.pop(evicted_key, None)
+                self._evicted_keys.append(evicted_key)
+                self.evictions += 1
+
+            free_rows = self._free_rows.setdefault(dim, [])
+            if free_rows:
+                row = free_rows.pop()
+            else:
+                row = self._next_row.get(dim, 0)
+                self._next_row[dim] = row + 1
+            self._array(dim, min_rows=row + 1)[row] = embedding
+            self._entries[key] = (dim, row)
+            self._use(key)
+
+    def flush(self) -> None:
+        """Writes the arrays, then appends the entries evicted, stored and hit since the last flush to the log."""
+        with self._lock:
+            # evictions first, as an evicted key may have been stored again since
+            records = [[key] for key in self._evicted_keys] + [
+                [key, *self._entries[key]] for key in self._used_keys
+            ]
+            self._evicted_keys = []
+            self._used_keys = OrderedDict()
+            if self.persistent:
+                for array in self._arrays.values():
+                    array.flush()
+            if self.persistent and records:
+                log_path = os.path.join(self.cache_dir, self.LOG_FILENAME)
+                with open(log_path, "a") as f:
+                    f.write("".join(json.dumps(record) + "\n" for record in records))
+                self._log_records += len(records)
+                if self._log_records > 2 * len(self._entries) + self.flush_every:
+                    self._compact()
+            # logged as evicted, their rows may now be overwritten
+            for dim, row in self._released:
+                self._free_rows.setdefault(dim, []).append(row)
+            self._released = []
+
+    @property
+    def stats(self) -> Dict[str, float]:
+        """Returns the hit/miss statistics of the cache."""
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+
+class CachedEmbedding(BaseEmbedding):
+    """
+    Embedding model wrapper that serves embeddings from an `EmbeddingCache`.
+
+    Only the texts missing from the cache are sent to the wrapped model, in a
+    single batch. Queries and texts are cached apart, as some models embed
+    them differently.
+    """
+
+    _inner: BaseEmbedding = PrivateAttr()
+    _cache: EmbeddingCache = PrivateAttr()
+
+    def __init__(self, inner: BaseEmbedding, cache: EmbeddingCache) -> None:
+        """
+        Wraps an embedding model.
+
+        Args:
+            inner (BaseEmbedding): The embedding model doing the actual work.
+            cache (EmbeddingCache): The cache to serve embeddings from.
+        """
+        super().__init__(
+            model_name=inner.model_name,
+            embed_batch_size=inner.embed_batch_size,
+            callback_manager=inner.callback_manager,
+        )
+        self._inner = inner
+        self._cache = cache
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "CachedEmbedding"
+
+    @property
+    def inner(self) -> BaseEmbedding:
+        return self._inner
+
+    @property
+    def cache(self) -> EmbeddingCache:
+        return self._cache
+
+    def _namespace(self, mode: str) -> str:
+        """Returns the cache namespace of the query or text embeddings of the wrapped model."""
+        # a model may embed in several dimensions, and embed queries differently from texts
+        dimensions = getattr(self._inner, "dimensions", None)
+        model_name = (
+            f"{self.model_name}@{dimensions}" if dimensions else self.model_name
+        )
+        return f"{model_name}:{mode}"
+
+    def _lookup(self, texts: List[str]) -> Tuple[List[Optional[Embedding]], List[int]]:
+        namespace = self._namespace("text")
+        embeddings = [self._cache.get(namespace, text) for text in texts]
+        missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+        return embeddings, missing
+
+    def _store(
+        self,
+        texts: List[str],
+        embeddings: List[Optional[Embedding]],
+        missing: List[int],
+        computed: List[Embedding],
+    ) -> List[Embedding]:
+        namespace = self._namespace("text")
+        for i, embedding in zip(missing, computed):
+            self._cache.put(namespace, texts[i], embedding)
+            embeddings[i] = embedding
+        return embeddings  # type: ignore
+
+    def _get_query_embedding(self, query: str) -> Embedding:
+        namespace = self._namespace("query")
+        embedding = self._cache.get(namespace, query)
+        if embedding is None:
+            embedding = self._inner._get_query_embedding(query)
+            self._cache.put(namespace, query, embedding)
+        return embedding
+
+    async def _aget_query_embedding(self, query: str) -> Embedding:
+        namespace = self._namespace("query")
+        embedding = self._cache.get(namespace, query)
+        if embedding is None:
+            embedding = await self._inner._aget_query_embedding(query)
+            self._cache.put(namespace, query, embedding)
+        return embedding
+
+    def _get_text_embedding(self, text: str) -> Embedding:
+        return self._get_text_embeddings([text])[0]
+
+    async def _aget_text_embedding(self, text: str) -> Embedding:
+        return (await self._aget_text_embeddings([text]))[0]
+
+    def _get_text_embeddings(self, texts: List[str]) -> List[Embedding]:
+        embeddings, missing = self._lookup(texts)
+        computed = []
+        if missing:
+            computed = self._inner._get_text_embeddings([texts[i] for i in missing])
+        return self._store(texts, embeddings, missing, computed)
+
+    async def _aget_text_embeddings(self, texts: List[str]) -> List[Embedding]:
+        embeddings, missing = self._lookup(texts)
+        computed = []
+        if missing:
+            computed = await self._inner._aget_text_embeddings(
+                [texts[i] for i in missing]
+            )
+        return self._store(texts, embeddings, missing, computed)
+
+
+def use_embedding_cache(
+    cache_dir: str = DEFAULT_CACHE_DIR, max_entries: int = 200_000
+) -> EmbeddingCache:
+    """
+    Routes every embedding call through a persistent cache, by wrapping `Settings.embed_model`.
+
+    Calling it again is a no-op returning the installed cache.
+
+    Args:
+        cache_dir (str, optional): The cache directory. Defaults to "./.cache/embeddings".
+        max_entries (int, optional): The maximum number of cached embeddings. Defaults to 200000.
+
+    Returns:
+        EmbeddingCache: The installed cache, exposing the hit/miss statistics.
+    """
+    embed_model = Settings.embed_model
+    if isinstance(embed_model, CachedEmbedding):
+        return embed_model.cache
+
+    cache = EmbeddingCache(cache_dir, max_entries=max_entries)
+    Settings.embed_model = CachedEmbedding(embed_model, cache)
+    return cache
+
+
+def count_calls(embed_model: BaseEmbedding) -> Tuple[BaseEmbedding, CountingEmbedding]:
+    """
+    Wraps an embedding model to count the calls reaching the underlying model.
+
+    Embeddings served from the cache of a `CachedEmbedding` are not counted.
+
+    Args:
+        embed_model (BaseEmbedding): The embedding model.
+
+    Returns:
+        Tuple[BaseEmbedding, CountingEmbedding]: The model to use in place of
+            `embed_model`, and the counter.
+    """
+    if isinstance(embed_model, CachedEmbedding):
+        counter = CountingEmbedding(embed_model.inner)
+        return CachedEmbedding(counter, embed_model.cache), counter
+
+    counter = CountingEmbedding(embed_model)
+    return counter, counter
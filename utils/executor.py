@@ -0,0 +1,382 @@
+import ast
+import io
+import multiprocessing
+import os
+import queue
+import threading
+import time
+import traceback
+import uuid
+import warnings
+from contextlib import redirect_stdout
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional
+
+# the characters of stdout and of the returned value sent back to the agent
+MAX_OUTPUT_CHARS = 4000
+# the time a new worker may take to import pandas and map the frame
+STARTUP_TIMEOUT = 120.0
+
+
+@dataclass
+class ScriptResult:
+    """
+    The outcome of a script run by a `ScriptExecutor`.
+
+    Attributes:
+        stdout (str): What the script printed, truncated.
+        value (Optional[str]): The value of the last expression of the script, or of its `result` variable, as text.
+        figures (List[str]): The PNG files of the figures the script drew.
+        error (Optional[str]): The exception the script raised, its timeout or the crash of its worker, None on success.
+        duration (float): Wall time of the run, waiting for a free worker excluded, in seconds.
+    """
+
+    stdout: str = ""
+    value: Optional[str] = None
+    figures: List[str] = field(default_factory=list)
+    error: Optional[str] = None
+    duration: float = 0.0
+
+    @property
+    def ok(self) -> bool:
+        """Whether the script ran to completion."""
+        return self.error is None
+
+    def __str__(self) -> str:
+        parts = []
+        if self.stdout:
+            parts.append(f"Output:\n{self.stdout}")
+        if self.value is not None:
+            parts.append(f"Result:\n{self.value}")
+        if self.figures:
+            parts.append("Figures saved to: " + ", ".join(self.figures))
+        if self.error is not None:
+            parts.append(f"Error: {self.error}")
+        return "\n".join(parts) or "Script applied"
+
+
+def _truncate(text: str) -> str:
+    if len(text) <= MAX_OUTPUT_CHARS:
+        return text
+    return (
+        text[:MAX_OUTPUT_CHARS]
+        + f"\n... ({len(text) - MAX_OUTPUT_CHARS} more characters)"
+    )
+
+
+def _describe(value: Any) -> str:
+    to_string = getattr(value, "to_string", None)
+    if callable(to_string):
+        try:
+            return _truncate(to_string(max_rows=50))
+        except TypeError:
+            pass
+    return _truncate(repr(value))
+
+
+def _limit_memory(memory_limit: Optional[int]) -> None:
+    if memory_limit is None:
+        return
+    try:
+        import resource
+    except ImportError:
+        # not available on Windows
+        return
+    # on top of what the worker already holds, thread arenas included
+    baseline = 0
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmData:"):
+                    baseline = int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    # private allocations only, the memory-mapped frame is not counted
+    limit = getattr(resource, "RLIMIT_DATA", resource.RLIMIT_AS)
+    resource.setrlimit(limit, (baseline + memory_limit, baseline + memory_limit))
+
+
+def _run_script(
+    script: str, namespace: Dict[str, Any], figure_dir: str
+) -> ScriptResult:
+    import matplotlib.pyplot as plt
+
+    stdout = io.StringIO()
+    result = ScriptResult()
+    try:
+        tree = ast.parse(script, mode="exec")
+        # the last expression is evaluated, as in a notebook cell
+        last = None
+        if tree.body and isinstance(tree.body[-1], ast.Expr):
+            last = ast.Expression(tree.body.pop().value)
+        with redirect_stdout(stdout), warnings.catch_warnings():
+            # `plt.show` is a no-op on Agg
+            warnings.simplefilter("ignore", UserWarning)
+            exec(compile(tree, "<script>", "exec"), namespace)
+            value = (
+                eval(compile(last, "<script>", "eval"), namespace)
+                if last is not None
+                else namespace.get("result")
+            )
+        if value is not None:
+            result.value = _describe(value)
+    except MemoryError:
+        result.error = "MemoryError: the script exceeded the memory limit"
+    except Exception as e:
+        result.error = "".join(traceback.format_exception_only(type(e), e)).strip()
+    result.stdout = _truncate(stdout.getvalue())
+
+    for number in plt.get_fignums():
+        path = os.path.join(figure_dir, f"{uuid.uuid4().hex}.png")
+        try:
+            plt.figure(number).savefig(path)
+            result.figures.append(path)
+        except Exception as e:
+            result.error = result.error or f"Could not save figure: {e}"
+    plt.close("all")
+    return result
+
+
+def _worker_main(
+    conn, csv_path: str, figure_dir: str, memory_limit: Optional[int]
+) -> None:
+    """Loads the frame once, then runs the scripts received on `conn` until it receives None."""
+    try:
+        import matplotlib
+
+        matplotlib.use("Agg")
+        import matplotlib.pyplot as plt
+        import numpy as np
+        import pandas
+
+        # loads the backend before the memory cap
+        plt.close(plt.figure())
+
+        from utils.dataframe import load_dataframe, writable_frame
+
+        # memory-mapped from the columnar cache, so the numeric columns are shared by the workers
+        df, report = load_dataframe(csv_path)
+        fingerprint = report.fingerprint
+        globals_ = {"pd": pandas, "pandas": pandas, "np": np, "plt": plt}
+        try:
+            import seaborn
+
+            globals_["sns"] = seaborn
+        except ImportError:
+            pass
+        _limit_memory(memory_limit)
+    except BaseException as e:
+        conn.send(("error", f"{type(e).__name__}: {e}"))
+        return
+    conn.send(("ready", None))
+
+    while True:
+        try:
+            request = conn.recv()
+        except EOFError:
+            return
+        if request is None:
+            return
+        script, version = request
+        start = time.perf_counter()
+        if version is not None and version != fingerprint:
+            # the CSV changed, its cache was rebuilt by the parent
+            try:
+                df, report = load_dataframe(csv_path)
+                fingerprint = report.fingerprint
+            except BaseException as e:
+                conn.send(
+                    (
+                        "result",
+                        ScriptResult(error=f"Could not reload the data: {e!r}"),
+                    )
+                )
+                continue
+        # the mapped frame is read-only, and a script's changes must not leak to the next one
+        try:
+            namespace = {**globals_, "df": writable_frame(df)}
+        except MemoryError:
+            conn.send(
+                (
+                    "result",
+                    ScriptResult(
+                        error="MemoryError: the frame does not fit in the memory limit"
+                    ),
+                )
+            )
+            continue
+        result = _run_script(script, namespace, figure_dir)
+        result.duration = time.perf_counter() - start
+        conn.send(("result", result))
+
+
+class _Worker:
+    def __init__(
+        self, context, csv_path: str, figure_dir: str, memory_limit: Optional[int]
+    ):
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(
+            target=_worker_main,
+            args=(child_conn, csv_path, figure_dir, memory_limit),
+            daemon=True,
+        )
+        self.process.start()
+        child_conn.close()
+        self.ready = False
+
+    def wait_ready(self) -> Optional[str]:
+        """Waits for the frame to be loaded, returning the error of the worker if it failed."""
+        if self.ready:
+            return None
+        if not self.conn.poll(STARTUP_TIMEOUT):
+            return f"worker did not start within {STARTUP_TIMEOUT:.0f}s"
+        try:
+            status, error = self.conn.recv()
+        except EOFError:
+            return f"worker exited with code {self.process.exitcode}"
+        self.ready = status == "ready"
+        return error
+
+    def kill(self) -> None:
+        self.process.kill()
+        self.process.join()
+        self.conn.close()
+
+
+class ScriptExecutor:
+    """
+    Pool of worker processes running Python scripts on a DataFrame.
+
+    The workers are started with the pool and load the frame once, from the
+    columnar cache of `utils.dataframe.load_dataframe`, which they memory-map:
+    the numeric columns are shared through the page cache rather than copied
+    into each worker. Every script gets `df`, a writable copy of the frame
+    with int64 integers, see `writable_frame`, along with `pd`, `np` and
+    `plt`. It runs with a timeout and a memory cap, the copy included, and
+    returns what it printed, the value of its last expression and the figures
+    it drew. Changes a script makes to `df` are not seen by the next one. A
+    script that times out or crashes its worker only loses that worker, which
+    is replaced.
+
+    `run` may be called from several threads, up to `workers` scripts running
+    in parallel.
+
+    Attributes:
+        csv_path (str): The CSV of the frame.
+        workers (int): The number of worker processes.
+        timeout (Optional[float]): The wall time a script may run, in seconds, None for no limit.
+        memory_limit (Optional[int]): The memory a script may allocate on top of its loaded worker, in bytes,
+            None for no limit.
+        figure_dir (str): The folder the figures are saved to.
+    """
+
+    csv_path: str
+    workers: int
+    timeout: Optional[float]
+    memory_limit: Optional[int]
+    figure_dir: str
+
+    def __init__(
+        self,
+        csv_path: str,
+        workers: int = 2,
+        timeout: Optional[float] = 30.0,
+        memory_limit: Optional[int] = 1 << 30,
+        figure_dir: str = os.path.join(".", "figures"),
+    ) -> None:
+        """
+        Starts the worker processes.
+
+        Args:
+            csv_path (str): The CSV of the frame. Its columnar cache should be built beforehand, e.g. by
+                `load_dataframe`, so that the workers do not all build it.
+            workers (int, optional): The number of worker processes. Defaults to 2.
+            timeout (float, optional): The wall time a script may run, in seconds, None for no limit. Defaults to 30.
+            memory_limit (int, optional): The memory a script may allocate, in bytes, None for no limit.
+                Defaults to 1 GiB.
+            figure_dir (str, optional): The folder the figures are saved to. Defaults to "./figures".
+        """
+        self.csv_path = csv_path
+        self.workers = max(workers, 1)
+        self.timeout = timeout
+        self.memory_limit = memory_limit
+        self.figure_dir = os.path.abspath(figure_dir)
+        os.makedirs(self.figure_dir, exist_ok=True)
+        # spawned rather than forked, as the parent process runs threads
+        self._context = multiprocessing.get_context("spawn")
+        self._lock = threading.Lock()
+        self._closed = False
+        self._all: List[_Worker] = []
+        self._idle: "queue.Queue[_Worker]" = queue.Queue()
+        for _ in range(self.workers):
+            self._idle.put(self._start_worker())
+
+    def _start_worker(self) -> _Worker:
+        worker = _Worker(
+            self._context, self.csv_path, self.figure_dir, self.memory_limit
+        )
+        with self._lock:
+            self._all.append(worker)
+        return worker
+
+    def _replace(self, worker: _Worker) -> None:
+        worker.kill()
+        with self._lock:
+            self._all.remove(worker)
+            closed = self._closed
+        if not closed:
+            self._idle.put(self._start_worker())
+
+    def run(self, script: str, fingerprint: Optional[str] = None) -> ScriptResult:
+        """
+        Runs a script on the frame, waiting for a free worker.
+
+        Args:
+            script (str): The Python script, `df` being the frame.
+            fingerprint (str, optional): The fingerprint of the current frame, see `FrameSource`.
+                A worker holding another version reloads the frame first. Defaults to None.
+
+        Returns:
+            ScriptResult: What the script printed, returned and drew, or its error.
+        """
+        if self._closed:
+            raise RuntimeError("the executor is closed")
+        worker = self._idle.get()
+        error = worker.wait_ready()
+        if error is not None or not worker.ready:
+            self._replace(worker)
+            return ScriptResult(error=f"Could not start the worker: {error}")
+
+        start = time.perf_counter()
+        try:
+            worker.conn.send((script, fingerprint))
+            if not worker.conn.poll(self.timeout):
+                self._replace(worker)
+                return ScriptResult(
+                    error=f"TimeoutError: the script did not finish within {self.timeout:.0f}s",
+                    duration=time.perf_counter() - start,
+                )
+            _, result = worker.conn.recv()
+        except (EOFError, OSError):
+            # killed, e.g. by the OOM killer, or crashed
+            self._replace(worker)
+            return ScriptResult(
+                error=f"the worker running the script exited with code {worker.process.exitcode}",
+                duration=time.perf_counter() - start,
+            )
+        self._idle.put(worker)
+        return result
+
+    def close(self) -> None:
+        """Stops the worker processes, the running scripts included."""
+        with self._lock:
+            self._closed = True
+            workers, self._all = self._all, []
+        for worker in workers:
+            try:
+                worker.conn.send(None)
+            except OSError:
+                pass
+            worker.process.join(timeout=1)
+            if worker.process.is_alive():
+                worker.kill()
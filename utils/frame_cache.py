@@ -0,0 +1,245 @@
+import ast
+import pickle
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+import numpy as np
+import pandas
+from llama_index.core.output_parsers.utils import parse_code_markdown
+from llama_index.core.types import BaseOutputParser
+
+from utils.dataframe import FrameSource, writable_frame
+
+# the prefix of the results of code that failed, which are not cached
+ERROR_PREFIX = "There was an error running the output as Python code."
+
+
+def normalize_script(script: str) -> str:
+    """
+    Normalizes a pandas script, so that equivalent scripts share a cache entry.
+
+    Comments, blank lines, indentation, spacing and quotes are normalized by
+    round-tripping the script through its syntax tree.
+
+    Args:
+        script (str): The script.
+
+    Returns:
+        str: The normalized script, the script with collapsed whitespace if it does not parse.
+    """
+    try:
+        return ast.unparse(ast.parse(script.strip()))
+    except (SyntaxError, ValueError):
+        return " ".join(script.split())
+
+
+def estimate_size(value: Any) -> int:
+    """
+    Estimates the memory held by a cached result.
+
+    Args:
+        value (Any): The result, usually text or a frame.
+
+    Returns:
+        int: The size, in bytes.
+    """
+    if isinstance(value, str):
+        return len(value.encode())
+    if isinstance(value, pandas.DataFrame):
+        return int(value.memory_usage(index=True, deep=True).sum())
+    if isinstance(value, pandas.Series):
+        return int(value.memory_usage(index=True, deep=True))
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    try:
+        return len(pickle.dumps(value))
+    except Exception:
+        return len(str(value).encode())
+
+
+class ResultCache:
+    """
+    Cache of the results of pandas scripts, bounded by size.
+
+    Results are keyed by the normalized script and the fingerprint of the
+    frame it ran on, see `FrameSource`, so that a result is never served for
+    another version of the data. With the source of the frame, results of a
+    version other than the current one are not stored, e.g. those of scripts
+    that were running while the data changed, and the results of previous
+    versions are dropped once a result of the current one is stored. The
+    least recently used results are evicted once the cache holds more than
+    `max_bytes`.
+
+    Attributes:
+        max_bytes (int): The maximum size of the cached results and their scripts.
+        hits (int): The number of hits.
+        misses (int): The number of misses.
+    """
+
+    max_bytes: int
+    hits: int
+    misses: int
+
+    def __init__(
+        self, max_bytes: int = 64 << 20, source: Optional[FrameSource] = None
+    ) -> None:
+        """
+        Creates an empty cache.
+
+        Args:
+            max_bytes (int, optional): The maximum size of the cached results and their scripts. Defaults to 64 MiB.
+            source (FrameSource, optional): The source of the frame, telling its current version. Defaults to None.
+        """
+        self.max_bytes = max_bytes
+        self.hits = self.misses = 0
+        self._source = source
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[Tuple[str, str], Tuple[Any, int]]" = OrderedDict()
+        self._bytes = 0
+        # the fingerprint of the frame of the cached results
+        self._fingerprint: Optional[str] = None
+
+    @property
+    def size(self) -> int:
+        """The size of the cached results and their scripts, in bytes."""
+        return self._bytes
+
+    def lookup(self, fingerprint: str, script: str) -> Optional[Any]:
+        """
+        Looks up the result of a script.
+
+        Args:
+            fingerprint (str): The fingerprint of the frame.
+            script (str): The script.
+
+        Returns:
+            Optional[Any]: The cached result, None on a miss.
+        """
+        key = (fingerprint, normalize_script(script))
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def store(
+        self, fingerprint: str, script: str, result: Any, size: Optional[int] = None
+    ) -> None:
+        """
+        Caches the result of a script, evicting the least recently used results beyond `max_bytes`.
+
+        The result is dropped if it was computed on a previous version of the frame.
+
+        Args:
+            fingerprint (str): The fingerprint of the frame.
+            script (str): The script.
+            result (Any): The result.
+            size (int, optional): The size of the result. Defaults to `estimate_size(result)`.
+        """
+        key = (fingerprint, normalize_script(script))
+        size = (estimate_size(result) if size is None else size) + len(key[1])
+        if size > self.max_bytes:
+            return
+        if self._source is not None and fingerprint != self._source.fingerprint:
+            # computed on a previous version of the frame
+            return
+        with self._lock:
+            if self._source is not None and fingerprint != self._fingerprint:
+                self._entries.clear()
+                self._bytes = 0
+                self._fingerprint = fingerprint
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._bytes -= previous[1]
+            self._entries[key] = (result, size)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self._bytes -= evicted
+
+    def invalidate(self) -> None:
+        """Drops every cached result. To be called whenever the frame changes."""
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    @property
+    def stats(self) -> Dict[str, float]:
+        """Returns the hit/miss statistics of the cache."""
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+
+def evaluate_pandas_code(code: str, df: pandas.DataFrame) -> str:
+    """
+    Runs pandas code on a frame, as `PandasQueryEngine` does.
+
+    Every line but the last is executed, then the last one is evaluated.
+
+    Args:
+        code (str): The code, `df` being the frame.
+        df (pandas.DataFrame): The frame.
+
+    Returns:
+        str: The value of the last line, or the error the code raised, starting with `ERROR_PREFIX`.
+    """
+    try:
+        tree = ast.parse(code)
+        global_vars = {"np": np, "pd": pandas}
+        local_vars = {"df": df}
+        exec(ast.unparse(ast.Module(tree.body[:-1], [])), global_vars, local_vars)
+        last = ast.unparse(ast.Module(tree.body[-1:], []))
+        # the LLM may quote the expression
+        if last.strip("'\"") != last:
+            last = ast.literal_eval(last)
+        return str(eval(last, global_vars, local_vars))
+    except Exception as e:
+        return f"{ERROR_PREFIX} Error message: {e}"
+
+
+class CachedPandasParser(BaseOutputParser):
+    """
+    Instruction parser of `PandasQueryEngine`, running the generated code through a `ResultCache`.
+
+    Equivalent code generated for different questions is only run once per
+    version of the frame. The code runs on a `writable_frame` of the frame, so
+    that it may modify it without changing the results of later code.
+    """
+
+    def __init__(
+        self, df: pandas.DataFrame, fingerprint: str, cache: ResultCache
+    ) -> None:
+        """
+        Creates the parser.
+
+        Args:
+            df (pandas.DataFrame): The frame.
+            fingerprint (str): The fingerprint of the frame.
+            cache (ResultCache): The cache to serve results from.
+        """
+        self.df = df
+        self.fingerprint = fingerprint
+        self.cache = cache
+
+    def parse(self, output: str) -> Any:
+        """Runs the code of an LLM output, unless its result is cached."""
+        code = parse_code_markdown(output, only_last=True)
+        # a string for a fenced block, a list otherwise
+        code = (code if isinstance(code, str) else code[0]).strip()
+        cached = self.cache.lookup(self.fingerprint, code)
+        if cached is not None:
+            return cached
+        result = evaluate_pandas_code(code, writable_frame(self.df))
+        if not result.startswith(ERROR_PREFIX):
+            self.cache.store(self.fingerprint, code, result)
+        return result
@@ -0,0 +1,499 @@
+import itertools
+import re
+import time
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+import pandas
+
+from utils.dataframe import FrameSource
+
+AGGREGATIONS = ("count", "sum", "mean", "min", "max")
+# e.g. "furnishingstatus=furnished", "bedrooms >= 3" or "price<5000000"
+FILTER_PATTERN = re.compile(r"^\s*(\w+)\s*(==|!=|>=|<=|=|>|<)\s*(.+?)\s*$")
+# the number of set bits of every byte
+_POPCOUNT = np.array([bin(byte).count("1") for byte in range(256)], dtype=np.uint8)
+
+
+@dataclass
+class Filter:
+    """
+    A condition on a column.
+
+    Attributes:
+        column (str): The column.
+        op (str): The comparison, one of "=", "!=", ">", ">=", "<" and "<=".
+        value (str): The value, as written by the agent.
+    """
+
+    column: str
+    op: str
+    value: str
+
+
+def parse_filters(text: Optional[str]) -> List[Filter]:
+    """
+    Parses conditions such as "furnishingstatus=furnished, bedrooms>=3".
+
+    Args:
+        text (Optional[str]): The conditions, separated by commas or "and".
+
+    Returns:
+        List[Filter]: The conditions.
+    """
+    filters = []
+    for part in re.split(r",|\band\b", text or ""):
+        if not part.strip():
+            continue
+        match = FILTER_PATTERN.match(part)
+        if match is None:
+            raise ValueError(f"Cannot parse the condition {part.strip()!r}")
+        column, op, value = match.groups()
+        filters.append(Filter(column, "=" if op == "==" else op, value.strip("'\"")))
+    return filters
+
+
+@dataclass
+class IndexAnswer:
+    """
+    The answer of a `FrameIndex`.
+
+    Attributes:
+        value (Any): The aggregate, a number, or a Series indexed by the groups.
+        source (str): What answered, "summary", "sorted index" or "bitmap index".
+        rows (int): The number of rows matching the filters.
+        duration (float): Wall time of the lookup, in seconds.
+    """
+
+    value: Any
+    source: str
+    rows: int
+    duration: float
+
+    def __str__(self) -> str:
+        value = self.value
+        if isinstance(value, pandas.Series):
+            value = value.to_string(max_rows=100)
+        elif isinstance(value, (float, np.floating)):
+            value = f"{value:.6g}"
+        return (
+            f"{value}\n({self.rows} matching rows, from the {self.source}"
+            f" in {self.duration * 1e6:.0f}µs)"
+        )
+
+
+class FrameIndex:
+    """
+    Aggregates and indexes of a DataFrame, materialized once to answer filtered group-bys without a scan.
+
+    The columns with few distinct values are the group columns. For every
+    group column, and every pair of them, the count, sum, mean, min and max of
+    every numeric column are materialized, along with the overall ones. Every
+    value of a group column gets a bitmap of its rows, and every numeric
+    column a sorted index with prefix sums.
+
+    A query whose equality conditions and group-by span at most two group
+    columns is a lookup in the summaries. Range conditions on the aggregated
+    column alone are answered from its sorted index by binary search. Other
+    queries combine the bitmaps and sorted ranges of their conditions, then
+    aggregate the matching rows only.
+
+    Attributes:
+        fingerprint (str): The fingerprint of the frame, see `FrameSource`.
+        rows (int): The number of rows.
+        group_columns (List[str]): The columns with at most `max_group_cardinality` distinct values.
+        measures (List[str]): The numeric columns.
+        build_time (float): Wall time of the materialization, in seconds.
+    """
+
+    fingerprint: str
+    rows: int
+    group_columns: List[str]
+    measures: List[str]
+    build_time: float
+
+    def __init__(
+        self,
+        df: pandas.DataFrame,
+        fingerprint: str = "",
+        max_group_cardinality: int = 64,
+    ) -> None:
+        """
+        Materializes the aggregates and indexes of a frame.
+
+        Args:
+            df (pandas.DataFrame): The frame.
+            fingerprint (str, optional): The fingerprint of the frame. Defaults to "".
+            max_group_cardinality (int, optional): The maximum number of distinct values of a group column.
+                Defaults to 64.
+        """
+        start = time.perf_counter()
+        self.fingerprint = fingerprint
+        self.rows = len(df)
+        self.group_columns = []
+        self.measures = []
+        for name, column in df.items():
+            numeric = pandas.api.types.is_numeric_dtype(
+                column.dtype
+            ) and not pandas.api.types.is_bool_dtype(column.dtype)
+            if numeric:
+                self.measures.append(name)
+            if (
+                not numeric or pandas.api.types.is_integer_dtype(column.dtype)
+            ) and column.nunique(dropna=True) <= max_group_cardinality:
+                self.group_columns.append(name)
+
+        # bitmaps of the rows of every value of the group columns
+        self._codes: Dict[str, np.ndarray] = {}
+        self._keys: Dict[str, List[Any]] = {}
+        self._bitmaps: Dict[str, List[np.ndarray]] = {}
+        for name in self.group_columns:
+            codes, keys = pandas.factorize(df[name], sort=True)
+            self._codes[name] = codes
+            self._keys[name] = list(keys)
+            self._bitmaps[name] = [
+                np.packbits(codes == code) for code in range(len(keys))
+            ]
+
+        # sorted values and their prefix sums, NaNs excluded
+        self._values: Dict[str, np.ndarray] = {}
+        self._sorted: Dict[str, Tuple[np.ndarray, np.ndarray, np.ndarray]] = {}
+        for name in self.measures:
+            values = df[name].to_numpy(dtype=np.float64)
+            order = np.argsort(values, kind="stable")
+            order = order[~np.isnan(values[order])]
+            sorted_values = values[order]
+            prefix = np.concatenate(([0.0], np.cumsum(sorted_values)))
+            self._values[name] = values
+            self._sorted[name] = (sorted_values, order, prefix)
+
+        # aggregates overall, by group column and by pair of group columns
+        totals = df[self.measures].agg(list(AGGREGATIONS))
+        self._totals = {
+            (measure, agg): totals.at[agg, measure]
+            for measure in self.measures
+            for agg in AGGREGATIONS
+        }
+        self._summaries: Dict[Tuple[str, ...], pandas.DataFrame] = {}
+        self._sizes: Dict[Tuple[str, ...], pandas.Series] = {}
+        # the columns of the summaries as arrays, for the lookups of a single group
+        self._arrays: Dict[Tuple[str, ...], Dict[Any, np.ndarray]] = {}
+        self._positions: Dict[Tuple[str, ...], Dict[Tuple[Any, ...], int]] = {}
+        self._slices: Dict[
+            Tuple[Tuple[str, ...], str, Any],
+            Tuple[pandas.Series, Optional[pandas.DataFrame]],
+        ] = {}
+        combinations = [(name,) for name in self.group_columns] + list(
+            itertools.combinations(self.group_columns, 2)
+        )
+        for combination in combinations:
+            grouped = df.groupby(list(combination), observed=True, sort=True)
+            measures = [name for name in self.measures if name not in combination]
+            if measures:
+                self._summaries[combination] = grouped[measures].agg(list(AGGREGATIONS))
+            self._sizes[combination] = grouped.size()
+            self._arrays[combination] = {
+                "size": self._sizes[combination].to_numpy(),
+                **(
+                    {
+                        column: self._summaries[combination][column].to_numpy()
+                        for column in self._summaries[combination].columns
+                    }
+                    if measures
+                    else {}
+                ),
+            }
+            # the position of every group, and for pairs, the slices by value of either column
+            self._positions[combination] = {
+                (key if isinstance(key, tuple) else (key,)): position
+                for position, key in enumerate(self._sizes[combination].index)
+            }
+            if len(combination) == 2:
+                summary = self._summaries.get(combination)
+                for name in combination:
+                    for key, sizes in self._sizes[combination].groupby(
+                        level=name, observed=True
+                    ):
+                        self._slices[(combination, name, key)] = (
+                            sizes.droplevel(name),
+                            (
+                                summary.xs(key, level=name)
+                                if summary is not None
+                                else None
+                            ),
+                        )
+        self.build_time = time.perf_counter() - start
+
+    def _key(self, column: str, value: str) -> Any:
+        for key in self._keys[column]:
+            if str(key).lower() == value.lower():
+                return key
+        raise ValueError(
+            f"{value!r} is not a value of {column}, which has "
+            + ", ".join(map(str, self._keys[column]))
+        )
+
+    def _range(self, filter_: Filter) -> Tuple[int, int]:
+        """The positions of the matching rows in the sorted index of the filtered column."""
+        sorted_values = self._sorted[filter_.column][0]
+        value = float(filter_.value)
+        lo, hi = 0, len(sorted_values)
+        if filter_.op in ("=", ">="):
+            lo = int(np.searchsorted(sorted_values, value, side="left"))
+        elif filter_.op == ">":
+            lo = int(np.searchsorted(sorted_values, value, side="right"))
+        if filter_.op in ("=", "<="):
+            hi = int(np.searchsorted(sorted_values, value, side="right"))
+        elif filter_.op == "<":
+            hi = int(np.searchsorted(sorted_values, value, side="left"))
+        return lo, max(lo, hi)
+
+    def _bitmap(self, filter_: Filter) -> np.ndarray:
+        column = filter_.column
+        if column in self._bitmaps and filter_.op in ("=", "!="):
+            bitmap = self._bitmaps[column][
+                self._keys[column].index(self._key(column, filter_.value))
+            ]
+            if filter_.op == "!=":
+                bitmap = np.packbits(~np.unpackbits(bitmap, count=self.rows).view(bool))
+            return bitmap
+        if column not in self._sorted:
+            raise ValueError(f"{column} is not numeric, only = and != apply")
+        if filter_.op == "!=":
+            return np.packbits(self._values[column] != float(filter_.value))
+        lo, hi = self._range(filter_)
+        mask = np.zeros(self.rows, dtype=bool)
+        mask[self._sorted[column][1][lo:hi]] = True
+        return np.packbits(mask)
+
+    def _from_summary(
+        self,
+        measure: Optional[str],
+        agg: str,
+        group_by: List[str],
+        filters: List[Filter],
+    ) -> Optional[Tuple[Any, int]]:
+        columns = set(group_by) | {filter_.column for filter_ in filters}
+        if (
+            any(
+                filter_.op != "=" or filter_.column not in self._keys
+                for filter_ in filters
+            )
+            or len(columns) > 2
+            or len(columns) != len(group_by) + len(filters)
+        ):
+            return None
+        if not columns:
+            rows = self.rows
+            if measure is None:
+                return rows, rows
+            return self._totals[(measure, agg)], rows
+
+        combination = tuple(name for name in self.group_columns if name in columns)
+        if measure is not None and measure in combination:
+            return None
+        keys = {
+            filter_.column: self._key(filter_.column, filter_.value)
+            for filter_ in filters
+        }
+        summary = self._summaries.get(combination)
+        if not group_by:
+            position = self._positions[combination].get(
+                tuple(keys[name] for name in combination)
+            )
+            if position is None:
+                empty = measure is None or agg in ("count", "sum")
+                return (0 if empty else np.nan), 0
+            arrays = self._arrays[combination]
+            rows = int(arrays["size"][position])
+            if measure is None:
+                return rows, rows
+            return arrays[(measure, agg)][position], rows
+        if filters:
+            # the slice of the pair summary for the value of the filtered column
+            (filter_,) = filters
+            sizes, summary = self._slices.get(
+                (combination, filter_.column, keys[filter_.column]), (None, None)
+            )
+            if sizes is None:
+                return pandas.Series(dtype=np.float64), 0
+        else:
+            sizes = self._sizes[combination]
+        table = sizes if measure is None else summary[(measure, agg)]
+        if len(group_by) == 2 and list(combination) != group_by:
+            # the levels in the requested order, as on the other paths
+            table = table.reorder_levels(group_by).sort_index()
+        return table, int(sizes.sum())
+
+    def _from_sorted_index(
+        self, measure: Optional[str], agg: str, filters: List[Filter]
+    ) -> Optional[Tuple[Any, int]]:
+        columns = {filter_.column for filter_ in filters}
+        if len(columns) != 1 or any(filter_.op == "!=" for filter_ in filters):
+            return None
+        (column,) = columns
+        if column not in self._sorted or measure not in (None, column):
+            return None
+        sorted_values, _, prefix = self._sorted[column]
+        # the intersection of the ranges, e.g. of "price>5000000, price<=6000000"
+        lo, hi = 0, len(sorted_values)
+        for filter_ in filters:
+            start, end = self._range(filter_)
+            lo, hi = max(lo, start), min(hi, end)
+        hi = max(lo, hi)
+        count = hi - lo
+        if measure is None or agg == "count":
+            return count, count
+        if count == 0:
+            return (0.0 if agg == "sum" else np.nan), 0
+        total = prefix[hi] - prefix[lo]
+        value = {
+            "sum": total,
+            "mean": total / count,
+            "min": sorted_values[lo],
+            "max": sorted_values[hi - 1],
+        }[agg]
+        return value, count
+
+    def _from_bitmaps(
+        self,
+        measure: Optional[str],
+        agg: str,
+        group_by: List[str],
+        filters: List[Filter],
+    ) -> Tuple[Any, int]:
+        bitmap = None
+        for filter_ in filters:
+            other = self._bitmap(filter_)
+            bitmap = other if bitmap is None else np.bitwise_and(bitmap, other)
+        if bitmap is None:
+            bitmap = np.packbits(np.ones(self.rows, dtype=bool))
+        rows = int(_POPCOUNT[bitmap].sum())
+        if measure is None and not group_by:
+            return rows, rows
+
+        mask = np.unpackbits(bitmap, count=self.rows).view(bool)
+        values = (
+            self._values[measure][mask]
+            if measure is not None
+            else np.ones(rows, dtype=np.float64)
+        )
+        if measure is None:
+            agg = "count"
+        if not group_by:
+            if agg == "count":
+                return int(np.count_nonzero(~np.isnan(values))), rows
+            if not np.any(~np.isnan(values)):
+                return (0.0 if agg == "sum" else np.nan), rows
+            return getattr(np, f"nan{agg}")(values), rows
+        keys = [
+            pandas.Categorical.from_codes(
+                self._codes[name][mask], categories=self._keys[name]
+            )
+            for name in group_by
+        ]
+        series = pandas.Series(values).groupby(keys, observed=True).agg(agg)
+        series.index.names = group_by
+        return series, rows
+
+    def query(
+        self,
+        measure: Optional[str] = None,
+        agg: str = "count",
+        group_by: Sequence[str] = (),
+        filters: Sequence[Filter] = (),
+    ) -> IndexAnswer:
+        """
+        Aggregates a column over the rows matching conditions, optionally by group.
+
+        Args:
+            measure (str, optional): The numeric column to aggregate, None to count the rows. Defaults to None.
+            agg (str, optional): One of "count", "sum", "mean", "min" and "max". Defaults to "count".
+            group_by (Sequence[str], optional): Up to two group columns. Defaults to none.
+            filters (Sequence[Filter], optional): The conditions, all of which the rows must match. Defaults to none.
+
+        Returns:
+            IndexAnswer: The aggregate, and what answered it.
+        """
+        start = time.perf_counter()
+        group_by, filters = list(group_by), list(filters)
+        if agg not in AGGREGATIONS:
+            raise ValueError(f"agg must be one of {', '.join(AGGREGATIONS)}")
+        if measure is not None and measure not in self._sorted:
+            raise ValueError(
+                f"{measure} is not a numeric column, which are {', '.join(self.measures)}"
+            )
+        for name in group_by:
+            if name not in self._keys:
+                raise ValueError(
+                    f"{name} cannot be grouped by, the group columns are {', '.join(self.group_columns)}"
+                )
+        if len(group_by) > 2:
+            raise ValueError("group by at most two columns")
+        for filter_ in filters:
+            if filter_.column not in self._keys and filter_.column not in self._sorted:
+                raise ValueError(f"{filter_.column} is not a column")
+
+        answer = self._from_summary(measure, agg, group_by, filters)
+        source = "summary"
+        if answer is None and not group_by and filters:
+            answer = self._from_sorted_index(measure, agg, filters)
+            source = "sorted index"
+        if answer is None:
+            answer = self._from_bitmaps(measure, agg, group_by, filters)
+            source = "bitmap index"
+        value, rows = answer
+        return IndexAnswer(value, source, rows, time.perf_counter() - start)
+
+
+def query_frame_index(
+    source: FrameSource, index: Optional[FrameIndex] = None
+) -> Callable[..., str]:
+    """
+    Create the tool function answering aggregate questions from the index of a frame.
+
+    The index is rebuilt once the CSV of the frame changes.
+
+    Args:
+        source (FrameSource): The frame.
+        index (Optional[FrameIndex]): The index of the current frame. Defaults to building it.
+    """
+    state = {"index": index}
+
+    def fn(
+        measure: Optional[str] = None,
+        agg: str = "count",
+        group_by: Optional[str] = None,
+        filters: Optional[str] = None,
+    ) -> str:
+        """
+        Aggregate a column of the data, optionally by group and over the rows matching conditions.
+
+        Args:
+            measure (Optional[str]): The numeric column to aggregate, none to count the rows.
+            agg (str): One of "count", "sum", "mean", "min" and "max".
+            group_by (Optional[str]): Up to two columns to group by, separated by a comma.
+            filters (Optional[str]): Conditions such as "furnishingstatus=furnished, bedrooms>=3, price<5000000".
+        """
+        source.refresh()
+        index = state["index"]
+        if index is None or index.fingerprint != source.fingerprint:
+            index = state["index"] = FrameIndex(source.df, source.fingerprint)
+        try:
+            return str(
+                index.query(
+                    measure or None,
+                    agg,
+                    [
+                        name.strip()
+                        for name in (group_by or "").split(",")
+                        if name.strip()
+                    ],
+                    parse_filters(filters),
+                )
+            )
+        except ValueError as e:
+            return f"Error: {e}"
+
+    return fn
@@ -0,0 +1,274 @@
+import asyncio
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional, Tuple
+
+from llama_index.core import VectorStoreIndex
+from llama_index.core.base.base_query_engine import BaseQueryEngine
+from llama_index.core.base.response.schema import RESPONSE_TYPE
+from llama_index.core.prompts.mixin import PromptMixinType
+from llama_index.core.schema import QueryBundle
+
+from utils.tracing import trace_span
+
+
+def estimate_index_size(index: VectorStoreIndex) -> int:
+    """
+    Estimates the memory held in process by the embeddings of an index.
+
+    Chroma collections count for nothing: their HNSW segments are held by the
+    shared Chroma client, which keeps them whether or not the index is loaded,
+    so that evicting the index would free nothing.
+
+    Args:
+        index (VectorStoreIndex): The index.
+
+    Returns:
+        int: The estimated size, in bytes. 0 if the vector store is not supported.
+    """
+    vector_store = index.vector_store
+    # in-process stores keep a single matrix
+    matrix = getattr(vector_store, "_matrix", None)
+    if matrix is not None:
+        return matrix.nbytes
+    # the simple vector store keeps lists of python floats
+    embedding_dict = getattr(getattr(vector_store, "data", None), "embedding_dict", {})
+    if embedding_dict:
+        dim = len(next(iter(embedding_dict.values())))
+        return len(embedding_dict) * dim * 32
+    return 0
+
+
+@dataclass
+class RegistryEntry:
+    """
+    A loaded index.
+
+    Attributes:
+        index (VectorStoreIndex): The index.
+        size (int): The estimated memory held by the index, in bytes.
+        last_use (float): The time of the last use, as returned by `time.monotonic`.
+    """
+
+    index: VectorStoreIndex
+    size: int
+    last_use: float
+
+
+class IndexRegistry:
+    """
+    Indices loaded on first use, kept warm, and evicted when idle or over a memory budget.
+
+    Every key is loaded at most once at a time, while different keys load
+    concurrently. When the loaded indices exceed the memory budget, the least
+    recently used ones are evicted; an index in use by a running query stays
+    alive until the query completes, and is loaded again on its next use.
+
+    The budget only bounds the indices whose embeddings are held in process,
+    i.e. the numpy and simple vector stores, see `estimate_index_size`. Chroma
+    keeps the segments of its collections in the cache of its client, which
+    evicting an index does not release.
+
+    Attributes:
+        memory_budget (int, optional): The memory the loaded indices may hold, in bytes. None for no limit.
+        idle_ttl (float, optional): The idle time after which an index is evicted, in seconds. None for no limit.
+        loads (int): The number of indices loaded.
+        evictions (int): The number of indices evicted.
+    """
+
+    memory_budget: Optional[int]
+    idle_ttl: Optional[float]
+    loads: int
+    evictions: int
+
+    def __init__(
+        self,
+        load: Callable[[str], VectorStoreIndex],
+        memory_budget: Optional[int] = None,
+        idle_ttl: Optional[float] = None,
+        sizeof: Callable[[VectorStoreIndex], int] = estimate_index_size,
+    ) -> None:
+        """
+        Creates an empty registry.
+
+        Args:
+            load (Callable[[str], VectorStoreIndex]): Loads the index of a key.
+            memory_budget (int, optional): The memory the loaded indices may hold, in bytes. Defaults to no limit.
+            idle_ttl (float, optional): The idle time after which an index is evicted, in seconds. Defaults to no limit.
+            sizeof (Callable[[VectorStoreIndex], int], optional): Estimates the memory held by an index.
+                Defaults to `estimate_index_size`.
+        """
+        self._load = load
+        self.memory_budget = memory_budget
+        self.idle_ttl = idle_ttl
+        self._sizeof = sizeof
+        self.loads = self.evictions = 0
+
+        self._lock = threading.Lock()
+        # loaded indices, in least recently used order
+        self._entries: "OrderedDict[str, RegistryEntry]" = OrderedDict()
+        self._key_locks: Dict[str, threading.Lock] = {}
+
+    def keys(self) -> List[str]:
+        """Returns the keys of the loaded indices."""
+        with self._lock:
+            return list(self._entries)
+
+    @property
+    def loaded_size(self) -> int:
+        """The estimated memory held by the loaded indices, in bytes."""
+        with self._lock:
+            return sum(entry.size for entry in self._entries.values())
+
+    def touch(self, key: str) -> Optional[VectorStoreIndex]:
+        """
+        Returns the index of a key if it is loaded, marking it as used.
+
+        Args:
+            key (str): The key.
+
+        Returns:
+            Optional[VectorStoreIndex]: The index, None if it is not loaded.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            entry.last_use = time.monotonic()
+            self._entries.move_to_end(key)
+            return entry.index
+
+    def get(self, key: str) -> VectorStoreIndex:
+        """
+        Returns the index of a key, loading it if needed.
+
+        Args:
+            key (str): The key.
+
+        Returns:
+            VectorStoreIndex: The index.
+        """
+        index = self.touch(key)
+        if index is None:
+            with self._lock:
+                key_lock = self._key_locks.setdefault(key, threading.Lock())
+            with key_lock:
+                # another thread may have loaded it meanwhile
+                index = self.touch(key)
+                if index is None:
+                    with trace_span("index.load", key=key):
+                        index = self._load(key)
+                    self.put(key, index)
+                    with self._lock:
+                        self.loads += 1
+        self.evict()
+        return index
+
+    def put(self, key: str, index: VectorStoreIndex) -> None:
+        """
+        Registers an already loaded index.
+
+        Args:
+            key (str): The key.
+            index (VectorStoreIndex): The index.
+        """
+        entry = RegistryEntry(index, self._sizeof(index), time.monotonic())
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+
+    def evict(self) -> List[str]:
+        """
+        Evicts the idle indices, then the least recently used ones until the budget is met.
+
+        The most recently used index is never evicted for the budget.
+
+        Returns:
+            List[str]: The keys of the evicted indices.
+        """
+        evicted = []
+        with self._lock:
+            if self.idle_ttl is not None:
+                deadline = time.monotonic() - self.idle_ttl
+                evicted += [
+                    key
+                    for key, entry in self._entries.items()
+                    if entry.last_use < deadline
+                ]
+                for key in evicted:
+                    del self._entries[key]
+            if self.memory_budget is not None:
+                size = sum(entry.size for entry in self._entries.values())
+                while size > self.memory_budget and len(self._entries) > 1:
+                    key, entry = self._entries.popitem(last=False)
+                    size -= entry.size
+                    evicted.append(key)
+            self.evictions += len(evicted)
+        return evicted
+
+
+class LazyQueryEngine(BaseQueryEngine):
+    """
+    Query engine resolving the engine doing the actual work on first use.
+
+    With a registry, the resolved engine is kept as long as the index of its
+    key stays loaded, and resolved again once the index is evicted.
+    Otherwise, it is resolved on every query. Asynchronous queries resolve the
+    engine on a worker thread, so that loading an index does not block the
+    event loop.
+    """
+
+    def __init__(
+        self,
+        resolve: Callable[[], BaseQueryEngine],
+        registry: Optional[IndexRegistry] = None,
+        key: Optional[str] = None,
+    ) -> None:
+        """
+        Creates the engine.
+
+        Args:
+            resolve (Callable[[], BaseQueryEngine]): Returns the engine to run a query with.
+            registry (IndexRegistry, optional): The registry of the index the engine queries. Defaults to None.
+            key (str, optional): The key of the index in the registry. Defaults to None.
+        """
+        self._resolve = resolve
+        self._registry = registry
+        self._key = key
+        # the resolved engine, and the index it was resolved with
+        self._resolved: Optional[Tuple[VectorStoreIndex, BaseQueryEngine]] = None
+        super().__init__(callback_manager=None)
+
+    def _get_prompt_modules(self) -> PromptMixinType:
+        return {}
+
+    def _cached_engine(self) -> Optional[BaseQueryEngine]:
+        resolved = self._resolved
+        if resolved is not None and self._registry.touch(self._key) is resolved[0]:
+            return resolved[1]
+        return None
+
+    def _engine(self) -> BaseQueryEngine:
+        if self._registry is None:
+            return self._resolve()
+        engine = self._cached_engine()
+        if engine is not None:
+            return engine
+        engine = self._resolve()
+        # loaded by the resolution
+        index = self._registry.touch(self._key)
+        if index is not None:
+            self._resolved = (index, engine)
+        return engine
+
+    def _query(self, query_bundle: QueryBundle) -> RESPONSE_TYPE:
+        return self._engine().query(query_bundle)
+
+    async def _aquery(self, query_bundle: QueryBundle) -> RESPONSE_TYPE:
+        engine = self._cached_engine() if self._registry is not None else None
+        if engine is None:
+            # loading an index hashes and may re-embed its files, off the event loop
+            engine = await asyncio.to_thread(self._engine)
+        return await engine.aquery(query_bundle)
@@ -0,0 +1,444 @@
+import multiprocessing
+import os
+import resource
+import sys
+import threading
+import time
+from collections import deque
+from concurrent.futures import (
+    Executor,
+    Future,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+)
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import dataclass, field
+from html.parser import HTMLParser
+from pathlib import Path
+from typing import (
+    Callable,
+    Deque,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+)
+
+from llama_index.core import Settings, VectorStoreIndex
+from llama_index.core.base.embeddings.base import BaseEmbedding
+from llama_index.core.schema import Document
+
+from utils.embeddings import count_calls
+
+
+@dataclass
+class BuildReport:
+    """
+    Statistics of a single year's index build.
+
+    Attributes:
+        year (str): The year of the indexed filing.
+        build_time (float): Wall time of the build, in seconds.
+        embedding_calls (int): The number of requests sent to the embedding model.
+        embedded_texts (int): The number of texts embedded.
+    """
+
+    year: str
+    build_time: float
+    embedding_calls: int
+    embedded_texts: int
+
+    def __str__(self) -> str:
+        return (
+            f"[{self.year}] built in {self.build_time:.2f}s"
+            f" ({self.embedding_calls} embedding calls, {self.embedded_texts} texts)"
+        )
+
+
+@dataclass
+class IngestReport:
+    """
+    Statistics of a single file's ingestion.
+
+    Attributes:
+        path (str): The path of the ingested file.
+        chunks (int): The number of chunks the file was split into.
+        inserted (int): The number of chunks embedded and inserted, the others were already indexed.
+        ingest_time (float): Wall time of the ingestion, in seconds.
+        peak_rss (int): The peak resident memory of the process during the ingestion, in bytes.
+        error (str, optional): Why the ingestion failed, None if it succeeded.
+    """
+
+    path: str
+    chunks: int
+    inserted: int
+    ingest_time: float
+    peak_rss: int
+    error: Optional[str] = None
+
+    @property
+    def chunks_per_second(self) -> float:
+        return self.chunks / self.ingest_time if self.ingest_time else 0.0
+
+    def __str__(self) -> str:
+        if self.error is not None:
+            return f"{self.path}: failed after {self.ingest_time:.2f}s, {self.error}"
+        return (
+            f"{self.path}: {self.chunks} chunks ({self.inserted} inserted)"
+            f" in {self.ingest_time:.2f}s, {self.chunks_per_second:.1f} chunks/s,"
+            f" peak RSS {self.peak_rss / 2**20:.1f} MiB"
+        )
+
+
+def current_rss() -> int:
+    """
+    Returns the resident memory of the process, in bytes.
+
+    Falls back to the peak resident memory where /proc is not available.
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # bytes on macOS, kilobytes elsewhere
+        return peak if sys.platform == "darwin" else peak * 1024
+
+
+class HTMLTextExtractor(HTMLParser):
+    """
+    Incremental HTML parser collecting the text of block elements.
+
+    Text is collected as blocks, one per paragraph, heading, list item or
+    table row, with scripts and styles skipped. Blocks longer than
+    `max_block_size` characters are split, so that memory stays bounded
+    whatever the markup.
+    """
+
+    BLOCK_TAGS = frozenset(
+        "address article aside blockquote body br dd div dl dt figcaption figure footer"
+        " form h1 h2 h3 h4 h5 h6 header hr li main nav ol p pre section table tbody"
+        " td th thead tfoot tr ul".split()
+    )
+    SKIP_TAGS = frozenset(["script", "style", "noscript", "template"])
+    CELL_TAGS = frozenset(["td", "th"])
+
+    def __init__(self, max_block_size: int = 1 << 16) -> None:
+        super().__init__(convert_charrefs=True)
+        self.max_block_size = max_block_size
+        self.blocks: List[str] = []
+        self._text: List[str] = []
+        self._size = 0
+        self._skip = 0
+
+    def _flush(self) -> None:
+        text = " ".join("".join(self._text).split())
+        if text:
+            self.blocks.append(text)
+        self._text, self._size = [], 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.SKIP_TAGS:
+            self._skip += 1
+        elif tag in self.CELL_TAGS:
+            # cells of a row form a single block
+            self._text.append(" ")
+        elif tag in self.BLOCK_TAGS:
+            self._flush()
+
+    def handle_endtag(self, tag):
+        if tag in self.SKIP_TAGS:
+            self._skip = max(self._skip - 1, 0)
+        elif tag in self.CELL_TAGS:
+            self._text.append(" ")
+        elif tag in self.BLOCK_TAGS:
+            self._flush()
+
+    def handle_data(self, data):
+        if self._skip:
+            return
+        self._text.append(data)
+        self._size += len(data)
+        if self._size >= self.max_block_size:
+            self._flush()
+
+    def close(self):
+        super().close()
+        self._flush()
+
+
+def stream_html_documents(
+    path: str,
+    metadata: Optional[Dict] = None,
+    section_size: Optional[int] = None,
+    overlap_size: Optional[int] = None,
+    read_size: int = 1 << 16,
+) -> Iterator[Document]:
+    """
+    Parses an HTML file incrementally into documents of bounded size.
+
+    The file is read `read_size` characters at a time, and its text blocks are
+    grouped into sections of about `section_size` characters, each yielded as
+    a document. Each section starts with the last `overlap_size` characters of
+    the previous one, so that chunks keep their overlap across sections.
+    Memory is bounded by the section size rather than by the file size.
+
+    Args:
+        path (str): The path of the HTML file.
+        metadata (Dict, optional): The metadata of every document. Defaults to None.
+        section_size (int, optional): The size of a section, in characters. Defaults to
+            16 chunks of `Settings.chunk_size` tokens of about 4 characters.
+        overlap_size (int, optional): The size of the overlap of consecutive sections, in characters.
+            Defaults to `Settings.chunk_overlap` tokens of about 4 characters.
+        read_size (int, optional): The number of characters read at a time. Defaults to 64 KiB.
+
+    Yields:
+        Document: The sections of the file, in order.
+    """
+    section_size = section_size or 16 * Settings.chunk_size * 4
+    if overlap_size is None:
+        overlap_size = Settings.chunk_overlap * 4
+    parser = HTMLTextExtractor(max_block_size=section_size)
+    section: List[str] = []
+    size = 0
+    # whether the section holds blocks beyond the tail of the previous one
+    fresh = False
+
+    def make_document() -> Document:
+        return Document(text="\n\n".join(section), metadata=dict(metadata or {}))
+
+    with open(path, encoding="utf-8", errors="replace") as f:
+        while True:
+            data = f.read(read_size)
+            if data:
+                parser.feed(data)
+            else:
+                parser.close()
+            for block in parser.blocks:
+                section.append(block)
+                size += len(block) + 2
+                fresh = True
+                if size >= section_size:
+                    document = make_document()
+                    yield document
+                    # carry the tail of the section over, cut at a word boundary
+                    tail = document.text[-overlap_size:] if overlap_size else ""
+                    if len(tail) == overlap_size:
+                        tail = tail.partition(" ")[2]
+                    section, size, fresh = ([tail] if tail else []), len(tail), False
+            parser.blocks.clear()
+            if not data:
+                break
+
+    if fresh:
+        yield make_document()
+
+
+def load_filing(
+    path: str, metadata: Dict, streaming: bool = True, **kwargs
+) -> Iterable[Document]:
+    """
+    Parses an HTML filing.
+
+    Args:
+        path (str): The path of the filing.
+        metadata (Dict): The metadata of every document.
+        streaming (bool, optional): Whether to parse the filing incrementally with `stream_html_documents`,
+            rather than as a single document with `UnstructuredReader`. Defaults to True.
+        **kwargs: Passed to `stream_html_documents`.
+
+    Returns:
+        Iterable[Document]: The documents of the filing.
+    """
+    if streaming:
+        return stream_html_documents(path, metadata=metadata, **kwargs)
+
+    from llama_index.readers.file import UnstructuredReader
+
+    documents = UnstructuredReader().load_data(file=Path(path), split_documents=False)
+    for document in documents:
+        document.metadata = dict(metadata)
+    return documents
+
+
+@dataclass
+class FilingLoader:
+    """
+    Picklable loader of the filings of some years, for parsing in worker processes.
+
+    The section sizes are taken from `Settings` when the loader is created, as
+    worker processes do not share the settings of the parent process.
+
+    Attributes:
+        years (Dict[str, str]): The year of every filing, mapped by path.
+        streaming (bool): Whether to parse the filings incrementally.
+        section_size (int): The size of a streamed section, in characters.
+        overlap_size (int): The size of the overlap of consecutive sections, in characters.
+    """
+
+    years: Dict[str, str]
+    streaming: bool = True
+    section_size: int = field(default_factory=lambda: 16 * Settings.chunk_size * 4)
+    overlap_size: int = field(default_factory=lambda: Settings.chunk_overlap * 4)
+
+    def __call__(self, path: str) -> Iterable[Document]:
+        return load_filing(
+            path,
+            {"year": self.years[path]},
+            streaming=self.streaming,
+            section_size=self.section_size,
+            overlap_size=self.overlap_size,
+        )
+
+
+_parse_pools: Dict[int, ProcessPoolExecutor] = {}
+_parse_pools_lock = threading.Lock()
+
+
+def get_parse_pool(workers: int) -> ProcessPoolExecutor:
+    """
+    Returns the process-wide pool of parsing processes of a given size, creating it if needed.
+
+    Workers are spawned rather than forked, as the parent process runs threads
+    (Chroma, the embedding cache writer) that forking could deadlock.
+
+    Args:
+        workers (int): The number of worker processes.
+
+    Returns:
+        ProcessPoolExecutor: The pool.
+    """
+    with _parse_pools_lock:
+        if workers not in _parse_pools:
+            _parse_pools[workers] = ProcessPoolExecutor(
+                max_workers=workers, mp_context=multiprocessing.get_context("spawn")
+            )
+        return _parse_pools[workers]
+
+
+def _discard_broken_pools() -> None:
+    with _parse_pools_lock:
+        for workers, pool in list(_parse_pools.items()):
+            if getattr(pool, "_broken", False):
+                del _parse_pools[workers]
+
+
+def _load_all(load: Callable[[str], Iterable[Document]], path: str) -> List[Document]:
+    return list(load(path))
+
+
+def _lazy_load(
+    load: Callable[[str], Iterable[Document]], path: str
+) -> Iterator[Document]:
+    yield from load(path)
+
+
+def _lazy_result(future) -> Iterator[Document]:
+    try:
+        documents = future.result()
+    except BrokenProcessPool:
+        _discard_broken_pools()
+        raise
+    yield from documents
+
+
+def load_in_order(
+    paths: Sequence[str],
+    load: Callable[[str], Iterable[Document]],
+    executor: Optional[Executor] = None,
+    prefetch: int = 8,
+) -> Iterator[Tuple[str, Iterable[Document]]]:
+    """
+    Loads the documents of files, in the order of the files.
+
+    Without an executor, every file is loaded lazily when its documents are
+    iterated. With an executor, up to `prefetch` files are loaded ahead in
+    its workers while the documents of the current file are consumed; `load`
+    must then be picklable, e.g. a module-level function or a `FilingLoader`.
+    In both cases, the errors of a file are raised when its documents are
+    iterated, so that the caller can report them and move on to the next file.
+
+    Args:
+        paths (Sequence[str]): The paths of the files.
+        load (Callable[[str], Iterable[Document]]): Loads the documents of a file.
+        executor (Executor, optional): The executor to load the files in. Defaults to loading in the caller.
+        prefetch (int, optional): The number of files loaded ahead. Defaults to 8.
+
+    Yields:
+        Tuple[str, Iterable[Document]]: The path and documents of every file, in order.
+    """
+    if executor is None:
+        for path in paths:
+            yield path, _lazy_load(load, path)
+        return
+
+    remaining = iter(paths)
+    pending: Deque = deque()
+
+    def submit() -> None:
+        for path in remaining:
+            try:
+                future = executor.submit(_load_all, load, path)
+            except (BrokenProcessPool, RuntimeError) as e:
+                # the pool died or was shut down, fail the file rather than the whole load
+                future = Future()
+                future.set_exception(e)
+            pending.append((path, future))
+            return
+
+    try:
+        for _ in range(max(prefetch, 1)):
+            submit()
+        while pending:
+            path, future = pending.popleft()
+            submit()
+            yield path, _lazy_result(future)
+    finally:
+        for _, future in pending:
+            future.cancel()
+
+
+def build_year_indices(
+    years: Sequence[str],
+    build: Callable[[str, BaseEmbedding], VectorStoreIndex],
+    max_workers: Optional[int] = None,
+) -> Tuple[Dict[str, VectorStoreIndex], List[BuildReport]]:
+    """
+    Builds one index per year concurrently.
+
+    Each build receives its own counting wrapper around `Settings.embed_model`
+    so that the embedding calls can be reported per year. Embeddings served
+    from the embedding cache are not counted.
+
+    Args:
+        years (Sequence[str]): The years to build.
+        build (Callable[[str, BaseEmbedding], VectorStoreIndex]): Builds the index of
+            a year using the given embedding model.
+        max_workers (int, optional): The number of worker threads. Defaults to one per year.
+
+    Returns:
+        Tuple[Dict[str, VectorStoreIndex], List[BuildReport]]: The indices mapped by
+            year, and the build reports in the order of `years`.
+    """
+
+    def build_one(year: str) -> Tuple[VectorStoreIndex, BuildReport]:
+        embed_model, counter = count_calls(Settings.embed_model)
+        start = time.perf_counter()
+        index = build(year, embed_model)
+        report = BuildReport(
+            year=year,
+            build_time=time.perf_counter() - start,
+            embedding_calls=counter.calls,
+            embedded_texts=counter.texts,
+        )
+        return index, report
+
+    with ThreadPoolExecutor(max_workers=max_workers or max(len(years), 1)) as pool:
+        results = list(pool.map(build_one, years))
+
+    index_set = {year: index for year, (index, _) in zip(years, results)}
+    reports = [report for _, report in results]
+    return index_set, reports
@@ -0,0 +1,312 @@
+import hashlib
+import json
+import os
+import time
+from concurrent.futures import Executor
+from dataclasses import dataclass, field
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from llama_index.core import Settings, SimpleDirectoryReader, VectorStoreIndex
+from llama_index.core.ingestion import run_transformations
+from llama_index.core.schema import BaseNode, Document, MetadataMode
+
+from utils.ingestion import IngestReport, current_rss, load_in_order
+
+
+def hash_file(path: str) -> str:
+    """
+    Computes the SHA-256 of a file's content.
+
+    Args:
+        path (str): The path of the file.
+
+    Returns:
+        str: The hex digest of the file.
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def hash_chunk(node: BaseNode) -> str:
+    """
+    Computes the SHA-256 of the content of a chunk, as seen by the embedding model.
+
+    Args:
+        node (BaseNode): The chunk.
+
+    Returns:
+        str: The hex digest of the chunk.
+    """
+    content = node.get_content(metadata_mode=MetadataMode.EMBED)
+    return hashlib.sha256(content.encode("utf-8", "surrogatepass")).hexdigest()
+
+
+def list_data_files(data_folder_path: str) -> List[str]:
+    """
+    Lists the files `SimpleDirectoryReader` would load from a folder.
+
+    Args:
+        data_folder_path (str): The path to the data folder.
+
+    Returns:
+        List[str]: The paths of the files.
+    """
+    reader = SimpleDirectoryReader(data_folder_path)
+    return [str(path) for path in reader.input_files]
+
+
+def load_data_file(path: str) -> List[Document]:
+    """
+    Loads the documents of a single file with `SimpleDirectoryReader`.
+
+    Args:
+        path (str): The path of the file.
+
+    Returns:
+        List[Document]: The documents of the file.
+    """
+    return SimpleDirectoryReader(input_files=[path]).load_data()
+
+
+@dataclass
+class ManifestDiff:
+    """
+    The files that changed since the last sync of an index.
+
+    Attributes:
+        added (List[str]): The files that are not indexed yet.
+        changed (List[str]): The indexed files whose content changed.
+        deleted (List[str]): The indexed files that no longer exist.
+        hashes (Dict[str, str]): The current content hashes of the added and changed files.
+        reports (List[IngestReport]): The ingestion statistics of the added and changed files.
+            Files that failed to load are reported with their error, and left out of the manifest.
+    """
+
+    added: List[str] = field(default_factory=list)
+    changed: List[str] = field(default_factory=list)
+    deleted: List[str] = field(default_factory=list)
+    hashes: Dict[str, str] = field(default_factory=dict)
+    reports: List[IngestReport] = field(default_factory=list)
+
+    def __bool__(self) -> bool:
+        return bool(self.added or self.changed or self.deleted)
+
+    @property
+    def failed(self) -> List[str]:
+        """The added and changed files that failed to load."""
+        return [report.path for report in self.reports if report.error is not None]
+
+    def __str__(self) -> str:
+        failed = f", {len(self.failed)} failed" if self.failed else ""
+        return (
+            f"{len(self.added)} added, {len(self.changed)} changed,"
+            f" {len(self.deleted)} deleted file(s){failed}"
+        )
+
+
+class IndexManifest:
+    """
+    Per-file and per-chunk content hashes of the files indexed in a vector store.
+
+    The manifest is a JSON file stored next to the index, mapping each indexed
+    file to its content hash and to the ids of its chunks. Chunk ids are derived
+    from the chunk hashes, so that unchanged chunks keep their id across syncs.
+
+    Attributes:
+        path (str): The path of the manifest file.
+        files (Dict[str, Dict]): The indexed files, mapped by path.
+    """
+
+    path: str
+    files: Dict[str, Dict]
+
+    def __init__(self, path: str) -> None:
+        """
+        Loads the manifest, if it exists.
+
+        Args:
+            path (str): The path of the manifest file.
+        """
+        self.path = path
+        self.files = {}
+        if self.exists:
+            with open(self.path) as f:
+                self.files = json.load(f)["files"]
+
+    @property
+    def exists(self) -> bool:
+        return os.path.exists(self.path)
+
+    def diff(self, paths: Sequence[str]) -> ManifestDiff:
+        """
+        Compares the given files against the manifest.
+
+        Args:
+            paths (Sequence[str]): The files that should be indexed.
+
+        Returns:
+            ManifestDiff: The added, changed and deleted files.
+        """
+        diff = ManifestDiff()
+        for path in paths:
+            file_hash = hash_file(path)
+            if path not in self.files:
+                diff.added.append(path)
+            elif self.files[path]["hash"] != file_hash:
+                diff.changed.append(path)
+            else:
+                continue
+            diff.hashes[path] = file_hash
+        current = set(paths)
+        diff.deleted = [path for path in self.files if path not in current]
+        return diff
+
+    def restore(self, chunks: Iterable[Tuple[str, Optional[str]]]) -> None:
+        """
+        Rebuilds the manifest of an index from its chunks, e.g. after the manifest was lost.
+
+        Chunks are assigned to a file through the id of their document, which
+        `sync_index` derives from the file path. File hashes are left empty, so
+        the next sync re-chunks every file but embeds only the chunks not in the
+        index yet, as chunk ids are derived from their content. Chunks indexed
+        before the manifest existed belong to no current file, and are removed.
+
+        Args:
+            chunks (Iterable[Tuple[str, Optional[str]]]): The id of every chunk and the id of its document.
+        """
+        self.files = {}
+        for chunk_id, document_id in chunks:
+            path = (document_id or "").rsplit("#", 1)[0]
+            self.files.setdefault(path, {"hash": "", "chunks": []})["chunks"].append(
+                chunk_id
+            )
+
+    def save(self) -> None:
+        """Writes the manifest to disk."""
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"files": self.files}, f, indent=1)
+        os.replace(tmp_path, self.path)
+
+
+def chunk_documents(documents: List[Document]) -> List[BaseNode]:
+    """
+    Chunks documents with `Settings.transformations`, assigning stable chunk ids.
+
+    Args:
+        documents (List[Document]): The documents to chunk. Their ids must be stable.
+
+    Returns:
+        List[BaseNode]: The chunks, with ids of the form `{doc_id}-{chunk_hash}`.
+    """
+    nodes = run_transformations(documents, Settings.transformations)
+    seen: Dict[str, int] = {}
+    for node in nodes:
+        node_id = f"{node.ref_doc_id}-{hash_chunk(node)}"
+        # identical chunks within a document get an occurrence suffix
+        seen[node_id] = seen.get(node_id, 0) + 1
+        node.id_ = node_id if seen[node_id] == 1 else f"{node_id}-{seen[node_id]}"
+    return nodes
+
+
+def sync_index(
+    index: VectorStoreIndex,
+    manifest: IndexManifest,
+    paths: Sequence[str],
+    load_documents: Callable[[str], Iterable[Document]],
+    batch_size: int = 256,
+    executor: Optional[Executor] = None,
+) -> ManifestDiff:
+    """
+    Brings an index in line with the given files, touching only what changed.
+
+    Deleted files have their chunks removed. Added and changed files are
+    re-chunked, but only the chunks that are not in the index yet are embedded
+    and inserted, and only the chunks that disappeared are removed. Documents
+    are chunked as they are loaded and inserted `batch_size` chunks at a time,
+    so a generator of bounded documents keeps memory bounded. With an
+    executor, files are parsed in its workers while the previous ones are
+    embedded, in the order of `paths`. A file that fails to load is rolled
+    back and reported, without aborting the sync, and retried on the next. Stores
+    built before their manifest existed must be cleared by the caller, or
+    their manifest restored with `IndexManifest.restore`.
+
+    Args:
+        index (VectorStoreIndex): The index to sync.
+        manifest (IndexManifest): The manifest of the index.
+        paths (Sequence[str]): The files that should be indexed.
+        load_documents (Callable[[str], Iterable[Document]]): Loads the documents of a file.
+        batch_size (int, optional): The number of chunks embedded and inserted at a time. Defaults to 256.
+        executor (Executor, optional): The executor to parse files in, see `load_in_order`.
+            Defaults to parsing in the caller.
+
+    Returns:
+        ManifestDiff: The files that were re-indexed.
+    """
+    diff = manifest.diff(paths)
+
+    for path in diff.deleted:
+        index.delete_nodes(
+            manifest.files.pop(path)["chunks"], delete_from_docstore=True
+        )
+
+    loaded = load_in_order(diff.added + diff.changed, load_documents, executor=executor)
+    for path, documents in loaded:
+        start = time.perf_counter()
+        peak_rss = current_rss()
+        old_chunks = set(manifest.files.get(path, {}).get("chunks", []))
+        new_chunks: List[str] = []
+        inserted: List[str] = []
+        batch: List[BaseNode] = []
+        try:
+            for i, document in enumerate(documents):
+                document.id_ = f"{path}#{i}"
+                nodes = chunk_documents([document])
+                new_chunks += [node.node_id for node in nodes]
+                batch += [node for node in nodes if node.node_id not in old_chunks]
+                while len(batch) >= batch_size:
+                    index.insert_nodes(batch[:batch_size])
+                    inserted += [node.node_id for node in batch[:batch_size]]
+                    batch = batch[batch_size:]
+                    peak_rss = max(peak_rss, current_rss())
+            if batch:
+                index.insert_nodes(batch)
+                inserted += [node.node_id for node in batch]
+        except Exception as e:
+            # roll the file back, it keeps its previous chunks until the next sync
+            if inserted:
+                index.delete_nodes(inserted, delete_from_docstore=True)
+            diff.reports.append(
+                IngestReport(
+                    path=path,
+                    chunks=0,
+                    inserted=0,
+                    ingest_time=time.perf_counter() - start,
+                    peak_rss=max(peak_rss, current_rss()),
+                    error=f"{type(e).__name__}: {e}",
+                )
+            )
+            continue
+
+        stale_chunks = list(old_chunks.difference(new_chunks))
+        if stale_chunks:
+            index.delete_nodes(stale_chunks, delete_from_docstore=True)
+
+        manifest.files[path] = {"hash": diff.hashes[path], "chunks": new_chunks}
+        diff.reports.append(
+            IngestReport(
+                path=path,
+                chunks=len(new_chunks),
+                inserted=len(inserted),
+                ingest_time=time.perf_counter() - start,
+                peak_rss=max(peak_rss, current_rss()),
+            )
+        )
+
+    if diff or not manifest.exists:
+        manifest.save()
+    return diff
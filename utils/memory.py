@@ -0,0 +1,369 @@
+import threading
+import time
+from typing import Any, List, Optional, Tuple
+
+import numpy as np
+from llama_index.core import Settings
+from llama_index.core.base.embeddings.base import BaseEmbedding
+from llama_index.core.base.llms.types import ChatMessage, MessageRole
+from llama_index.core.bridge.pydantic import Field, PrivateAttr, SerializeAsAny
+from llama_index.core.llms.llm import LLM
+from llama_index.core.memory.types import BaseMemory
+
+SUMMARIZE_PROMPT = (
+    "Summary of the conversation so far:\n{summary}\n\n"
+    "New messages:\n{conversation}\n\n"
+    "Update the summary with the new messages in at most {words} words. Keep the facts,"
+    " figures and years the user asked about and the answers they got, drop the rest."
+)
+SUMMARY_PREFIX = "Summary of the earlier conversation: "
+RECALL_PREFIX = "Relevant earlier exchanges:\n"
+# tokens of the role and separators of every message
+MESSAGE_OVERHEAD = 4
+# the delays before retrying a failed summary, doubled on each failure, in seconds
+SUMMARY_RETRY_DELAY = 1.0
+MAX_SUMMARY_RETRY_DELAY = 60.0
+
+
+def split_turns(messages: List[ChatMessage]) -> List[List[ChatMessage]]:
+    """
+    Splits messages into turns, each starting with a user message.
+
+    Args:
+        messages (List[ChatMessage]): The messages.
+
+    Returns:
+        List[List[ChatMessage]]: The turns, the first one possibly not starting with a user message.
+    """
+    turns: List[List[ChatMessage]] = []
+    for message in messages:
+        if not turns or message.role == MessageRole.USER:
+            turns.append([])
+        turns[-1].append(message)
+    return turns
+
+
+def _set_event() -> threading.Event:
+    event = threading.Event()
+    event.set()
+    return event
+
+
+class SummaryMemory(BaseMemory):
+    """
+    Chat memory with a hard token budget, summarizing the turns it cannot keep.
+
+    The most recent turns are kept verbatim, within `token_limit` minus the
+    summary and retrieval budgets. Once a turn no longer fits, it is folded
+    into a running summary, with a single LLM call over the previous summary
+    and the evicted turn, so that the cost of a turn does not grow with the
+    session. The summary is written on a background thread, so that the agent
+    does not wait for it, e.g. on the event loop of the server: until it is
+    written, the evicted turns are left out of the prompt. With
+    `retrieve_top_k`, the evicted turns are also embedded, and those most
+    similar to the user message are recalled verbatim.
+
+    Turns are kept or evicted whole, so that a tool message is never separated
+    from the tool call it answers. The latest turn is always kept, its longest
+    messages truncated if it exceeds the budget alone.
+    """
+
+    token_limit: int = 3000
+    summary_token_limit: int = 500
+    retrieve_top_k: int = 0
+    retrieved_token_limit: int = 500
+    max_archived_turns: int = 1000
+    llm: Optional[SerializeAsAny[LLM]] = Field(default=None, exclude=True)
+    embed_model: Optional[SerializeAsAny[BaseEmbedding]] = Field(
+        default=None, exclude=True
+    )
+
+    _lock: threading.RLock = PrivateAttr(default_factory=threading.RLock)
+    # the verbatim messages and their token counts
+    _messages: List[ChatMessage] = PrivateAttr(default_factory=list)
+    _counts: List[int] = PrivateAttr(default_factory=list)
+    _summary: str = PrivateAttr(default="")
+    # the text and unit-norm embedding of every evicted turn, oldest first
+    _archive: List[Tuple[str, np.ndarray]] = PrivateAttr(default_factory=list)
+    # the evicted turns not summarized yet, and whether none is being summarized
+    _pending_turns: List[str] = PrivateAttr(default_factory=list)
+    _idle: threading.Event = PrivateAttr(default_factory=_set_event)
+    # bumped on reset, so that the summary of the previous turns is dropped
+    _generation: int = PrivateAttr(default=0)
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "SummaryMemory"
+
+    @classmethod
+    def from_defaults(
+        cls,
+        token_limit: int = 3000,
+        summary_token_limit: int = 500,
+        retrieve_top_k: int = 0,
+        retrieved_token_limit: int = 500,
+        llm: Optional[LLM] = None,
+        embed_model: Optional[BaseEmbedding] = None,
+        **kwargs: Any,
+    ) -> "SummaryMemory":
+        """
+        Creates an empty memory.
+
+        Args:
+            token_limit (int, optional): The tokens of the messages `get` returns, summary included. Defaults to 3000.
+            summary_token_limit (int, optional): The tokens of the running summary. Defaults to 500.
+            retrieve_top_k (int, optional): The number of evicted turns recalled by similarity, 0 to disable it. Defaults to 0.
+            retrieved_token_limit (int, optional): The tokens of the recalled turns. Defaults to 500.
+            llm (LLM, optional): The LLM writing the summary. Defaults to `Settings.llm`.
+            embed_model (BaseEmbedding, optional): The model embedding the turns. Defaults to `Settings.embed_model`.
+
+        Returns:
+            SummaryMemory: The memory.
+        """
+        reserved = summary_token_limit + (
+            retrieved_token_limit if retrieve_top_k else 0
+        )
+        if reserved >= token_limit:
+            raise ValueError(
+                "token_limit must exceed the summary and retrieval budgets"
+            )
+        return cls(
+            token_limit=token_limit,
+            summary_token_limit=summary_token_limit,
+            retrieve_top_k=retrieve_top_k,
+            retrieved_token_limit=retrieved_token_limit,
+            llm=llm,
+            embed_model=embed_model,
+            **kwargs,
+        )
+
+    @property
+    def recent_token_limit(self) -> int:
+        """The tokens of the verbatim turns."""
+        reserved = self.summary_token_limit
+        if self.retrieve_top_k:
+            reserved += self.retrieved_token_limit
+        return self.token_limit - reserved
+
+    @property
+    def summary(self) -> str:
+        """The running summary of the evicted turns."""
+        return self._summary
+
+    @staticmethod
+    def _count(text: str) -> int:
+        return len(Settings.tokenizer(text))
+
+    @staticmethod
+    def _format(message: ChatMessage) -> str:
+        content = message.content or ""
+        tool_calls = message.additional_kwargs.get("tool_calls") or []
+        if tool_calls:
+            names = ", ".join(
+                getattr(getattr(call, "function", None), "name", "?")
+                for call in tool_calls
+            )
+            content = f"{content} [called {names}]".strip()
+        name = message.additional_kwargs.get("name")
+        role = f"{message.role.value} ({name})" if name else message.role.value
+        return f"{role}: {content}"
+
+    def _message_tokens(self, message: ChatMessage) -> int:
+        return self._count(self._format(message)) + MESSAGE_OVERHEAD
+
+    def _truncate(self, text: str, limit: int) -> str:
+        count = self._count(text)
+        while count > limit:
+            words = text.split()
+            text = " ".join(words[: max(int(len(words) * limit / count) - 1, 0)])
+            count = self._count(text)
+        return text
+
+    def _embed(self, text: str) -> np.ndarray:
+        embed_model = self.embed_model or Settings.embed_model
+        embedding = np.asarray(embed_model.get_text_embedding(text), dtype=np.float32)
+        norm = np.linalg.norm(embedding)
+        return embedding / norm if norm else embedding
+
+    def _fit_latest_turn(self, start: int) -> None:
+        """Truncates the longest messages of the turn starting at `start` until it fits the verbatim budget."""
+        while sum(self._counts[start:]) > self.recent_token_limit:
+            excess = sum(self._counts[start:]) - self.recent_token_limit
+            longest = max(
+                range(start, len(self._messages)), key=self._counts.__getitem__
+            )
+            message = self._messages[longest]
+            content = message.content or ""
+            if not content:
+                return
+            message = ChatMessage(
+                role=message.role,
+                content=self._truncate(content, max(self._count(content) - excess, 0)),
+                additional_kwargs=message.additional_kwargs,
+            )
+            self._messages[longest] = message
+            self._counts[longest] = self._message_tokens(message)
+
+    def _compress(self) -> None:
+        """Evicts the oldest turns until the verbatim turns fit their budget, and summarizes them in the background."""
+        if sum(self._counts) <= self.recent_token_limit:
+            return
+        turns = split_turns(self._messages)
+        # the latest turn is always kept, truncated if needed
+        keep_from = len(self._messages) - len(turns[-1])
+        self._fit_latest_turn(keep_from)
+        # then the longest suffix of whole turns within the budget
+        tokens = sum(self._counts[keep_from:])
+        for turn in reversed(turns[:-1]):
+            start = keep_from - len(turn)
+            tokens += sum(self._counts[start:keep_from])
+            if tokens > self.recent_token_limit:
+                break
+            keep_from = start
+
+        evicted = split_turns(self._messages[:keep_from])
+        if not evicted:
+            return
+        self._messages = self._messages[keep_from:]
+        self._counts = self._counts[keep_from:]
+        self._pending_turns.extend(
+            "\n".join(self._format(message) for message in turn) for turn in evicted
+        )
+        if self._idle.is_set():
+            self._idle.clear()
+            threading.Thread(
+                target=self._summarize, name="memory-summary", daemon=True
+            ).start()
+
+    def _summarize(self) -> None:
+        """Folds the evicted turns into the summary, off the thread of the agent."""
+        delay = SUMMARY_RETRY_DELAY
+        while True:
+            with self._lock:
+                turns, self._pending_turns = self._pending_turns, []
+                if not turns:
+                    self._idle.set()
+                    return
+                generation, summary = self._generation, self._summary
+
+            llm = self.llm or Settings.llm
+            words = max(self.summary_token_limit * 3 // 4, 1)
+            try:
+                summary = llm.complete(
+                    SUMMARIZE_PROMPT.format(
+                        summary=summary or "(empty)",
+                        conversation="\n".join(turns),
+                        words=words,
+                    )
+                ).text
+                archived = (
+                    [(turn, self._embed(turn)) for turn in turns]
+                    if self.retrieve_top_k
+                    else []
+                )
+            except Exception as e:
+                print(
+                    f"Could not summarize {len(turns)} turns, retrying in {delay:g}s: {e}"
+                )
+                with self._lock:
+                    # back in front of the turns evicted meanwhile, unless the memory was reset
+                    if generation == self._generation:
+                        self._pending_turns[:0] = turns
+                time.sleep(delay)
+                delay = min(delay * 2, MAX_SUMMARY_RETRY_DELAY)
+                continue
+            delay = SUMMARY_RETRY_DELAY
+            budget = self.summary_token_limit - self._count(SUMMARY_PREFIX)
+            summary = self._truncate(summary.strip(), budget - MESSAGE_OVERHEAD)
+
+            with self._lock:
+                # unless the memory was reset meanwhile
+                if generation == self._generation:
+                    self._summary = summary
+                    self._archive.extend(archived)
+                    del self._archive[: -self.max_archived_turns]
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """
+        Waits for the evicted turns to be summarized.
+
+        Args:
+            timeout (float, optional): The time to wait, in seconds. Defaults to waiting as long as needed.
+
+        Returns:
+            bool: Whether every evicted turn was summarized.
+        """
+        return self._idle.wait(timeout)
+
+    def _recall(self, query: str) -> Optional[ChatMessage]:
+        if not self.retrieve_top_k or not self._archive or not query:
+            return None
+        scores = np.stack([embedding for _, embedding in self._archive]) @ self._embed(
+            query
+        )
+        best = np.argsort(-scores)[: self.retrieve_top_k]
+        # oldest first, as they happened
+        turns = [self._archive[i][0] for i in sorted(best)]
+        budget = self.retrieved_token_limit - self._count(RECALL_PREFIX)
+        content = self._truncate("\n\n".join(turns), budget - MESSAGE_OVERHEAD)
+        return ChatMessage(role=MessageRole.SYSTEM, content=RECALL_PREFIX + content)
+
+    def get(self, input: Optional[str] = None, **kwargs: Any) -> List[ChatMessage]:
+        """
+        Gets the messages to prompt the LLM with, within `token_limit`.
+
+        Args:
+            input (str, optional): The user message, to recall the similar evicted turns with.
+
+        Returns:
+            List[ChatMessage]: The summary, the recalled turns, then the verbatim turns.
+        """
+        with self._lock:
+            messages = []
+            if self._summary:
+                messages.append(
+                    ChatMessage(
+                        role=MessageRole.SYSTEM,
+                        content=SUMMARY_PREFIX + self._summary,
+                    )
+                )
+            recalled = self._recall(input or "")
+            if recalled is not None:
+                messages.append(recalled)
+            return messages + list(self._messages)
+
+    def get_all(self) -> List[ChatMessage]:
+        """Gets the verbatim messages, the evicted ones being only kept in the summary."""
+        with self._lock:
+            return list(self._messages)
+
+    def put(self, message: ChatMessage) -> None:
+        self.put_messages([message])
+
+    def put_messages(self, messages: List[ChatMessage]) -> None:
+        """
+        Appends the messages of a turn, summarizing the oldest turns beyond the budget.
+
+        Args:
+            messages (List[ChatMessage]): The messages.
+        """
+        with self._lock:
+            for message in messages:
+                self._messages.append(message)
+                self._counts.append(self._message_tokens(message))
+            self._compress()
+
+    def set(self, messages: List[ChatMessage]) -> None:
+        with self._lock:
+            self._messages = []
+            self._counts = []
+            self.put_messages(messages)
+
+    def reset(self) -> None:
+        with self._lock:
+            self._messages = []
+            self._counts = []
+            self._summary = ""
+            self._archive = []
+            self._pending_turns = []
+            self._generation += 1
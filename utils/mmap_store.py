@@ -0,0 +1,404 @@
+import json
+import mmap
+import os
+import threading
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import fsspec
+import numpy as np
+from llama_index.core.bridge.pydantic import PrivateAttr
+from llama_index.core.schema import BaseNode
+from llama_index.core.vector_stores.types import (
+    BasePydanticVectorStore,
+    MetadataFilters,
+    VectorStoreQuery,
+    VectorStoreQueryResult,
+)
+from llama_index.core.vector_stores.utils import (
+    metadata_dict_to_node,
+    node_to_metadata_dict,
+)
+
+from utils.numpy_store import top_k
+
+FORMAT = "mmap-v1"
+DTYPES = {"float32": np.float32, "float16": np.float16}
+DEFAULT_PERSIST_FNAME = "vector_store.json"
+DEFAULT_VECTOR_STORE = "default"
+NAMESPACE_SEP = "__"
+# rows scored at once, bounding the memory of float16 upcasts
+BLOCK_ROWS = 1 << 16
+
+
+def _stem(persist_path: str) -> str:
+    return (
+        persist_path[: -len(".json")]
+        if persist_path.endswith(".json")
+        else persist_path
+    )
+
+
+class MmapVectorStore(BasePydanticVectorStore):
+    """
+    Vector store persisted in binary files that are memory-mapped on load.
+
+    A store persisted at `<stem>.json` is made of:
+        <stem>.json: The format, dimension, dtype and number of rows.
+        <stem>.vectors: The unit-norm embeddings, as a contiguous row-major float32 or float16 matrix.
+        <stem>.records: The nodes, text and metadata included, as concatenated JSON records.
+        <stem>.offsets: The uint64 offsets of the records, one more than the rows.
+        <stem>.ids: The node and document id of every row, one tab-separated line per row.
+
+    Loading only maps the files, so it takes the same time whatever the size of
+    the index, and processes serving the same index share its pages. Nodes are
+    decoded only when retrieved. Rows added or deleted after loading are kept in
+    memory until the next `persist`, which rewrites the files.
+
+    Similarities are cosine similarities.
+
+    Attributes:
+        dtype (str): The dtype of the persisted embeddings, "float32" or "float16".
+    """
+
+    stores_text: bool = True
+    dtype: str = "float32"
+
+    _lock: threading.RLock = PrivateAttr(default_factory=threading.RLock)
+    _dim: Optional[int] = PrivateAttr(default=None)
+    # persisted rows, memory-mapped
+    _matrix: np.ndarray = PrivateAttr(default=None)
+    _offsets: np.ndarray = PrivateAttr(default=None)
+    _records: Optional[mmap.mmap] = PrivateAttr(default=None)
+    _ids_path: Optional[str] = PrivateAttr(default=None)
+    # (node id, document id) of the persisted rows, read on first mutation
+    _ids: Optional[List[Tuple[str, str]]] = PrivateAttr(default=None)
+    _deleted: set = PrivateAttr(default_factory=set)
+    # rows added since loading, by node id
+    _added: Dict[str, Tuple[np.ndarray, BaseNode]] = PrivateAttr(default_factory=dict)
+    _added_matrix: Optional[np.ndarray] = PrivateAttr(default=None)
+
+    def __init__(self, dtype: str = "float32", **kwargs: Any) -> None:
+        """
+        Creates an empty store.
+
+        Args:
+            dtype (str, optional): The dtype of the persisted embeddings, "float32" or "float16". Defaults to "float32".
+        """
+        if dtype not in DTYPES:
+            raise ValueError(f"dtype must be one of {list(DTYPES)}, got {dtype}")
+        super().__init__(dtype=dtype, **kwargs)
+        self._matrix = np.empty((0, 0), dtype=DTYPES[dtype])
+        self._offsets = np.zeros(1, dtype=np.uint64)
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "MmapVectorStore"
+
+    @property
+    def client(self) -> None:
+        return None
+
+    @staticmethod
+    def is_persisted(persist_path: str) -> bool:
+        """
+        Tells whether a store was persisted in this format at a path.
+
+        Args:
+            persist_path (str): The path of the store's JSON file.
+
+        Returns:
+            bool: False if there is no file, or a store of another format.
+        """
+        # other formats, such as the simple vector store's, can be large
+        if not os.path.exists(persist_path) or os.path.getsize(persist_path) > 4096:
+            return False
+        with open(persist_path) as f:
+            try:
+                return json.load(f).get("format") == FORMAT
+            except ValueError:
+                return False
+
+    @classmethod
+    def from_persist_dir(
+        cls, persist_dir: str, namespace: str = DEFAULT_VECTOR_STORE
+    ) -> "MmapVectorStore":
+        """
+        Loads a store persisted by `StorageContext.persist`.
+
+        Args:
+            persist_dir (str): The directory of the storage context.
+            namespace (str, optional): The namespace of the vector store. Defaults to "default".
+
+        Returns:
+            MmapVectorStore: The loaded store.
+        """
+        persist_fname = f"{namespace}{NAMESPACE_SEP}{DEFAULT_PERSIST_FNAME}"
+        return cls.from_persist_path(os.path.join(persist_dir, persist_fname))
+
+    @classmethod
+    def from_persist_path(cls, persist_path: str) -> "MmapVectorStore":
+        """
+        Loads a persisted store.
+
+        Args:
+            persist_path (str): The path of the store's JSON file.
+
+        Returns:
+            MmapVectorStore: The loaded store.
+        """
+        if not cls.is_persisted(persist_path):
+            raise ValueError(f"No {cls.class_name()} found at {persist_path}")
+        with open(persist_path) as f:
+            meta = json.load(f)
+        store = cls(dtype=meta["dtype"])
+        store._map(_stem(persist_path), meta["dim"], meta["count"])
+        return store
+
+    def _map(self, stem: str, dim: Optional[int], count: int) -> None:
+        """Maps the files of a persisted store, replacing the rows in memory."""
+        self._dim = dim
+        self._ids_path = f"{stem}.ids"
+        self._ids = None
+        self._deleted = set()
+        self._added = {}
+        self._added_matrix = None
+        if self._records is not None:
+            self._records.close()
+            self._records = None
+        if not count:
+            self._matrix = np.empty((0, dim or 0), dtype=DTYPES[self.dtype])
+            self._offsets = np.zeros(1, dtype=np.uint64)
+            return
+        self._matrix = np.memmap(
+            f"{stem}.vectors", dtype=DTYPES[self.dtype], mode="r", shape=(count, dim)
+        )
+        self._offsets = np.memmap(
+            f"{stem}.offsets", dtype=np.uint64, mode="r", shape=(count + 1,)
+        )
+        with open(f"{stem}.records", "rb") as f:
+            self._records = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def _load_ids(self) -> List[Tuple[str, str]]:
+        if self._ids is None:
+            self._ids = []
+            if len(self._matrix):
+                with open(self._ids_path, encoding="utf-8") as f:  # type: ignore
+                    self._ids = [tuple(line.rstrip("\n").split("\t")) for line in f]  # type: ignore
+        return self._ids  # type: ignore
+
+    def _record(self, row: int) -> bytes:
+        start, end = int(self._offsets[row]), int(self._offsets[row + 1])
+        return self._records[start:end]  # type: ignore
+
+    def _node(self, row: int) -> BaseNode:
+        if row < len(self._matrix):
+            return metadata_dict_to_node(json.loads(self._record(row)))
+        return list(self._added.values())[row - len(self._matrix)][1]
+
+    def _count(self) -> int:
+        return len(self._matrix) - len(self._deleted) + len(self._added)
+
+    def add(self, nodes: Sequence[BaseNode], **add_kwargs: Any) -> List[str]:
+        """
+        Adds nodes, replacing those with the same id.
+
+        Args:
+            nodes (Sequence[BaseNode]): The nodes, with their embeddings.
+
+        Returns:
+            List[str]: The ids of the added nodes.
+        """
+        with self._lock:
+            self._delete_ids([node.node_id for node in nodes])
+            for node in nodes:
+                vector = np.asarray(node.get_embedding(), dtype=np.float32)
+                if self._dim is None:
+                    self._dim = len(vector)
+                    self._matrix = np.empty((0, self._dim), dtype=DTYPES[self.dtype])
+                norm = np.linalg.norm(vector)
+                vector = (vector / norm if norm else vector).astype(DTYPES[self.dtype])
+                self._added[node.node_id] = (vector, node)
+            self._added_matrix = None
+        return [node.node_id for node in nodes]
+
+    def _delete_rows(self, predicate) -> None:
+        for row, (node_id, ref_doc_id) in enumerate(self._load_ids()):
+            if predicate(node_id, ref_doc_id):
+                self._deleted.add(row)
+        for node_id, (_, node) in list(self._added.items()):
+            if predicate(node_id, node.ref_doc_id):
+                del self._added[node_id]
+        self._added_matrix = None
+
+    def _delete_ids(self, node_ids: Sequence[str]) -> None:
+        node_ids = set(node_ids)
+        if node_ids:
+            self._delete_rows(lambda node_id, _: node_id in node_ids)
+
+    def delete(self, ref_doc_id: str, **delete_kwargs: Any) -> None:
+        """
+        Deletes the nodes of a document.
+
+        Args:
+            ref_doc_id (str): The id of the document.
+        """
+        with self._lock:
+            self._delete_rows(lambda _, doc_id: doc_id == ref_doc_id)
+
+    def delete_nodes(
+        self,
+        node_ids: Optional[List[str]] = None,
+        filters: Optional[MetadataFilters] = None,
+        **delete_kwargs: Any,
+    ) -> None:
+        """
+        Deletes nodes by id.
+
+        Args:
+            node_ids (List[str], optional): The ids of the nodes.
+            filters (MetadataFilters, optional): Not supported.
+        """
+        if filters is not None:
+            raise NotImplementedError("Metadata filters are not supported")
+        with self._lock:
+            self._delete_ids(node_ids or [])
+
+    def clear(self) -> None:
+        """Deletes every node."""
+        with self._lock:
+            self._deleted = set(range(len(self._matrix)))
+            self._added = {}
+            self._added_matrix = None
+
+    def get_nodes(
+        self,
+        node_ids: Optional[List[str]] = None,
+        filters: Optional[MetadataFilters] = None,
+    ) -> List[BaseNode]:
+        """
+        Returns nodes by id.
+
+        Args:
+            node_ids (List[str], optional): The ids of the nodes. Defaults to every node.
+            filters (MetadataFilters, optional): Not supported.
+
+        Returns:
+            List[BaseNode]: The nodes, without their embeddings.
+        """
+        if filters is not None:
+            raise NotImplementedError("Metadata filters are not supported")
+        with self._lock:
+            wanted = set(node_ids) if node_ids is not None else None
+            rows = [
+                row
+                for row, (node_id, _) in enumerate(self._load_ids())
+                if row not in self._deleted and (wanted is None or node_id in wanted)
+            ]
+            nodes = [self._node(row) for row in rows]
+            nodes += [
+                node
+                for node_id, (_, node) in self._added.items()
+                if wanted is None or node_id in wanted
+            ]
+        return nodes
+
+    def _scores(self, query: np.ndarray) -> np.ndarray:
+        """Scores every row, persisted ones first, deleted ones at -inf."""
+        scores = np.empty(len(self._matrix) + len(self._added), dtype=np.float32)
+        for start in range(0, len(self._matrix), BLOCK_ROWS):
+            block = np.asarray(self._matrix[start : start + BLOCK_ROWS], np.float32)
+            scores[start : start + len(block)] = block @ query
+        if self._deleted:
+            scores[list(self._deleted)] = -np.inf
+        if self._added:
+            if self._added_matrix is None:
+                self._added_matrix = np.stack(
+                    [vector for vector, _ in self._added.values()]
+                ).astype(np.float32)
+            scores[len(self._matrix) :] = self._added_matrix @ query
+        return scores
+
+    def query(self, query: VectorStoreQuery, **kwargs: Any) -> VectorStoreQueryResult:
+        """
+        Retrieves the nodes most similar to the query embedding.
+
+        Args:
+            query (VectorStoreQuery): The query. Metadata filters and id restrictions are not supported.
+
+        Returns:
+            VectorStoreQueryResult: The nodes, by decreasing similarity.
+        """
+        if query.filters is not None or query.node_ids or query.doc_ids:
+            raise NotImplementedError("Filtered queries are not supported")
+        embedding = np.asarray(query.query_embedding, dtype=np.float32)
+        norm = np.linalg.norm(embedding)
+        embedding = embedding / norm if norm else embedding
+
+        with self._lock:
+            k = min(query.similarity_top_k, self._count())
+            if not k:
+                return VectorStoreQueryResult(nodes=[], similarities=[], ids=[])
+            scores = self._scores(embedding)
+            top = top_k(scores, k)
+            nodes = [self._node(int(row)) for row in top]
+        return VectorStoreQueryResult(
+            nodes=nodes,
+            similarities=[float(scores[row]) for row in top],
+            ids=[node.node_id for node in nodes],
+        )
+
+    def persist(
+        self, persist_path: str, fs: Optional[fsspec.AbstractFileSystem] = None
+    ) -> None:
+        """
+        Writes the store, then maps the written files.
+
+        Args:
+            persist_path (str): The path of the store's JSON file.
+            fs (fsspec.AbstractFileSystem, optional): Not supported, the files are written locally.
+        """
+        stem = _stem(persist_path)
+        os.makedirs(os.path.dirname(stem) or ".", exist_ok=True)
+        with self._lock:
+            ids = self._load_ids()
+            alive = np.ones(len(self._matrix), dtype=bool)
+            alive[list(self._deleted)] = False
+            count, offset = 0, 0
+            with open(f"{stem}.vectors.tmp", "wb") as vectors, open(
+                f"{stem}.records.tmp", "wb"
+            ) as records, open(f"{stem}.ids.tmp", "w", encoding="utf-8") as id_lines:
+                offsets = [0]
+
+                def write(vector: np.ndarray, record: bytes, node_id, ref_doc_id):
+                    nonlocal count, offset
+                    vectors.write(vector.tobytes())
+                    records.write(record)
+                    offset += len(record)
+                    offsets.append(offset)
+                    id_lines.write(f"{node_id}\t{ref_doc_id or ''}\n")
+                    count += 1
+
+                for start in range(0, len(self._matrix), BLOCK_ROWS):
+                    block = np.asarray(self._matrix[start : start + BLOCK_ROWS])
+                    for i in np.flatnonzero(alive[start : start + len(block)]):
+                        row = start + int(i)
+                        write(block[i], self._record(row), *ids[row])
+                for node_id, (vector, node) in self._added.items():
+                    record = node_to_metadata_dict(
+                        node, remove_text=False, flat_metadata=False
+                    )
+                    write(
+                        vector,
+                        json.dumps(record).encode("utf-8"),
+                        node_id,
+                        node.ref_doc_id,
+                    )
+            np.asarray(offsets, dtype=np.uint64).tofile(f"{stem}.offsets.tmp")
+
+            for suffix in ("vectors", "records", "offsets", "ids"):
+                os.replace(f"{stem}.{suffix}.tmp", f"{stem}.{suffix}")
+            meta = {"format": FORMAT, "dim": self._dim, "dtype": self.dtype}
+            with open(f"{persist_path}.tmp", "w") as f:
+                json.dump({**meta, "count": count}, f)
+            os.replace(f"{persist_path}.tmp", persist_path)
+            self._map(stem, self._dim, count)
@@ -0,0 +1,345 @@
+import atexit
+import json
+import os
+import threading
+import time
+import uuid
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from llama_index.core import Settings
+from llama_index.core.base.embeddings.base import BaseEmbedding
+from llama_index.core.schema import TextNode
+
+from utils.bm25 import BM25Index, reciprocal_rank_fusion
+from utils.numpy_store import normalize
+from utils.numpy_store import top_k as top_positions
+
+try:
+    import fcntl
+except ImportError:
+    # not available on Windows, where only the writers of a process are serialized
+    fcntl = None
+
+
+@dataclass
+class Note:
+    """
+    A note of the agent.
+
+    Attributes:
+        note_id (str): The id of the note.
+        text (str): The text of the note.
+        created_at (float): The creation time, as returned by `time.time`.
+    """
+
+    note_id: str
+    text: str
+    created_at: float
+
+    def __str__(self) -> str:
+        created_at = time.strftime("%Y-%m-%d %H:%M", time.localtime(self.created_at))
+        return f"[{created_at}] {self.text}"
+
+
+class NotesStore:
+    """
+    Append-only store of notes, searchable by keyword and by embedding.
+
+    Notes are appended to a JSON lines file, one note per line, and never
+    rewritten. `add` only buffers a note and indexes its words: a background
+    thread embeds the buffered notes and writes them in a single append,
+    followed by an fsync, once `flush_bytes` are buffered or `flush_interval`
+    seconds after the first one. The appends are serialized by a file lock, so
+    that several processes may share the file, each searching its own notes
+    and those written before it opened the store. The embeddings are written
+    with their notes, so that reopening the store embeds nothing.
+
+    `search` fuses a BM25 ranking over an inverted index with a similarity
+    ranking over the matrix of the embeddings, so that a search costs the
+    postings of its words and a single matrix-vector product, rather than a
+    pass over the file.
+
+    Attributes:
+        path (str): The JSON lines file.
+        flush_interval (float): The time a note may stay buffered, in seconds.
+        flush_bytes (int): The size of the buffered notes that triggers a write.
+    """
+
+    path: str
+    flush_interval: float
+    flush_bytes: int
+
+    def __init__(
+        self,
+        path: str = os.path.join(".", "notes.jsonl"),
+        flush_interval: float = 1.0,
+        flush_bytes: int = 1 << 16,
+        embed_model: Optional[BaseEmbedding] = None,
+    ) -> None:
+        """
+        Opens the store, indexing the notes of the file.
+
+        Args:
+            path (str, optional): The JSON lines file. Defaults to "./notes.jsonl".
+            flush_interval (float, optional): The time a note may stay buffered, in seconds. Defaults to 1.
+            flush_bytes (int, optional): The size of the buffered notes that triggers a write. Defaults to 64 KiB.
+            embed_model (BaseEmbedding, optional): The model embedding the notes. Defaults to `Settings.embed_model`.
+        """
+        self.path = path
+        self.flush_interval = flush_interval
+        self.flush_bytes = flush_bytes
+        self._embed_model = embed_model
+
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        self._notes: Dict[str, Note] = {}
+        self._keywords = BM25Index()
+        # unit-norm embeddings, one row per embedded note, grown by doubling
+        self._matrix: Optional[np.ndarray] = None
+        self._matrix_ids: List[str] = []
+        self._buffer: List[Note] = []
+        self._buffer_bytes = 0
+        self._buffered_at = 0.0
+        # the number of notes added, of those to write at once, and of those written
+        self._added = self._flush_target = self._written = 0
+        self._closed = False
+
+        unembedded = self._load()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._file = open(path, "a", encoding="utf-8")
+        if self._torn:
+            # so that the next note does not extend the torn line
+            self._append("\n")
+        self._writer = threading.Thread(
+            target=self._write_behind, name="notes-writer", daemon=True
+        )
+        self._writer.start()
+        if unembedded:
+            self._index_embeddings(unembedded, self._embed(unembedded))
+        atexit.register(self.close)
+
+    def __len__(self) -> int:
+        return len(self._notes)
+
+    def _load(self) -> List[Note]:
+        """Indexes the notes of the file, returning those written without embedding."""
+        self._torn = False
+        if not os.path.exists(self.path):
+            return []
+        unembedded, embedded, embeddings = [], [], []
+        with open(self.path, encoding="utf-8") as f:
+            for line in f:
+                self._torn = not line.endswith("\n")
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # a torn last line, from a crash during an append
+                    continue
+                note = Note(record["id"], record["text"], record["created_at"])
+                self._notes[note.note_id] = note
+                if record.get("embedding"):
+                    embedded.append(note)
+                    embeddings.append(record["embedding"])
+                else:
+                    unembedded.append(note)
+        self._keywords.add(self._node(note) for note in self._notes.values())
+        if embedded:
+            self._index_embeddings(embedded, embeddings)
+        return unembedded
+
+    @staticmethod
+    def _node(note: Note) -> TextNode:
+        return TextNode(id_=note.note_id, text=note.text)
+
+    def _embed(self, notes: List[Note]) -> Optional[List[List[float]]]:
+        embed_model = self._embed_model or Settings.embed_model
+        try:
+            return embed_model.get_text_embedding_batch([note.text for note in notes])
+        except Exception as e:
+            # kept for keyword search, and embedded when the store is reopened
+            print(f"Could not embed {len(notes)} notes: {e}")
+            return None
+
+    def _index_embeddings(
+        self, notes: List[Note], embeddings: Optional[List[List[float]]]
+    ) -> None:
+        if not embeddings:
+            return
+        vectors = normalize(np.asarray(embeddings, dtype=np.float32))
+        with self._lock:
+            rows = len(self._matrix_ids)
+            if self._matrix is None or self._matrix.shape[1] != vectors.shape[1]:
+                self._matrix = np.empty((0, vectors.shape[1]), dtype=np.float32)
+                self._matrix_ids, rows = [], 0
+            if rows + len(vectors) > len(self._matrix):
+                capacity = max(2 * len(self._matrix), rows + len(vectors), 64)
+                matrix = np.empty((capacity, vectors.shape[1]), dtype=np.float32)
+                matrix[:rows] = self._matrix[:rows]
+                self._matrix = matrix
+            self._matrix[rows : rows + len(vectors)] = vectors
+            self._matrix_ids.extend(note.note_id for note in notes)
+
+    def add(self, text: str) -> Note:
+        """
+        Adds a note, searchable by keyword at once and by embedding once written.
+
+        Args:
+            text (str): The text of the note.
+
+        Returns:
+            Note: The note.
+        """
+        note = Note(uuid.uuid4().hex, text, time.time())
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("the notes store is closed")
+            self._notes[note.note_id] = note
+            if not self._buffer:
+                # starts the interval of the background thread
+                self._buffered_at = time.monotonic()
+                self._changed.notify_all()
+            self._buffer.append(note)
+            self._buffer_bytes += len(text.encode())
+            self._added += 1
+            if self._buffer_bytes >= self.flush_bytes:
+                self._changed.notify_all()
+        # indexed once registered, so that a search never finds an unknown note
+        self._keywords.add([self._node(note)])
+        return note
+
+    def _write_behind(self) -> None:
+        while True:
+            with self._lock:
+                while not self._closed and not (
+                    self._buffer
+                    and (
+                        self._buffer_bytes >= self.flush_bytes
+                        or self._written < self._flush_target
+                        or time.monotonic() - self._buffered_at >= self.flush_interval
+                    )
+                ):
+                    timeout = None
+                    if self._buffer:
+                        timeout = max(
+                            self._buffered_at + self.flush_interval - time.monotonic(),
+                            0.0,
+                        )
+                    self._changed.wait(timeout)
+                if self._closed and not self._buffer:
+                    return
+                notes, self._buffer, self._buffer_bytes = self._buffer, [], 0
+
+            embeddings = self._embed(notes)
+            lines = "".join(
+                json.dumps(
+                    {
+                        "id": note.note_id,
+                        "text": note.text,
+                        "created_at": note.created_at,
+                        "embedding": embeddings[i] if embeddings else None,
+                    }
+                )
+                + "\n"
+                for i, note in enumerate(notes)
+            )
+            try:
+                self._append(lines)
+            except OSError as e:
+                print(f"Could not write {len(notes)} notes: {e}")
+            self._index_embeddings(notes, embeddings)
+            with self._lock:
+                self._written += len(notes)
+                self._changed.notify_all()
+
+    def _append(self, lines: str) -> None:
+        if fcntl is not None:
+            fcntl.flock(self._file, fcntl.LOCK_EX)
+        try:
+            self._file.write(lines)
+            self._file.flush()
+            os.fsync(self._file.fileno())
+        finally:
+            if fcntl is not None:
+                fcntl.flock(self._file, fcntl.LOCK_UN)
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """
+        Writes the buffered notes at once, and waits for them to be on disk.
+
+        Args:
+            timeout (float, optional): The time to wait, in seconds. Defaults to waiting as long as needed.
+
+        Returns:
+            bool: Whether the notes added so far are on disk.
+        """
+        with self._lock:
+            target = self._added
+            self._flush_target = max(self._flush_target, target)
+            self._changed.notify_all()
+            return (
+                self._changed.wait_for(
+                    lambda: self._written >= target or not self._writer.is_alive(),
+                    timeout,
+                )
+                and self._written >= target
+            )
+
+    def search(self, query: str, top_k: int = 5) -> List[Tuple[Note, float]]:
+        """
+        Finds the notes most relevant to a query, by keyword and by embedding.
+
+        Args:
+            query (str): The query.
+            top_k (int, optional): The number of notes to return. Defaults to 5.
+
+        Returns:
+            List[Tuple[Note, float]]: The notes and their fused scores, by decreasing score.
+        """
+        rankings = [[note_id for note_id, _ in self._keywords.search(query, 2 * top_k)]]
+        with self._lock:
+            rows = len(self._matrix_ids)
+            matrix = self._matrix[:rows] if rows else None
+            matrix_ids = self._matrix_ids[:rows]
+        if matrix is not None:
+            embed_model = self._embed_model or Settings.embed_model
+            embedding = normalize(embed_model.get_query_embedding(query))
+            if embedding.shape[-1] == matrix.shape[1]:
+                best = top_positions(matrix @ embedding, 2 * top_k)
+                rankings.append([matrix_ids[row] for row in best])
+        return [
+            (self._notes[note_id], score)
+            for note_id, score in reciprocal_rank_fusion(rankings)[:top_k]
+        ]
+
+    def close(self) -> None:
+        """Writes the buffered notes, then stops the background thread."""
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._changed.notify_all()
+        self._writer.join()
+        self._file.close()
+        atexit.unregister(self.close)
+
+
+_stores: Dict[str, NotesStore] = {}
+_stores_lock = threading.Lock()
+
+
+def get_notes_store(path: str = os.path.join(".", "notes.jsonl")) -> NotesStore:
+    """
+    Returns the process-wide notes store of a file, opening it if needed.
+
+    Args:
+        path (str, optional): The JSON lines file. Defaults to "./notes.jsonl".
+
+    Returns:
+        NotesStore: The store.
+    """
+    with _stores_lock:
+        if path not in _stores:
+            _stores[path] = NotesStore(path)
+        return _stores[path]
@@ -0,0 +1,509 @@
+import json
+import os
+import threading
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import fsspec
+import numpy as np
+from llama_index.core.bridge.pydantic import PrivateAttr
+from llama_index.core.schema import BaseNode
+from llama_index.core.vector_stores.types import (
+    BasePydanticVectorStore,
+    FilterCondition,
+    FilterOperator,
+    MetadataFilter,
+    MetadataFilters,
+    VectorStoreQuery,
+    VectorStoreQueryResult,
+)
+from llama_index.core.vector_stores.utils import (
+    metadata_dict_to_node,
+    node_to_metadata_dict,
+)
+
+from utils.manifest import IndexManifest
+
+FORMAT = "numpy-v1"
+QUANTIZATIONS = {None: np.float32, "float16": np.float16, "int8": np.int8}
+# rows scored at once, bounding the memory of quantized upcasts
+BLOCK_ROWS = 1 << 16
+
+
+def top_k(scores: np.ndarray, k: int) -> np.ndarray:
+    """
+    Selects the positions of the highest scores.
+
+    Args:
+        scores (np.ndarray): The scores. -inf marks excluded positions.
+        k (int): The number of positions to select.
+
+    Returns:
+        np.ndarray: At most k positions, by decreasing score.
+    """
+    k = min(k, len(scores))
+    if k <= 0:
+        return np.empty(0, dtype=np.int64)
+    top = np.argpartition(-scores, k - 1)[:k]
+    top = top[np.argsort(-scores[top], kind="stable")]
+    return top[np.isfinite(scores[top])]
+
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    """Scales vectors, the rows of a matrix or a single one, to unit norm."""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.where(norms == 0, 1, norms)
+
+
+def _matches(values: np.ndarray, filter_: MetadataFilter) -> np.ndarray:
+    operator, value = filter_.operator, filter_.value
+    if operator == FilterOperator.EQ:
+        return values == value
+    if operator == FilterOperator.NE:
+        return values != value
+    if operator in (FilterOperator.IN, FilterOperator.NIN):
+        accepted = set(value)  # type: ignore
+        matches = np.frompyfunc(lambda v: v in accepted, 1, 1)(values).astype(bool)
+        return matches if operator == FilterOperator.IN else ~matches
+    compare = {
+        FilterOperator.GT: lambda v: v > value,
+        FilterOperator.GTE: lambda v: v >= value,
+        FilterOperator.LT: lambda v: v < value,
+        FilterOperator.LTE: lambda v: v <= value,
+    }.get(operator)
+    if compare is None:
+        raise NotImplementedError(f"Filter operator {operator} is not supported")
+    return np.frompyfunc(lambda v: v is not None and compare(v), 1, 1)(values).astype(
+        bool
+    )
+
+
+class NumpyVectorStore(BasePydanticVectorStore):
+    """
+    In-process vector store scoring a contiguous embedding matrix exactly.
+
+    Embeddings are stored unit-norm in a single matrix, optionally quantized to
+    float16 or to int8 with a scale per row, and scored with a matrix product,
+    the top k being selected with `argpartition`. Metadata filters, as well as
+    node and document id restrictions, select the rows to score before scoring
+    them. Several queries sharing the same filters are scored in a single
+    product with `batch_query`.
+
+    For the corpus sizes at hand, an exact scan is about as fast as a round
+    trip through an approximate nearest neighbor index such as Chroma's, and
+    never misses a neighbor. Quantization halves or quarters the memory of the
+    embeddings at the cost of query latency, as they are upcast before scoring.
+
+    Similarities are cosine similarities.
+
+    Attributes:
+        quantization (str, optional): None for float32 embeddings, "float16" or "int8".
+    """
+
+    stores_text: bool = True
+    quantization: Optional[str] = None
+
+    _lock: threading.RLock = PrivateAttr(default_factory=threading.RLock)
+    _matrix: np.ndarray = PrivateAttr(default=None)
+    # int8 dequantization factors, one per row
+    _scales: np.ndarray = PrivateAttr(default=None)
+    _size: int = PrivateAttr(default=0)
+    # node metadata dicts, see `node_to_metadata_dict`, one per row
+    _records: List[Dict[str, Any]] = PrivateAttr(default_factory=list)
+    _row_of: Dict[str, int] = PrivateAttr(default_factory=dict)
+    # metadata values of every row, by key, rebuilt lazily after each change
+    _columns: Dict[str, np.ndarray] = PrivateAttr(default_factory=dict)
+
+    def __init__(self, quantization: Optional[str] = None, **kwargs: Any) -> None:
+        """
+        Creates an empty store.
+
+        Args:
+            quantization (str, optional): None for float32 embeddings, "float16" or "int8". Defaults to None.
+        """
+        if quantization not in QUANTIZATIONS:
+            raise ValueError(
+                f"quantization must be one of {list(QUANTIZATIONS)}, got {quantization}"
+            )
+        super().__init__(quantization=quantization, **kwargs)
+        self._matrix = np.empty((0, 0), dtype=QUANTIZATIONS[quantization])
+        self._scales = np.empty(0, dtype=np.float32)
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "NumpyVectorStore"
+
+    @property
+    def client(self) -> None:
+        return None
+
+    @property
+    def count(self) -> int:
+        """The number of stored nodes."""
+        return self._size
+
+    def _quantize(self, vectors: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        scales = np.ones(len(vectors), dtype=np.float32)
+        if self.quantization == "int8":
+            peaks = np.abs(vectors).max(axis=1)
+            scales = np.where(peaks == 0, 1, peaks) / 127
+            vectors = np.round(vectors / scales[:, None])
+        return vectors.astype(QUANTIZATIONS[self.quantization]), scales
+
+    def _append(
+        self, node_ids: List[str], vectors: np.ndarray, records: List[Dict[str, Any]]
+    ) -> None:
+        vectors, scales = self._quantize(normalize(vectors))
+        if not self._size:
+            self._matrix = np.empty((0, vectors.shape[1]), dtype=vectors.dtype)
+        needed = self._size + len(vectors)
+        if needed > len(self._matrix):
+            # grown by doubling, so that appends are amortized O(1)
+            capacity = max(needed, 2 * len(self._matrix), 1024)
+            matrix = np.empty((capacity, vectors.shape[1]), dtype=vectors.dtype)
+            matrix[: self._size] = self._matrix[: self._size]
+            self._matrix = matrix
+            self._scales = np.resize(self._scales, capacity)
+        self._matrix[self._size : needed] = vectors
+        self._scales[self._size : needed] = scales
+        for node_id, record in zip(node_ids, records):
+            self._row_of[node_id] = len(self._records)
+            self._records.append(record)
+        self._size = needed
+        self._columns = {}
+
+    def _keep(self, keep: np.ndarray) -> None:
+        """Compacts the store to the rows where `keep` is True."""
+        rows = np.flatnonzero(keep)
+        self._matrix = self._matrix[rows]
+        self._scales = self._scales[rows]
+        self._records = [self._records[row] for row in rows]
+        self._row_of = {
+            node_id: new_row
+            for new_row, node_id in enumerate(self._node_ids(rows.tolist()))
+        }
+        self._size = len(rows)
+        self._columns = {}
+
+    def _node_ids(self, old_rows: List[int]) -> List[str]:
+        ids_by_row = {row: node_id for node_id, row in self._row_of.items()}
+        return [ids_by_row[row] for row in old_rows]
+
+    def add(self, nodes: Sequence[BaseNode], **add_kwargs: Any) -> List[str]:
+        """
+        Adds nodes, replacing those with the same id.
+
+        Args:
+            nodes (Sequence[BaseNode]): The nodes, with their embeddings.
+
+        Returns:
+            List[str]: The ids of the added nodes.
+        """
+        if not nodes:
+            return []
+        with self._lock:
+            self._delete_ids([node.node_id for node in nodes])
+            self._append(
+                [node.node_id for node in nodes],
+                np.array([node.get_embedding() for node in nodes], dtype=np.float32),
+                [
+                    node_to_metadata_dict(node, remove_text=False, flat_metadata=False)
+                    for node in nodes
+                ],
+            )
+        return [node.node_id for node in nodes]
+
+    def _delete_ids(self, node_ids: Sequence[str]) -> None:
+        rows = [
+            self._row_of[node_id] for node_id in node_ids if node_id in self._row_of
+        ]
+        if rows:
+            keep = np.ones(self._size, dtype=bool)
+            keep[rows] = False
+            self._keep(keep)
+
+    def delete(self, ref_doc_id: str, **delete_kwargs: Any) -> None:
+        """
+        Deletes the nodes of a document.
+
+        Args:
+            ref_doc_id (str): The id of the document.
+        """
+        with self._lock:
+            matches = self._column("ref_doc_id") == ref_doc_id
+            if matches.any():
+                self._keep(~matches)
+
+    def delete_nodes(
+        self,
+        node_ids: Optional[List[str]] = None,
+        filters: Optional[MetadataFilters] = None,
+        **delete_kwargs: Any,
+    ) -> None:
+        """
+        Deletes nodes by id and/or metadata.
+
+        Args:
+            node_ids (List[str], optional): The ids of the nodes.
+            filters (MetadataFilters, optional): The metadata of the nodes.
+        """
+        with self._lock:
+            matches = self._mask(filters, node_ids=node_ids)
+            if matches is not None and matches.any():
+                self._keep(~matches)
+
+    def clear(self) -> None:
+        """Deletes every node."""
+        with self._lock:
+            self._keep(np.zeros(self._size, dtype=bool))
+
+    def _column(self, key: str) -> np.ndarray:
+        if key not in self._columns:
+            column = np.empty(self._size, dtype=object)
+            column[:] = [record.get(key) for record in self._records]
+            self._columns[key] = column
+        return self._columns[key]
+
+    def _filters_mask(self, filters: MetadataFilters) -> np.ndarray:
+        masks = [
+            (
+                self._filters_mask(filter_)
+                if isinstance(filter_, MetadataFilters)
+                else _matches(self._column(filter_.key), filter_)
+            )
+            for filter_ in filters.filters
+        ]
+        if not masks:
+            return np.ones(self._size, dtype=bool)
+        if filters.condition == FilterCondition.OR:
+            return np.logical_or.reduce(masks)
+        if filters.condition == FilterCondition.NOT:
+            return ~np.logical_or.reduce(masks)
+        return np.logical_and.reduce(masks)
+
+    def _mask(
+        self,
+        filters: Optional[MetadataFilters] = None,
+        node_ids: Optional[List[str]] = None,
+        doc_ids: Optional[List[str]] = None,
+    ) -> Optional[np.ndarray]:
+        """Selects the rows matching all the given restrictions, None if there is none."""
+        mask = None
+        if filters is not None:
+            mask = self._filters_mask(filters)
+        # empty restrictions are no restrictions, as in the other stores
+        if node_ids:
+            rows = [
+                self._row_of[node_id] for node_id in node_ids if node_id in self._row_of
+            ]
+            id_mask = np.zeros(self._size, dtype=bool)
+            id_mask[rows] = True
+            mask = id_mask if mask is None else mask & id_mask
+        if doc_ids:
+            accepted = set(doc_ids)
+            doc_mask = np.frompyfunc(lambda v: v in accepted, 1, 1)(
+                self._column("ref_doc_id")
+            ).astype(bool)
+            mask = doc_mask if mask is None else mask & doc_mask
+        return mask
+
+    def get_nodes(
+        self,
+        node_ids: Optional[List[str]] = None,
+        filters: Optional[MetadataFilters] = None,
+    ) -> List[BaseNode]:
+        """
+        Returns nodes by id and/or metadata.
+
+        Args:
+            node_ids (List[str], optional): The ids of the nodes. Defaults to any.
+            filters (MetadataFilters, optional): The metadata of the nodes. Defaults to any.
+
+        Returns:
+            List[BaseNode]: The nodes, without their embeddings.
+        """
+        with self._lock:
+            mask = self._mask(filters, node_ids=node_ids)
+            rows = range(self._size) if mask is None else np.flatnonzero(mask)
+            return [metadata_dict_to_node(self._records[row]) for row in rows]
+
+    def _scores(self, queries: np.ndarray, rows: Optional[np.ndarray]) -> np.ndarray:
+        """Scores the given rows, or every row, against unit-norm queries."""
+        count = self._size if rows is None else len(rows)
+        scores = np.empty((len(queries), count), dtype=np.float32)
+        for start in range(0, count, BLOCK_ROWS):
+            if rows is None:
+                block = slice(start, min(start + BLOCK_ROWS, count))
+            else:
+                block = rows[start : start + BLOCK_ROWS]
+            vectors = self._matrix[block]
+            if vectors.dtype != np.float32:
+                vectors = vectors.astype(np.float32)
+            block_scores = queries @ vectors.T
+            if self.quantization == "int8":
+                block_scores *= self._scales[block]
+            scores[:, start : start + len(vectors)] = block_scores
+        return scores
+
+    def batch_query(
+        self,
+        query_embeddings: Sequence[Sequence[float]],
+        similarity_top_k: int,
+        filters: Optional[MetadataFilters] = None,
+        node_ids: Optional[List[str]] = None,
+        doc_ids: Optional[List[str]] = None,
+    ) -> List[VectorStoreQueryResult]:
+        """
+        Retrieves the nodes most similar to several query embeddings at once.
+
+        Args:
+            query_embeddings (Sequence[Sequence[float]]): The query embeddings.
+            similarity_top_k (int): The number of nodes to retrieve per query.
+            filters (MetadataFilters, optional): The metadata of the nodes to retrieve from.
+            node_ids (List[str], optional): The ids of the nodes to retrieve from.
+            doc_ids (List[str], optional): The ids of the documents to retrieve from.
+
+        Returns:
+            List[VectorStoreQueryResult]: The nodes of each query, by decreasing similarity.
+        """
+        queries = normalize(np.atleast_2d(np.asarray(query_embeddings, np.float32)))
+        with self._lock:
+            mask = self._mask(filters, node_ids=node_ids, doc_ids=doc_ids)
+            rows = None if mask is None else np.flatnonzero(mask)
+            scores = self._scores(queries, rows)
+            results = []
+            for query_scores in scores:
+                top = top_k(query_scores, similarity_top_k)
+                top_rows = top if rows is None else rows[top]
+                nodes = [metadata_dict_to_node(self._records[row]) for row in top_rows]
+                results.append(
+                    VectorStoreQueryResult(
+                        nodes=nodes,
+                        similarities=query_scores[top].tolist(),
+                        ids=[node.node_id for node in nodes],
+                    )
+                )
+        return results
+
+    def query(self, query: VectorStoreQuery, **kwargs: Any) -> VectorStoreQueryResult:
+        """
+        Retrieves the nodes most similar to the query embedding.
+
+        Args:
+            query (VectorStoreQuery): The query, with its optional metadata filters and id restrictions.
+
+        Returns:
+            VectorStoreQueryResult: The nodes, by decreasing similarity.
+        """
+        return self.batch_query(
+            [query.query_embedding],  # type: ignore
+            query.similarity_top_k,
+            filters=query.filters,
+            node_ids=query.node_ids,
+            doc_ids=query.doc_ids,
+        )[0]
+
+    @staticmethod
+    def is_persisted(persist_path: str) -> bool:
+        """
+        Tells whether a store was persisted at a path.
+
+        Args:
+            persist_path (str): The path of the store's JSON file.
+
+        Returns:
+            bool: False if there is no file, or a store of another format.
+        """
+        if not os.path.exists(persist_path) or os.path.getsize(persist_path) > 4096:
+            return False
+        with open(persist_path) as f:
+            try:
+                return json.load(f).get("format") == FORMAT
+            except ValueError:
+                return False
+
+    @classmethod
+    def from_persist_path(cls, persist_path: str) -> "NumpyVectorStore":
+        """
+        Loads a persisted store.
+
+        Args:
+            persist_path (str): The path of the store's JSON file.
+
+        Returns:
+            NumpyVectorStore: The loaded store.
+        """
+        if not cls.is_persisted(persist_path):
+            raise ValueError(f"No {cls.class_name()} found at {persist_path}")
+        with open(persist_path) as f:
+            meta = json.load(f)
+        stem = persist_path[: -len(".json")]
+        store = cls(quantization=meta["quantization"])
+        if meta["count"]:
+            with open(f"{stem}.records.jsonl", encoding="utf-8") as f:
+                records = [json.loads(line) for line in f]
+            with open(f"{stem}.ids.json") as f:
+                node_ids = json.load(f)
+            store._matrix = np.load(f"{stem}.npy")
+            store._scales = np.load(f"{stem}.scales.npy")
+            store._records = records
+            store._row_of = {node_id: row for row, node_id in enumerate(node_ids)}
+            store._size = len(records)
+        return store
+
+    def persist(
+        self, persist_path: str, fs: Optional[fsspec.AbstractFileSystem] = None
+    ) -> None:
+        """
+        Writes the store next to its JSON file, `persist_path`.
+
+        Args:
+            persist_path (str): The path of the store's JSON file, ending with ".json".
+            fs (fsspec.AbstractFileSystem, optional): Not supported, the files are written locally.
+        """
+        stem = persist_path[: -len(".json")]
+        os.makedirs(os.path.dirname(stem) or ".", exist_ok=True)
+        with self._lock:
+            # np.save appends .npy to paths without it
+            np.save(f"{stem}.tmp.npy", self._matrix[: self._size])
+            os.replace(f"{stem}.tmp.npy", f"{stem}.npy")
+            np.save(f"{stem}.scales.tmp.npy", self._scales[: self._size])
+            os.replace(f"{stem}.scales.tmp.npy", f"{stem}.scales.npy")
+            with open(f"{stem}.records.jsonl.tmp", "w", encoding="utf-8") as f:
+                for record in self._records:
+                    f.write(json.dumps(record) + "\n")
+            os.replace(f"{stem}.records.jsonl.tmp", f"{stem}.records.jsonl")
+            with open(f"{stem}.ids.json.tmp", "w") as f:
+                json.dump(self._node_ids(list(range(self._size))), f)
+            os.replace(f"{stem}.ids.json.tmp", f"{stem}.ids.json")
+            meta = {
+                "format": FORMAT,
+                "quantization": self.quantization,
+                "count": self._size,
+            }
+            with open(f"{persist_path}.tmp", "w") as f:
+                json.dump(meta, f)
+            os.replace(f"{persist_path}.tmp", persist_path)
+
+
+def open_numpy_store(
+    persist_path: str, manifest: IndexManifest, quantization: Optional[str] = None
+) -> NumpyVectorStore:
+    """
+    Loads the store persisted at a path, or creates an empty one.
+
+    An empty store is created along with an empty manifest when the store was
+    never persisted, so that the next sync indexes every file again.
+
+    Args:
+        persist_path (str): The path of the store's JSON file.
+        manifest (IndexManifest): The manifest of the index backed by the store.
+        quantization (str, optional): The quantization of a new store. Defaults to None.
+
+    Returns:
+        NumpyVectorStore: The store.
+    """
+    if NumpyVectorStore.is_persisted(persist_path):
+        return NumpyVectorStore.from_persist_path(persist_path)
+    manifest.files = {}
+    return NumpyVectorStore(quantization=quantization)
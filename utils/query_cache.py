@@ -0,0 +1,375 @@
+import re
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+from llama_index.core import Settings
+from llama_index.core.base.base_query_engine import BaseQueryEngine
+from llama_index.core.base.embeddings.base import BaseEmbedding
+from llama_index.core.base.response.schema import (
+    RESPONSE_TYPE,
+    Response,
+    StreamingResponse,
+)
+from llama_index.core.prompts.mixin import PromptMixinType
+from llama_index.core.schema import QueryBundle
+
+
+@dataclass
+class CacheEntry:
+    """
+    A cached query result.
+
+    Attributes:
+        query (str): The normalized query.
+        numbers (frozenset): The numbers mentioned in the query.
+        embedding (Optional[np.ndarray]): The unit-norm embedding of the query, None without semantic lookups.
+        response (Response): The cached response.
+        created_at (float): The creation time, as returned by `time.monotonic`.
+    """
+
+    query: str
+    numbers: frozenset
+    embedding: Optional[np.ndarray]
+    response: Response
+    created_at: float
+
+
+class QueryCache:
+    """
+    Bounded, expiring cache of query results, with exact and semantic lookups.
+
+    A query first looks for an entry with the same normalized text, then for
+    the entry whose embedding is the most similar to its own. A semantic match
+    must reach the similarity threshold and mention the same numbers, so that
+    "revenue in 2021" is never answered with the result of "revenue in 2022".
+
+    Semantic lookups can be turned off for queries whose answers hinge on a
+    single word, e.g. "maximum" and "minimum" price, which their embeddings
+    barely tell apart.
+
+    Attributes:
+        max_size (int): The maximum number of cached results.
+        ttl (float): The lifetime of a cached result, in seconds.
+        similarity_threshold (float): The minimum cosine similarity of a semantic match.
+        semantic (bool): Whether queries are also matched by embedding, rather than by normalized text only.
+        hits (int): The number of exact hits.
+        semantic_hits (int): The number of semantic hits.
+        misses (int): The number of misses.
+    """
+
+    max_size: int
+    ttl: float
+    similarity_threshold: float
+    semantic: bool
+    hits: int
+    semantic_hits: int
+    misses: int
+
+    def __init__(
+        self,
+        max_size: int = 256,
+        ttl: float = 3600,
+        similarity_threshold: float = 0.97,
+        embed_model: Optional[BaseEmbedding] = None,
+        semantic: bool = True,
+    ) -> None:
+        """
+        Creates an empty cache.
+
+        Args:
+            max_size (int, optional): The maximum number of cached results. Defaults to 256.
+            ttl (float, optional): The lifetime of a cached result, in seconds. Defaults to 3600.
+            similarity_threshold (float, optional): The minimum cosine similarity of a semantic match. Defaults to 0.97.
+            embed_model (BaseEmbedding, optional): The model embedding the queries. Defaults to `Settings.embed_model`.
+            semantic (bool, optional): Whether queries are also matched by embedding. Defaults to True.
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.similarity_threshold = similarity_threshold
+        self.semantic = semantic
+        self._embed_model = embed_model
+        self.hits = self.semantic_hits = self.misses = 0
+
+        self._lock = threading.Lock()
+        # bumped on invalidation, so that in-flight results computed against
+        # the previous index are not cached
+        self._generation = 0
+        self._entries: "OrderedDict[str, CacheEntry]" = OrderedDict()
+        # stacked entry embeddings, rebuilt lazily after each change
+        self._matrix: Optional[np.ndarray] = None
+        self._matrix_keys: List[str] = []
+
+    @staticmethod
+    def normalize(query: str) -> str:
+        """Lowercases a query and collapses its whitespace and trailing punctuation."""
+        return " ".join(query.lower().split()).rstrip(" ?!.")
+
+    @staticmethod
+    def _numbers(query: str) -> frozenset:
+        return frozenset(re.findall(r"\d+(?:[.,]\d+)*", query))
+
+    @staticmethod
+    def _unit(embedding: List[float]) -> np.ndarray:
+        embedding = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(embedding)
+        return embedding / norm if norm else embedding
+
+    def _embed(self, query: str) -> np.ndarray:
+        embed_model = self._embed_model or Settings.embed_model
+        return self._unit(embed_model.get_query_embedding(query))
+
+    async def _aembed(self, query: str) -> np.ndarray:
+        embed_model = self._embed_model or Settings.embed_model
+        return self._unit(await embed_model.aget_query_embedding(query))
+
+    def _expire(self) -> None:
+        deadline = time.monotonic() - self.ttl
+        expired = [
+            key for key, entry in self._entries.items() if entry.created_at < deadline
+        ]
+        for key in expired:
+            del self._entries[key]
+        if expired:
+            self._matrix = None
+
+    def _nearest(self, embedding: np.ndarray) -> Tuple[Optional[str], float]:
+        if not self._entries:
+            return None, 0.0
+        if self._matrix is None:
+            self._matrix_keys = list(self._entries)
+            self._matrix = np.stack(
+                [self._entries[key].embedding for key in self._matrix_keys]
+            )
+        scores = self._matrix @ embedding
+        best = int(np.argmax(scores))
+        return self._matrix_keys[best], float(scores[best])
+
+    @property
+    def generation(self) -> int:
+        return self._generation
+
+    def _lookup_exact(self, key: str) -> Optional[Response]:
+        with self._lock:
+            self._expire()
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry.response
+
+    def _lookup_similar(self, key: str, embedding: np.ndarray) -> Optional[Response]:
+        with self._lock:
+            nearest, score = self._nearest(embedding)
+            entry = self._entries.get(nearest) if nearest is not None else None
+            if (
+                entry is not None
+                and score >= self.similarity_threshold
+                and entry.numbers == self._numbers(key)
+            ):
+                self._entries.move_to_end(nearest)
+                self.semantic_hits += 1
+                return entry.response
+            self.misses += 1
+            return None
+
+    def _count_miss(self, response: Optional[Response]) -> Optional[Response]:
+        if response is None:
+            with self._lock:
+                self.misses += 1
+        return response
+
+    def lookup(self, query: str) -> Tuple[Optional[Response], Optional[np.ndarray]]:
+        """
+        Looks up the result of a query.
+
+        Args:
+            query (str): The query.
+
+        Returns:
+            Tuple[Optional[Response], Optional[np.ndarray]]: The cached response, or
+                None on a miss, and the query embedding if it was computed.
+        """
+        key = self.normalize(query)
+        response = self._lookup_exact(key)
+        if response is not None or not self.semantic:
+            return self._count_miss(response), None
+        embedding = self._embed(query)
+        return self._lookup_similar(key, embedding), embedding
+
+    async def alookup(
+        self, query: str
+    ) -> Tuple[Optional[Response], Optional[np.ndarray]]:
+        """
+        Looks up the result of a query, embedding it asynchronously.
+
+        Args:
+            query (str): The query.
+
+        Returns:
+            Tuple[Optional[Response], Optional[np.ndarray]]: The cached response, or
+                None on a miss, and the query embedding if it was computed.
+        """
+        key = self.normalize(query)
+        response = self._lookup_exact(key)
+        if response is not None or not self.semantic:
+            return self._count_miss(response), None
+        embedding = await self._aembed(query)
+        return self._lookup_similar(key, embedding), embedding
+
+    def store(
+        self,
+        query: str,
+        response: Response,
+        embedding: Optional[np.ndarray] = None,
+        generation: Optional[int] = None,
+    ) -> None:
+        """
+        Caches the result of a query, evicting the least recently used result if the cache is full.
+
+        Args:
+            query (str): The query.
+            response (Response): The response to cache.
+            embedding (np.ndarray, optional): The query embedding, if already computed.
+            generation (int, optional): The cache generation the result was computed in.
+                The result is dropped if the cache was invalidated since. Defaults to the current one.
+        """
+        key = self.normalize(query)
+        if embedding is None and self.semantic:
+            embedding = self._embed(query)
+        with self._lock:
+            if generation is not None and generation != self._generation:
+                return
+            self._entries[key] = CacheEntry(
+                query=key,
+                numbers=self._numbers(key),
+                embedding=embedding,
+                response=response,
+                created_at=time.monotonic(),
+            )
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+            self._matrix = None
+
+    def invalidate(self) -> None:
+        """Drops every cached result. To be called whenever the underlying index changes."""
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+            self._matrix = None
+
+    @property
+    def stats(self) -> Dict[str, float]:
+        """Returns the hit/miss statistics of the cache."""
+        lookups = self.hits + self.semantic_hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "semantic_hits": self.semantic_hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits + self.semantic_hits) / lookups if lookups else 0.0,
+        }
+
+
+class CachedQueryEngine(BaseQueryEngine):
+    """
+    Query engine serving repeated and paraphrased queries from a `QueryCache`.
+
+    Streaming responses are cached once fully consumed, and replayed as a
+    single-chunk stream.
+    """
+
+    def __init__(
+        self, query_engine: BaseQueryEngine, cache: QueryCache, streaming: bool = False
+    ) -> None:
+        """
+        Wraps a query engine.
+
+        Args:
+            query_engine (BaseQueryEngine): The query engine doing the actual work.
+            cache (QueryCache): The cache to serve results from.
+            streaming (bool, optional): Whether the query engine streams its responses. Defaults to False.
+        """
+        self._query_engine = query_engine
+        self._cache = cache
+        self._streaming = streaming
+        super().__init__(callback_manager=query_engine.callback_manager)
+
+    @property
+    def cache(self) -> QueryCache:
+        return self._cache
+
+    @property
+    def inner(self) -> BaseQueryEngine:
+        return self._query_engine
+
+    def _get_prompt_modules(self) -> PromptMixinType:
+        return {"query_engine": self._query_engine}
+
+    def _replay(self, response: Response) -> RESPONSE_TYPE:
+        if self._streaming:
+            return StreamingResponse(
+                response_gen=iter([response.response or ""]),
+                source_nodes=response.source_nodes,
+                metadata=response.metadata,
+            )
+        return Response(response.response, response.source_nodes, response.metadata)
+
+    def _record_stream(
+        self,
+        query: str,
+        response: StreamingResponse,
+        embedding: Optional[np.ndarray],
+        generation: int,
+    ) -> StreamingResponse:
+        inner_gen = response.response_gen
+
+        def response_gen() -> Iterator[str]:
+            chunks = []
+            for chunk in inner_gen:
+                chunks.append(chunk)
+                yield chunk
+            self._cache.store(
+                query,
+                Response("".join(chunks), response.source_nodes, response.metadata),
+                embedding,
+                generation,
+            )
+
+        response.response_gen = response_gen()
+        return response
+
+    def _query(self, query_bundle: QueryBundle) -> RESPONSE_TYPE:
+        generation = self._cache.generation
+        cached, embedding = self._cache.lookup(query_bundle.query_str)
+        if cached is not None:
+            return self._replay(cached)
+
+        response = self._query_engine.query(query_bundle)
+        if isinstance(response, StreamingResponse):
+            return self._record_stream(
+                query_bundle.query_str, response, embedding, generation
+            )
+        if isinstance(response, Response):
+            self._cache.store(query_bundle.query_str, response, embedding, generation)
+        return response
+
+    async def _aquery(self, query_bundle: QueryBundle) -> RESPONSE_TYPE:
+        generation = self._cache.generation
+        cached, embedding = await self._cache.alookup(query_bundle.query_str)
+        if cached is not None:
+            return self._replay(cached)
+
+        response = await self._query_engine.aquery(query_bundle)
+        if isinstance(response, StreamingResponse):
+            return self._record_stream(
+                query_bundle.query_str, response, embedding, generation
+            )
+        if isinstance(response, Response):
+            self._cache.store(query_bundle.query_str, response, embedding, generation)
+        return response
@@ -0,0 +1,276 @@
+import hashlib
+import io
+import json
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Any, Dict, Optional, Sequence
+
+FORMATS = ("png", "svg")
+
+
+@dataclass
+class PlotHandle:
+    """
+    A plot being rendered, or already rendered.
+
+    Attributes:
+        key (str): The hash of the plot request.
+        path (str): The file the plot is written to.
+        cached (bool): Whether an identical plot was already rendered or being rendered.
+        future (Future): Resolves to the bytes of the plot once rendered.
+    """
+
+    key: str
+    path: str
+    cached: bool
+    future: Future
+
+    @property
+    def done(self) -> bool:
+        """Whether the plot was rendered."""
+        return self.future.done()
+
+    def result(self, timeout: Optional[float] = None) -> bytes:
+        """
+        Waits for the plot to be rendered.
+
+        Args:
+            timeout (float, optional): The time to wait, in seconds. Defaults to waiting as long as needed.
+
+        Returns:
+            bytes: The PNG or SVG bytes.
+        """
+        return self.future.result(timeout)
+
+
+class PlotRenderer:
+    """
+    Renders line plots to files on a background thread, without blocking the caller.
+
+    The plots are drawn on the Agg backend, without pyplot, onto a single
+    figure reused from plot to plot, so that rendering needs no display and
+    no window can block a turn. `plot` returns the path of the file at once.
+    Identical requests, hashed with their data, share a single rendering:
+    they are served from the most recently rendered plots in memory, from
+    the files already written, or from the rendering in progress.
+
+    Attributes:
+        output_dir (str): The folder of the plot files, named by the hash of their request.
+        max_cached (int): The number of rendered plots kept in memory.
+        hits (int): The number of requests served by an identical plot.
+        misses (int): The number of plots rendered.
+        failures (int): The number of plots that could not be rendered.
+    """
+
+    output_dir: str
+    max_cached: int
+    hits: int
+    misses: int
+    failures: int
+
+    def __init__(
+        self,
+        output_dir: str = os.path.join(".", "plots"),
+        max_cached: int = 128,
+        figsize: Sequence[float] = (8, 6),
+        dpi: int = 100,
+    ) -> None:
+        """
+        Creates the renderer and its background thread.
+
+        Args:
+            output_dir (str, optional): The folder of the plot files. Defaults to "./plots".
+            max_cached (int, optional): The number of rendered plots kept in memory. Defaults to 128.
+            figsize (Sequence[float], optional): The size of the plots, in inches. Defaults to (8, 6).
+            dpi (int, optional): The resolution of the PNG plots. Defaults to 100.
+        """
+        self.output_dir = output_dir
+        self.max_cached = max_cached
+        self._figsize = tuple(figsize)
+        self._dpi = dpi
+        os.makedirs(output_dir, exist_ok=True)
+        # a single thread, as the figure is reused and matplotlib is not thread-safe
+        self._executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="plot-renderer"
+        )
+        self._figure = None
+        self._lock = threading.Lock()
+        self._pending: Dict[str, Future] = {}
+        self._cache: "OrderedDict[str, bytes]" = OrderedDict()
+        self.hits = self.misses = self.failures = 0
+
+    @staticmethod
+    def request_key(request: Dict[str, Any]) -> str:
+        """
+        Hashes a plot request, data included.
+
+        Args:
+            request (Dict[str, Any]): The request.
+
+        Returns:
+            str: The SHA-256 of the request as canonical JSON.
+        """
+        payload = json.dumps(request, sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def plot(
+        self,
+        x: Sequence[Any],
+        y: Sequence[float],
+        title: str = "",
+        xlabel: str = "",
+        ylabel: str = "",
+        format: str = "png",
+    ) -> PlotHandle:
+        """
+        Renders a line plot in the background.
+
+        Args:
+            x (Sequence[Any]): The values of the x axis, e.g. years.
+            y (Sequence[float]): The values of the y axis.
+            title (str, optional): The title. Defaults to "".
+            xlabel (str, optional): The label of the x axis. Defaults to "".
+            ylabel (str, optional): The label of the y axis. Defaults to "".
+            format (str, optional): "png" or "svg". Defaults to "png".
+
+        Returns:
+            PlotHandle: The plot, whose file is written once rendered.
+
+        Raises:
+            ValueError: If the request cannot be plotted, e.g. x and y differ in length.
+        """
+        if format not in FORMATS:
+            raise ValueError(f"format must be one of {', '.join(FORMATS)}")
+        x, y = list(x), list(y)
+        # checked here, as the caller never sees the errors of the rendering
+        if len(x) != len(y):
+            raise ValueError(
+                f"x and y must have the same length, but have {len(x)} and {len(y)} values"
+            )
+        try:
+            y = [float(value) for value in y]
+        except (TypeError, ValueError):
+            raise ValueError(f"y must hold numbers, got {y!r}") from None
+        request = {
+            "x": x,
+            "y": y,
+            "title": title,
+            "xlabel": xlabel,
+            "ylabel": ylabel,
+            "format": format,
+            "figsize": self._figsize,
+            "dpi": self._dpi,
+        }
+        key = self.request_key(request)
+        path = os.path.join(self.output_dir, f"{key}.{format}")
+        with self._lock:
+            future = self._pending.get(key)
+            if future is None and key in self._cache:
+                self._cache.move_to_end(key)
+                future = Future()
+                future.set_result(self._cache[key])
+            if future is None and os.path.exists(path):
+                # rendered by a previous run
+                future = self._executor.submit(self._read, key, path)
+                self._pending[key] = future
+            if future is not None:
+                self.hits += 1
+                return PlotHandle(key, path, True, future)
+            self.misses += 1
+            future = self._executor.submit(self._render, key, request, path)
+            self._pending[key] = future
+            return PlotHandle(key, path, False, future)
+
+    def _read(self, key: str, path: str) -> bytes:
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            self._remember(key, data)
+            return data
+        finally:
+            with self._lock:
+                self._pending.pop(key, None)
+
+    def _remember(self, key: str, data: bytes) -> None:
+        with self._lock:
+            self._cache[key] = data
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.max_cached:
+                self._cache.popitem(last=False)
+
+    def _render(self, key: str, request: Dict[str, Any], path: str) -> bytes:
+        try:
+            if self._figure is None:
+                # imported here, so that pyplot and its backend are never involved
+                from matplotlib.backends.backend_agg import FigureCanvasAgg
+                from matplotlib.figure import Figure
+
+                self._figure = Figure(figsize=self._figsize, dpi=self._dpi)
+                FigureCanvasAgg(self._figure)
+            figure = self._figure
+            figure.clear()
+            axes = figure.add_subplot()
+            x = [str(value) for value in request["x"]]
+            axes.plot(x, request["y"], marker="o", color="b", linestyle="-")
+            axes.set_title(request["title"])
+            axes.set_xlabel(request["xlabel"])
+            axes.set_ylabel(request["ylabel"])
+            axes.grid(True)
+            axes.tick_params(axis="x", labelrotation=45)
+            figure.tight_layout()
+
+            buffer = io.BytesIO()
+            figure.savefig(buffer, format=request["format"])
+            data = buffer.getvalue()
+            with open(f"{path}.tmp", "wb") as f:
+                f.write(data)
+            os.replace(f"{path}.tmp", path)
+            self._remember(key, data)
+            return data
+        except Exception as e:
+            with self._lock:
+                self.failures += 1
+            print(f"Could not render the plot {path}: {e}")
+            raise
+        finally:
+            with self._lock:
+                self._pending.pop(key, None)
+
+    @property
+    def stats(self) -> Dict[str, float]:
+        """Returns the hit/miss statistics of the renderer."""
+        requests = self.hits + self.misses
+        return {
+            "cached": len(self._cache),
+            "hits": self.hits,
+            "misses": self.misses,
+            "failures": self.failures,
+            "hit_rate": self.hits / requests if requests else 0.0,
+        }
+
+    def close(self) -> None:
+        """Waits for the plots being rendered, then stops the background thread."""
+        self._executor.shutdown(wait=True)
+
+
+_renderers: Dict[str, PlotRenderer] = {}
+_renderers_lock = threading.Lock()
+
+
+def get_renderer(output_dir: str = os.path.join(".", "plots")) -> PlotRenderer:
+    """
+    Returns the process-wide renderer writing to a folder, creating it if needed.
+
+    Args:
+        output_dir (str, optional): The folder of the plot files. Defaults to "./plots".
+
+    Returns:
+        PlotRenderer: The renderer.
+    """
+    with _renderers_lock:
+        if output_dir not in _renderers:
+            _renderers[output_dir] = PlotRenderer(output_dir)
+        return _renderers[output_dir]
@@ -0,0 +1,335 @@
+import asyncio
+import json
+import time
+import uuid
+from collections import OrderedDict
+from typing import Any, AsyncIterator, Callable, Dict, Optional, Tuple, Union
+
+from llama_index.core.agent.types import BaseAgent
+
+from utils.chroma_pool import chroma_pool
+from utils.streaming import TurnStream, watch_tool_calls
+from utils.tracing import trace_span
+
+REASONS = {
+    200: "OK",
+    400: "Bad Request",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    413: "Payload Too Large",
+    500: "Internal Server Error",
+}
+
+
+class ChatServer:
+    """
+    Asyncio HTTP server serving many concurrent chat sessions.
+
+    Every session gets its own agent, and so its own chat memory, while the
+    agents share the tools, and so the loaded indices, of a single chatbot.
+    Turns are run with `achat`, so a session waiting on the LLM does not block
+    the others.
+
+    Routes:
+        POST /chat: `{"message": str, "session_id": str?}` -> `{"session_id": str, "response": str}`.
+            With `"stream": true`, the turn is streamed as newline-delimited JSON: a `{"tool_call": str, "arguments": str}`
+            line per tool call, a `{"delta": str}` line per token, then the response with its `metrics`.
+        DELETE /sessions/<session_id>: Ends a session.
+        GET /health: Returns the number of open sessions and the Chroma client pool metrics.
+
+    Attributes:
+        host (str): The interface to listen on.
+        port (int): The port to listen on.
+        max_sessions (int): The maximum number of open sessions. The least recently used session is closed beyond.
+        session_ttl (float): The idle time after which a session is closed, in seconds.
+    """
+
+    MAX_BODY_SIZE = 1 << 20
+
+    host: str
+    port: int
+    max_sessions: int
+    session_ttl: float
+
+    def __init__(
+        self,
+        create_agent: Callable[[], BaseAgent],
+        host: str = "127.0.0.1",
+        port: int = 8000,
+        max_sessions: int = 1000,
+        session_ttl: float = 3600,
+    ) -> None:
+        """
+        Initializes the server.
+
+        Args:
+            create_agent (Callable[[], BaseAgent]): Creates the agent of a new session.
+            host (str, optional): The interface to listen on. Defaults to "127.0.0.1".
+            port (int, optional): The port to listen on. Defaults to 8000.
+            max_sessions (int, optional): The maximum number of open sessions. Defaults to 1000.
+            session_ttl (float, optional): The idle time after which a session is closed, in seconds. Defaults to 3600.
+        """
+        self.create_agent = create_agent
+        self.host = host
+        self.port = port
+        self.max_sessions = max_sessions
+        self.session_ttl = session_ttl
+        # session id -> (agent, last use), in least recently used order
+        self._sessions: "OrderedDict[str, Tuple[BaseAgent, float]]" = OrderedDict()
+        # a session runs one turn at a time, sessions run concurrently
+        self._session_locks: Dict[str, asyncio.Lock] = {}
+
+    def get_session(self, session_id: Optional[str]) -> Tuple[str, BaseAgent]:
+        """
+        Returns the agent of a session, opening the session if needed.
+
+        Args:
+            session_id (str, optional): The session id. A new session is opened if None or unknown.
+
+        Returns:
+            Tuple[str, BaseAgent]: The session id and its agent.
+        """
+        now = time.monotonic()
+        for expired_id, (_, last_use) in list(self._sessions.items()):
+            if now - last_use > self.session_ttl:
+                self.close_session(expired_id)
+
+        session_id = session_id or uuid.uuid4().hex
+        if session_id in self._sessions:
+            agent, _ = self._sessions.pop(session_id)
+        else:
+            agent = self.create_agent()
+            while len(self._sessions) >= self.max_sessions:
+                self.close_session(next(iter(self._sessions)))
+        self._sessions[session_id] = (agent, now)
+        return session_id, agent
+
+    def close_session(self, session_id: str) -> bool:
+        """
+        Closes a session.
+
+        Args:
+            session_id (str): The session id.
+
+        Returns:
+            bool: Whether the session was open.
+        """
+        self._session_locks.pop(session_id, None)
+        return self._sessions.pop(session_id, None) is not None
+
+    async def chat(self, session_id: Optional[str], message: str) -> Dict[str, Any]:
+        """
+        Runs a chat turn.
+
+        Args:
+            session_id (str, optional): The session id. A new session is opened if None or unknown.
+            message (str): The user message.
+
+        Returns:
+            Dict[str, Any]: The session id and the agent response.
+        """
+        session_id, agent = self.get_session(session_id)
+        lock = self._session_locks.setdefault(session_id, asyncio.Lock())
+        async with lock:
+            with trace_span("server.turn", session_id=session_id):
+                response = await agent.achat(message)
+        return {"session_id": session_id, "response": str(response)}
+
+    async def chat_stream(
+        self, session_id: Optional[str], message: str
+    ) -> AsyncIterator[Dict[str, Any]]:
+        """
+        Runs a chat turn, streaming its tool calls and tokens as they are produced.
+
+        Args:
+            session_id (str, optional): The session id. A new session is opened if None or unknown.
+            message (str): The user message.
+
+        Yields:
+            Dict[str, Any]: The tool calls, the tokens, then the session id, the agent response and the turn metrics.
+        """
+        session_id, agent = self.get_session(session_id)
+        lock = self._session_locks.setdefault(session_id, asyncio.Lock())
+        async with lock:
+            with trace_span("server.turn", session_id=session_id) as span:
+                loop = asyncio.get_running_loop()
+                events: asyncio.Queue = asyncio.Queue()
+                turn = TurnStream()
+
+                def on_tool_call(tool: str, arguments: Optional[str]) -> None:
+                    event = {"tool_call": tool, "arguments": arguments}
+                    loop.call_soon_threadsafe(events.put_nowait, event)
+
+                # the turn task inherits the listener
+                with watch_tool_calls(on_tool_call):
+                    task = asyncio.ensure_future(agent.astream_chat(message))
+                # the tools are called before the answer starts streaming
+                while not task.done() or not events.empty():
+                    get_event = asyncio.ensure_future(events.get())
+                    await asyncio.wait(
+                        {task, get_event}, return_when=asyncio.FIRST_COMPLETED
+                    )
+                    if get_event.done():
+                        yield get_event.result()
+                    else:
+                        get_event.cancel()
+                response = task.result()
+
+                async for delta in turn.atrack(response.async_response_gen()):
+                    if delta:
+                        yield {"delta": delta}
+                metrics = turn.metrics(tool_calls=len(response.sources)).to_dict()
+                if span is not None:
+                    span.attributes.update(metrics)
+        yield {"session_id": session_id, "response": turn.text, "metrics": metrics}
+
+    async def route(
+        self, method: str, path: str, body: bytes
+    ) -> Tuple[int, Union[Dict, AsyncIterator[Dict]]]:
+        """
+        Dispatches a request.
+
+        Args:
+            method (str): The HTTP method.
+            path (str): The request path.
+            body (bytes): The request body.
+
+        Returns:
+            Tuple[int, Union[Dict, AsyncIterator[Dict]]]: The status code and the JSON payload of the response,
+                or the JSON lines of a streamed response.
+        """
+        if path == "/health":
+            return 200, {
+                "status": "ok",
+                "sessions": len(self._sessions),
+                "chroma": chroma_pool.stats,
+            }
+
+        if path == "/chat":
+            if method != "POST":
+                return 405, {"error": "use POST"}
+            try:
+                payload = json.loads(body or b"{}")
+                message = payload["message"]
+            except (ValueError, KeyError, TypeError):
+                return 400, {"error": 'expected a JSON body with a "message" field'}
+            if payload.get("stream"):
+                return 200, self.chat_stream(payload.get("session_id"), message)
+            return 200, await self.chat(payload.get("session_id"), message)
+
+        if path.startswith("/sessions/"):
+            if method != "DELETE":
+                return 405, {"error": "use DELETE"}
+            session_id = path[len("/sessions/") :]
+            if not self.close_session(session_id):
+                return 404, {"error": f"unknown session {session_id}"}
+            return 200, {"session_id": session_id, "closed": True}
+
+        return 404, {"error": f"unknown route {path}"}
+
+    async def handle(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        """Serves a single HTTP/1.1 request per connection."""
+        try:
+            head = await reader.readuntil(b"\r\n\r\n")
+            request_line, *header_lines = head.decode("latin-1").split("\r\n")
+            method, target, _ = request_line.split(" ", 2)
+            headers = {}
+            for line in header_lines:
+                if ":" in line:
+                    name, value = line.split(":", 1)
+                    headers[name.strip().lower()] = value.strip()
+            length = int(headers.get("content-length", 0))
+            if length > self.MAX_BODY_SIZE:
+                raise OverflowError
+            body = await reader.readexactly(length) if length else b""
+        except OverflowError:
+            status, payload = 413, {"error": "request body too large"}
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ValueError):
+            status, payload = 400, {"error": "malformed request"}
+        else:
+            try:
+                status, payload = await self.route(
+                    method.upper(), target.split("?", 1)[0], body
+                )
+            except Exception as e:
+                print(e)
+                status, payload = 500, {"error": str(e)}
+
+        if not isinstance(payload, dict):
+            await self.write_stream(writer, status, payload)
+            return
+
+        data = json.dumps(payload).encode()
+        writer.write(
+            (
+                f"HTTP/1.1 {status} {REASONS[status]}\r\n"
+                "Content-Type: application/json\r\n"
+                f"Content-Length: {len(data)}\r\n"
+                "Connection: close\r\n\r\n"
+            ).encode()
+            + data
+        )
+        try:
+            await writer.drain()
+        finally:
+            writer.close()
+
+    async def write_stream(
+        self,
+        writer: asyncio.StreamWriter,
+        status: int,
+        lines: AsyncIterator[Dict],
+    ) -> None:
+        """Writes JSON lines as a chunked response, flushing every line as soon as it is produced."""
+        writer.write(
+            (
+                f"HTTP/1.1 {status} {REASONS[status]}\r\n"
+                "Content-Type: application/x-ndjson\r\n"
+                "Transfer-Encoding: chunked\r\n"
+                "Connection: close\r\n\r\n"
+            ).encode()
+        )
+        try:
+            try:
+                async for line in lines:
+                    data = json.dumps(line).encode() + b"\n"
+                    writer.write(b"%x\r\n%s\r\n" % (len(data), data))
+                    await writer.drain()
+            except (ConnectionError, asyncio.CancelledError):
+                raise
+            except Exception as e:
+                print(e)
+                data = json.dumps({"error": str(e)}).encode() + b"\n"
+                writer.write(b"%x\r\n%s\r\n" % (len(data), data))
+            writer.write(b"0\r\n\r\n")
+            await writer.drain()
+        finally:
+            # closes an abandoned stream in the task that ran it
+            aclose = getattr(lines, "aclose", None)
+            if aclose is not None:
+                await aclose()
+            writer.close()
+
+    async def serve_forever(self) -> None:
+        """Listens until cancelled."""
+        server = await asyncio.start_server(self.handle, self.host, self.port)
+        print(f"Serving chat sessions on http://{self.host}:{self.port}")
+        async with server:
+            await server.serve_forever()
+
+
+def serve_sessions(create_agent: Callable[[], BaseAgent], host: str, port: int) -> None:
+    """
+    Runs a `ChatServer` until interrupted.
+
+    Args:
+        create_agent (Callable[[], BaseAgent]): Creates the agent of a new session.
+        host (str): The interface to listen on.
+        port (int): The port to listen on.
+    """
+    try:
+        asyncio.run(ChatServer(create_agent, host=host, port=port).serve_forever())
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,226 @@
+import contextvars
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import (
+    Any,
+    AsyncIterable,
+    AsyncIterator,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+)
+
+from llama_index.core import Settings
+from llama_index.core.callbacks.base_handler import BaseCallbackHandler
+from llama_index.core.callbacks.schema import CBEventType, EventPayload
+
+
+@dataclass
+class TurnMetrics:
+    """
+    Latency of a streamed agent turn.
+
+    Attributes:
+        time_to_first_token (Optional[float]): Wall time from the start of the turn to its first token,
+            tool calls included, in seconds. None if nothing was streamed.
+        duration (float): Wall time of the whole turn, in seconds.
+        tokens (int): The number of tokens of the answer.
+        deltas (int): The number of chunks the answer was streamed in.
+        tool_calls (int): The number of tools the agent called.
+    """
+
+    time_to_first_token: Optional[float]
+    duration: float
+    tokens: int
+    deltas: int
+    tool_calls: int = 0
+
+    @property
+    def tokens_per_second(self) -> Optional[float]:
+        """The generation rate, from the first token to the end of the turn, None if the answer was not streamed."""
+        if self.time_to_first_token is None or self.deltas < 2:
+            return None
+        generation = self.duration - self.time_to_first_token
+        return self.tokens / generation if generation > 0 else None
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Returns the metrics, generation rate included."""
+        return {
+            "time_to_first_token": self.time_to_first_token,
+            "duration": self.duration,
+            "tokens": self.tokens,
+            "deltas": self.deltas,
+            "tokens_per_second": self.tokens_per_second,
+            "tool_calls": self.tool_calls,
+        }
+
+    def __str__(self) -> str:
+        first = (
+            "no token"
+            if self.time_to_first_token is None
+            else f"first token in {self.time_to_first_token:.2f}s"
+        )
+        rate = self.tokens_per_second
+        rate = f" at {rate:.1f} tokens/s" if rate is not None else ""
+        return (
+            f"{first}, {self.tokens} tokens{rate}, "
+            f"{self.tool_calls} tool calls, {self.duration:.2f}s"
+        )
+
+
+class TurnStream:
+    """
+    Tracks the tokens of an agent turn as they are streamed.
+
+    The turn starts when the stream is created, so that the time to the first
+    token includes the tool calls the agent makes before answering.
+    """
+
+    def __init__(self) -> None:
+        """Starts the turn."""
+        self._start = time.perf_counter()
+        self._first_token: Optional[float] = None
+        self._end: Optional[float] = None
+        self._deltas: List[str] = []
+
+    def _record(self, delta: str) -> None:
+        if delta and self._first_token is None:
+            self._first_token = time.perf_counter()
+        self._deltas.append(delta)
+
+    def track(self, deltas: Iterable[str]) -> Iterator[str]:
+        """
+        Passes the deltas of a stream through, timing them.
+
+        Args:
+            deltas (Iterable[str]): The deltas, e.g. `StreamingAgentChatResponse.response_gen`.
+
+        Yields:
+            str: The deltas.
+        """
+        for delta in deltas:
+            self._record(delta)
+            yield delta
+        self._end = time.perf_counter()
+
+    async def atrack(self, deltas: AsyncIterable[str]) -> AsyncIterator[str]:
+        """
+        Passes the deltas of an async stream through, timing them.
+
+        Args:
+            deltas (AsyncIterable[str]): The deltas, e.g. `StreamingAgentChatResponse.async_response_gen()`.
+
+        Yields:
+            str: The deltas.
+        """
+        async for delta in deltas:
+            self._record(delta)
+            yield delta
+        self._end = time.perf_counter()
+
+    @property
+    def text(self) -> str:
+        """The text streamed so far."""
+        return "".join(self._deltas)
+
+    def metrics(self, tool_calls: int = 0) -> TurnMetrics:
+        """
+        Gets the metrics of the turn, ending it if the stream was not exhausted.
+
+        Args:
+            tool_calls (int, optional): The number of tools the agent called. Defaults to 0.
+
+        Returns:
+            TurnMetrics: The metrics.
+        """
+        end = self._end or time.perf_counter()
+        return TurnMetrics(
+            time_to_first_token=(
+                self._first_token - self._start
+                if self._first_token is not None
+                else None
+            ),
+            duration=end - self._start,
+            tokens=len(Settings.tokenizer(self.text)),
+            deltas=sum(1 for delta in self._deltas if delta),
+            tool_calls=tool_calls,
+        )
+
+
+# the listener of the tool calls of the running turn
+_tool_call_listener: contextvars.ContextVar[
+    Optional[Callable[[str, Optional[str]], None]]
+] = contextvars.ContextVar("tool_call_listener", default=None)
+
+
+class ToolCallNotifier(BaseCallbackHandler):
+    """Callback handler reporting the function calls of agents to the listener of their turn."""
+
+    def __init__(self) -> None:
+        super().__init__(event_starts_to_ignore=[], event_ends_to_ignore=[])
+
+    def on_event_start(
+        self,
+        event_type: CBEventType,
+        payload: Optional[Dict[str, Any]] = None,
+        event_id: str = "",
+        parent_id: str = "",
+        **kwargs: Any,
+    ) -> str:
+        listener = _tool_call_listener.get()
+        if listener is not None and event_type == CBEventType.FUNCTION_CALL:
+            payload = payload or {}
+            tool = payload.get(EventPayload.TOOL)
+            listener(getattr(tool, "name", ""), payload.get(EventPayload.FUNCTION_CALL))
+        return event_id
+
+    def on_event_end(
+        self,
+        event_type: CBEventType,
+        payload: Optional[Dict[str, Any]] = None,
+        event_id: str = "",
+        **kwargs: Any,
+    ) -> None:
+        pass
+
+    def start_trace(self, trace_id: Optional[str] = None) -> None:
+        pass
+
+    def end_trace(
+        self,
+        trace_id: Optional[str] = None,
+        trace_map: Optional[Dict[str, List[str]]] = None,
+    ) -> None:
+        pass
+
+
+_notifier: Optional[ToolCallNotifier] = None
+
+
+@contextmanager
+def watch_tool_calls(listener: Callable[[str, Optional[str]], None]) -> Iterator[None]:
+    """
+    Reports the tool calls of the agent turns run within the context.
+
+    The listener is held in a context variable. Asyncio tasks created within
+    the context and functions run with `asyncio.to_thread` inherit it, so a
+    turn may run in a task created in the context. Plain threads and
+    `loop.run_in_executor` do not copy the context, and must be run with
+    `contextvars.copy_context().run` to report their tool calls.
+
+    Args:
+        listener (Callable[[str, Optional[str]], None]): Called with the tool name and its JSON arguments.
+    """
+    global _notifier
+    if _notifier is None:
+        _notifier = ToolCallNotifier()
+        Settings.callback_manager.add_handler(_notifier)
+    token = _tool_call_listener.set(listener)
+    try:
+        yield
+    finally:
+        _tool_call_listener.reset(token)
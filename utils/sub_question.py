@@ -0,0 +1,218 @@
+import asyncio
+import contextvars
+import time
+import weakref
+from dataclasses import asdict, dataclass
+from typing import Any, List, Optional, Sequence
+
+from llama_index.core.base.response.schema import RESPONSE_TYPE
+from llama_index.core.query_engine import SubQuestionQueryEngine
+from llama_index.core.prompts.mixin import PromptDictType, PromptMixinType
+from llama_index.core.question_gen.types import BaseQuestionGenerator, SubQuestion
+from llama_index.core.schema import QueryBundle
+from llama_index.core.tools import QueryEngineTool, ToolMetadata
+from llama_index.core.utils import print_text
+
+from utils.tracing import trace_span
+
+
+@dataclass
+class SubQuestionTiming:
+    """
+    Outcome of a single sub-question.
+
+    Attributes:
+        tool_name (str): The tool the sub-question was routed to.
+        sub_question (str): The sub-question.
+        latency (float): Wall time from the start of the sub-question to its outcome, in seconds.
+        status (str): "ok", "timeout" or "error".
+    """
+
+    tool_name: str
+    sub_question: str
+    latency: float
+    status: str
+
+
+# timings of the sub-questions of the query being run
+_timings: contextvars.ContextVar[List[SubQuestionTiming]] = contextvars.ContextVar(
+    "sub_question_timings"
+)
+
+
+class TracedQuestionGenerator(BaseQuestionGenerator):
+    """Question generator recording the generation of the sub-questions as a "sub_question.generate" span."""
+
+    def __init__(self, question_gen: BaseQuestionGenerator) -> None:
+        """
+        Wraps a question generator.
+
+        Args:
+            question_gen (BaseQuestionGenerator): The generator doing the actual work.
+        """
+        self._question_gen = question_gen
+
+    def _get_prompts(self) -> PromptDictType:
+        # the prompts keep the keys of the wrapped generator
+        return self._question_gen.get_prompts()
+
+    def _update_prompts(self, prompts: PromptDictType) -> None:
+        self._question_gen.update_prompts(prompts)
+
+    def _get_prompt_modules(self) -> PromptMixinType:
+        return {}
+
+    def generate(
+        self, tools: Sequence[ToolMetadata], query: QueryBundle
+    ) -> List[SubQuestion]:
+        with trace_span("sub_question.generate") as span:
+            sub_questions = self._question_gen.generate(tools, query)
+            if span is not None:
+                span.attributes["sub_questions"] = len(sub_questions)
+        return sub_questions
+
+    async def agenerate(
+        self, tools: Sequence[ToolMetadata], query: QueryBundle
+    ) -> List[SubQuestion]:
+        with trace_span("sub_question.generate") as span:
+            sub_questions = await self._question_gen.agenerate(tools, query)
+            if span is not None:
+                span.attributes["sub_questions"] = len(sub_questions)
+        return sub_questions
+
+
+class ParallelSubQuestionQueryEngine(SubQuestionQueryEngine):
+    """
+    Sub-question query engine fanning the sub-questions out concurrently.
+
+    Every sub-question runs in a worker thread, so that the synchronous
+    retrieval of one year does not hold back the others, with at most
+    `max_concurrency` of them in flight. A sub-question exceeding
+    `sub_question_timeout` is dropped and the answer is synthesized from the
+    ones that completed. The outcome and latency of every sub-question are
+    recorded under `response.metadata["sub_questions"]`, along with the
+    `critical_path`, the latency of the slowest one. With tracing enabled, the
+    generation of the sub-questions is recorded as its own span.
+
+    Note that a timed out sub-question is abandoned, not interrupted: its
+    thread runs to completion in the background, and holds its slot until
+    then, so that at most `max_concurrency` threads ever run.
+    """
+
+    def __init__(
+        self,
+        *args: Any,
+        max_concurrency: int = 4,
+        sub_question_timeout: Optional[float] = 60.0,
+        **kwargs: Any,
+    ) -> None:
+        """
+        Initializes the engine.
+
+        Args:
+            max_concurrency (int, optional): The maximum number of sub-questions in flight. Defaults to 4.
+            sub_question_timeout (float, optional): The timeout of a sub-question, in seconds. None disables it. Defaults to 60.
+            *args, **kwargs: The arguments of `SubQuestionQueryEngine`.
+        """
+        super().__init__(*args, **kwargs)
+        if not isinstance(self._question_gen, TracedQuestionGenerator):
+            self._question_gen = TracedQuestionGenerator(self._question_gen)
+        self.max_concurrency = max_concurrency
+        self.sub_question_timeout = sub_question_timeout
+        # the sub-questions of a query run in their own event loop
+        self._semaphores: (
+            "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, asyncio.Semaphore]"
+        ) = weakref.WeakKeyDictionary()
+
+    @classmethod
+    def from_defaults(
+        cls,
+        query_engine_tools: Sequence[QueryEngineTool],
+        max_concurrency: int = 4,
+        sub_question_timeout: Optional[float] = 60.0,
+        **kwargs: Any,
+    ) -> "ParallelSubQuestionQueryEngine":
+        """
+        Creates the engine with the defaults of `SubQuestionQueryEngine.from_defaults`.
+
+        Args:
+            query_engine_tools (Sequence[QueryEngineTool]): The tools to route sub-questions to.
+            max_concurrency (int, optional): The maximum number of sub-questions in flight. Defaults to 4.
+            sub_question_timeout (float, optional): The timeout of a sub-question, in seconds. None disables it. Defaults to 60.
+            **kwargs: The other arguments of `SubQuestionQueryEngine.from_defaults`.
+
+        Returns:
+            ParallelSubQuestionQueryEngine: The created engine.
+        """
+        kwargs["use_async"] = True
+        engine = super().from_defaults(query_engine_tools, **kwargs)
+        engine.max_concurrency = max_concurrency
+        engine.sub_question_timeout = sub_question_timeout
+        return engine  # type: ignore
+
+    def _semaphore(self) -> asyncio.Semaphore:
+        loop = asyncio.get_running_loop()
+        if loop not in self._semaphores:
+            self._semaphores[loop] = asyncio.Semaphore(self.max_concurrency)
+        return self._semaphores[loop]
+
+    @staticmethod
+    def _release(semaphore: asyncio.Semaphore, task: "asyncio.Future") -> None:
+        semaphore.release()
+        # retrieved, as a sub-question that timed out is not awaited anymore
+        if not task.cancelled():
+            task.exception()
+
+    async def _aquery_subq(self, sub_q: SubQuestion, color: Optional[str] = None):
+        status, qa_pair = "ok", None
+        semaphore = self._semaphore()
+        await semaphore.acquire()
+        start = time.perf_counter()
+        task = asyncio.ensure_future(asyncio.to_thread(self._query_subq, sub_q, color))
+        # the slot is freed once the thread ends, which a timeout cannot interrupt
+        task.add_done_callback(lambda task: self._release(semaphore, task))
+        try:
+            qa_pair = await asyncio.wait_for(
+                asyncio.shield(task), self.sub_question_timeout
+            )
+            if qa_pair is None:
+                status = "error"
+        except asyncio.TimeoutError:
+            status = "timeout"
+        except Exception as e:
+            status = "error"
+            print_text(f"[{sub_q.tool_name}] Failed: {e}\n", color=color)
+        latency = time.perf_counter() - start
+
+        timing = SubQuestionTiming(sub_q.tool_name, sub_q.sub_question, latency, status)
+        _timings.get([]).append(timing)
+        if self._verbose:
+            print_text(f"[{sub_q.tool_name}] {status} in {latency:.2f}s\n", color=color)
+        return qa_pair
+
+    def _record(self, response: RESPONSE_TYPE, timings: List[SubQuestionTiming]):
+        if response.metadata is None:
+            response.metadata = {}
+        response.metadata["sub_questions"] = [asdict(timing) for timing in timings]
+        response.metadata["critical_path"] = max(
+            (timing.latency for timing in timings), default=0.0
+        )
+        return response
+
+    def _query(self, query_bundle: QueryBundle) -> RESPONSE_TYPE:
+        timings: List[SubQuestionTiming] = []
+        token = _timings.set(timings)
+        try:
+            response = super()._query(query_bundle)
+        finally:
+            _timings.reset(token)
+        return self._record(response, timings)
+
+    async def _aquery(self, query_bundle: QueryBundle) -> RESPONSE_TYPE:
+        timings: List[SubQuestionTiming] = []
+        token = _timings.set(timings)
+        try:
+            response = await super()._aquery(query_bundle)
+        finally:
+            _timings.reset(token)
+        return self._record(response, timings)
@@ -0,0 +1,362 @@
+import atexit
+import json
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager, nullcontext
+from dataclasses import dataclass, field
+from typing import Any, ContextManager, Deque, Dict, Iterator, List, Optional
+
+from llama_index.core import Settings
+from llama_index.core.callbacks.base import (
+    global_stack_trace,
+    global_stack_trace_ids,
+)
+from llama_index.core.callbacks.base_handler import BaseCallbackHandler
+from llama_index.core.callbacks.schema import CBEventType, EventPayload
+from llama_index.core.callbacks.token_counting import get_llm_token_counts
+from llama_index.core.utilities.token_counting import TokenCounter
+
+
+@dataclass
+class Span:
+    """
+    A timed stage of a query or agent turn.
+
+    Attributes:
+        span_id (str): The id of the span, the LlamaIndex event id for events.
+        parent_id (str): The id of the enclosing span, "root" at the top.
+        name (str): The stage, e.g. "retrieve", "llm" or "function_call".
+        start (float): The start time, as returned by `time.perf_counter`.
+        duration (float): The wall time of the stage, in seconds.
+        thread_id (int): The thread the stage started on.
+        attributes (Dict[str, Any]): The details of the stage, e.g. the tool name or the token counts.
+    """
+
+    span_id: str
+    parent_id: str
+    name: str
+    start: float
+    duration: float = 0.0
+    thread_id: int = 0
+    attributes: Dict[str, Any] = field(default_factory=dict)
+
+
+class Tracer(BaseCallbackHandler):
+    """
+    Callback handler recording the LlamaIndex events as nested spans.
+
+    Queries, retrievals, syntheses, sub-questions, LLM calls, embeddings and
+    function calls are recorded with their wall time, along with the token
+    counts of the LLM calls, the number of retrieved nodes and the tool names.
+    Stages that are not LlamaIndex events are recorded with `span`. The spans
+    can be exported as a Chrome trace, to be opened in `chrome://tracing` or
+    https://ui.perfetto.dev.
+
+    The tracer only runs once registered with `enable_tracing`, so that a
+    disabled tracer costs nothing.
+
+    Attributes:
+        path (Optional[str]): The Chrome trace file `flush` writes to.
+        max_spans (int): The number of finished spans kept, the oldest are dropped beyond.
+    """
+
+    path: Optional[str]
+    max_spans: int
+
+    def __init__(self, path: Optional[str] = None, max_spans: int = 100_000) -> None:
+        """
+        Creates the tracer.
+
+        Args:
+            path (str, optional): The Chrome trace file `flush` writes to. Defaults to None.
+            max_spans (int, optional): The number of finished spans kept. Defaults to 100000.
+        """
+        super().__init__(event_starts_to_ignore=[], event_ends_to_ignore=[])
+        self.path = path
+        self.max_spans = max_spans
+        self._epoch = time.perf_counter()
+        self._lock = threading.Lock()
+        self._open: Dict[str, Span] = {}
+        self._spans: Deque[Span] = deque(maxlen=max_spans)
+        self._token_counter: Optional[TokenCounter] = None
+        self._next_id = 0
+
+    @property
+    def spans(self) -> List[Span]:
+        """The finished spans, in order of completion."""
+        with self._lock:
+            return list(self._spans)
+
+    def _start(self, span_id: str, parent_id: str, name: str, **attributes) -> Span:
+        span = Span(
+            span_id,
+            parent_id or "root",
+            name,
+            time.perf_counter(),
+            thread_id=threading.get_ident(),
+            attributes=attributes,
+        )
+        with self._lock:
+            self._open[span_id] = span
+        return span
+
+    def _end(self, span_id: str, **attributes) -> None:
+        end = time.perf_counter()
+        with self._lock:
+            span = self._open.pop(span_id, None)
+            if span is None:
+                return
+            span.duration = end - span.start
+            span.attributes.update(attributes)
+            self._spans.append(span)
+
+    def on_event_start(
+        self,
+        event_type: CBEventType,
+        payload: Optional[Dict[str, Any]] = None,
+        event_id: str = "",
+        parent_id: str = "",
+        **kwargs: Any,
+    ) -> str:
+        payload = payload or {}
+        attributes: Dict[str, Any] = {}
+        if EventPayload.QUERY_STR in payload:
+            attributes["query"] = str(payload[EventPayload.QUERY_STR])
+        if event_type == CBEventType.FUNCTION_CALL:
+            tool = payload.get(EventPayload.TOOL)
+            attributes["tool"] = getattr(tool, "name", None)
+            attributes["arguments"] = payload.get(EventPayload.FUNCTION_CALL)
+        self._start(event_id, parent_id, event_type.value, **attributes)
+        return event_id
+
+    def on_event_end(
+        self,
+        event_type: CBEventType,
+        payload: Optional[Dict[str, Any]] = None,
+        event_id: str = "",
+        **kwargs: Any,
+    ) -> None:
+        payload = payload or {}
+        attributes: Dict[str, Any] = {}
+        if event_type == CBEventType.LLM:
+            if self._token_counter is None:
+                self._token_counter = TokenCounter(Settings.tokenizer)
+            # the usage reported by the LLM, else the tokenized prompt and completion
+            counts = get_llm_token_counts(self._token_counter, payload)
+            attributes["prompt_tokens"] = counts.prompt_token_count
+            attributes["completion_tokens"] = counts.completion_token_count
+        elif event_type == CBEventType.EMBEDDING:
+            attributes["chunks"] = len(payload.get(EventPayload.CHUNKS, []) or [])
+        elif event_type == CBEventType.SUB_QUESTION:
+            qa_pair = payload.get(EventPayload.SUB_QUESTION)
+            if qa_pair is not None:
+                attributes["tool"] = qa_pair.sub_q.tool_name
+                attributes["sub_question"] = qa_pair.sub_q.sub_question
+        if EventPayload.NODES in payload:
+            attributes["nodes"] = len(payload[EventPayload.NODES] or [])
+        self._end(event_id, **attributes)
+
+    def start_trace(self, trace_id: Optional[str] = None) -> None:
+        pass
+
+    def end_trace(
+        self,
+        trace_id: Optional[str] = None,
+        trace_map: Optional[Dict[str, List[str]]] = None,
+    ) -> None:
+        pass
+
+    @contextmanager
+    def span(self, name: str, **attributes) -> Iterator[Span]:
+        """
+        Records a stage that is not a LlamaIndex event.
+
+        The events started within the stage are nested under it, as part of a
+        single LlamaIndex trace.
+
+        Args:
+            name (str): The stage, e.g. "chatbot.turn".
+            **attributes: The details of the stage.
+
+        Yields:
+            Span: The span, whose attributes may be completed before it ends.
+        """
+        with self._lock:
+            self._next_id += 1
+            span_id = f"{name}-{self._next_id}"
+        stack = global_stack_trace.get()
+        span = self._start(span_id, stack[-1] if stack else "root", name, **attributes)
+        # a running trace keeps the queries within from resetting the event stack
+        trace_token = global_stack_trace_ids.set(global_stack_trace_ids.get() + [name])
+        token = global_stack_trace.set(stack + [span_id])
+        try:
+            yield span
+        finally:
+            global_stack_trace.reset(token)
+            global_stack_trace_ids.reset(trace_token)
+            self._end(span_id)
+
+    def descendants(self, span_id: str) -> List[Span]:
+        """
+        Gets the finished spans nested under a span.
+
+        Args:
+            span_id (str): The id of the span.
+
+        Returns:
+            List[Span]: The spans, in order of completion.
+        """
+        spans = self.spans
+        children: Dict[str, List[Span]] = {}
+        for span in spans:
+            children.setdefault(span.parent_id, []).append(span)
+        found, pending = set(), [span_id]
+        while pending:
+            for child in children.get(pending.pop(), []):
+                found.add(child.span_id)
+                pending.append(child.span_id)
+        return [span for span in spans if span.span_id in found]
+
+    def summary(self, span_id: str) -> str:
+        """
+        Summarizes the time spent in every stage under a span.
+
+        Args:
+            span_id (str): The id of the span, e.g. of a "chatbot.turn".
+
+        Returns:
+            str: The stages by decreasing total time, nested stages included, with their counts, tokens and nodes.
+        """
+        stages: Dict[str, Dict[str, float]] = {}
+        for span in self.descendants(span_id):
+            name = span.name
+            if span.attributes.get("tool"):
+                name = f"{name}[{span.attributes['tool']}]"
+            stage = stages.setdefault(name, {"count": 0, "time": 0.0})
+            stage["count"] += 1
+            stage["time"] += span.duration
+            for key in ("prompt_tokens", "completion_tokens", "nodes"):
+                if key in span.attributes:
+                    stage[key] = stage.get(key, 0) + span.attributes[key]
+        parts = []
+        for name, stage in sorted(
+            stages.items(), key=lambda item: item[1]["time"], reverse=True
+        ):
+            details = [f"x{stage['count']:.0f}"]
+            if "prompt_tokens" in stage:
+                details.append(
+                    f"{stage['prompt_tokens']:.0f}+{stage['completion_tokens']:.0f} tokens"
+                )
+            if "nodes" in stage:
+                details.append(f"{stage['nodes']:.0f} nodes")
+            parts.append(f"{name} {stage['time']:.2f}s ({', '.join(details)})")
+        return ", ".join(parts)
+
+    def to_chrome_trace(self) -> Dict[str, Any]:
+        """
+        Converts the finished spans to the Chrome trace event format.
+
+        Returns:
+            Dict[str, Any]: The trace, with a complete ("X") event per span.
+        """
+        pid = os.getpid()
+        events = [
+            {
+                "name": span.name,
+                "cat": span.name.split(".")[0],
+                "ph": "X",
+                "ts": round((span.start - self._epoch) * 1e6, 3),
+                "dur": round(span.duration * 1e6, 3),
+                "pid": pid,
+                "tid": span.thread_id,
+                "args": {
+                    "span_id": span.span_id,
+                    "parent_id": span.parent_id,
+                    **{key: _jsonable(value) for key, value in span.attributes.items()},
+                },
+            }
+            for span in self.spans
+        ]
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def flush(self, path: Optional[str] = None) -> None:
+        """
+        Writes the finished spans to a Chrome trace file.
+
+        Args:
+            path (str, optional): The path of the file. Defaults to `self.path`.
+        """
+        path = path or self.path
+        if path is None:
+            return
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(f"{path}.tmp", "w") as f:
+            json.dump(self.to_chrome_trace(), f)
+        os.replace(f"{path}.tmp", path)
+
+
+def _jsonable(value: Any) -> Any:
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    return str(value)
+
+
+# the tracer registered with `Settings.callback_manager`, if any
+_tracer: Optional[Tracer] = None
+
+
+def enable_tracing(path: Optional[str] = None) -> Tracer:
+    """
+    Registers a tracer with `Settings.callback_manager`, shared by the indices, LLMs and agents.
+
+    The trace is written to `path` at exit.
+
+    Args:
+        path (str, optional): The Chrome trace file. Defaults to None.
+
+    Returns:
+        Tracer: The registered tracer, the already registered one if any.
+    """
+    global _tracer
+    if _tracer is None:
+        _tracer = Tracer(path)
+        Settings.callback_manager.add_handler(_tracer)
+        atexit.register(_tracer.flush)
+    elif path is not None:
+        _tracer.path = path
+    return _tracer
+
+
+def disable_tracing() -> None:
+    """Unregisters the tracer, writing its trace."""
+    global _tracer
+    if _tracer is None:
+        return
+    Settings.callback_manager.remove_handler(_tracer)
+    atexit.unregister(_tracer.flush)
+    _tracer.flush()
+    _tracer = None
+
+
+def get_tracer() -> Optional[Tracer]:
+    """Returns the registered tracer, None when tracing is disabled."""
+    return _tracer
+
+
+def trace_span(name: str, **attributes) -> ContextManager[Optional[Span]]:
+    """
+    Records a stage with the registered tracer, doing nothing when tracing is disabled.
+
+    Args:
+        name (str): The stage.
+        **attributes: The details of the stage.
+
+    Returns:
+        ContextManager[Optional[Span]]: The span, None when tracing is disabled.
+    """
+    tracer = _tracer
+    if tracer is None:
+        return nullcontext()
+    return tracer.span(name, **attributes)